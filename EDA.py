@@ -1,111 +1,64 @@
-import psycopg2
-import pandas as pd
-# use the natural language toolkit library to remove stopwords
-import nltk
-from nltk.corpus import stopwords
+import argparse
 
-DB_PARAMS = {
-    'dbname': 'poetry',
-    'user': '',
-    'host': 'localhost',
-    'port': '5432'
-}
-
-def execute_query(query):
-    conn = psycopg2.connect(**DB_PARAMS)
-    return pd.read_sql_query(query, conn)
+import analytics
+import sketches
+import wordfreq
 
 
 def advanced_poetry_database_eda():
     print("Performing Advanced Exploratory Data Analysis on Poetry Database")
 
+    # every dataset comes from the shared analytics module, which computes it once and caches it for the charts
+
     # 1. poems length distribution analysis
-    poem_length_distribution = execute_query("""
-            SELECT 
-                CASE 
-                    WHEN line_count <= 4 THEN 'Very Short (1-4 lines)'
-                    WHEN line_count <= 14 THEN 'Short (5-14 lines)'
-                    WHEN line_count <= 30 THEN 'Medium (15-30 lines)'
-                    WHEN line_count <= 50 THEN 'Long (31-50 lines)'
-                    ELSE 'Very Long (50+ lines)'
-                END as length_category,
-                COUNT(*) as poem_count
-            FROM poems
-            GROUP BY length_category
-            ORDER BY poem_count DESC
-        """)
+    poem_length_distribution = analytics.load(analytics.POEM_LENGTHS)
 
     print("\n1. Distribution of poem lengths:")
     print(poem_length_distribution)
 
 
     # 2. Top 10 most productive authors, by number of poems and total lines
-    author_productivity = execute_query("""
-        SELECT a.author_name, 
-               COUNT(DISTINCT p.poem_id) as poem_count,
-               SUM(p.line_count) as total_lines
-        FROM authors a
-        JOIN poems p ON a.author_id = p.author_id
-        GROUP BY a.author_name
-        ORDER BY poem_count DESC
-        LIMIT 10
-    """)
+    author_productivity = analytics.load(analytics.AUTHOR_PRODUCTIVITY)
 
     print("\n2. Top 10 most productive authors:")
     print(author_productivity)
 
     # 3. time-related words frequency analysis
-    time_references = execute_query("""
-        SELECT LOWER(word) as word, COUNT(*) as frequency
-        FROM poems p
-        JOIN lines l ON p.poem_id = l.poem_id,
-        LATERAL UNNEST(STRING_TO_ARRAY(l.line_content, ' ')) AS word
-        WHERE LOWER(word) IN ('morning', 'afternoon', 'evening', 'night', 
-                              'dawn', 'dusk', 'noon', 'midnight',
-                              'spring', 'summer', 'autumn', 'winter',
-                              'january', 'february', 'march', 'april', 'may', 'june',
-                              'july', 'august', 'september', 'october', 'november', 'december')
-        GROUP BY LOWER(word)
-        ORDER BY frequency DESC
-    """)
+    time_references = analytics.load(analytics.TIME_REFERENCES)
 
     print("\n3. Frequency of time-related words in poems:")
     print(time_references)
 
 
     # 4. Top 20 most common words across all poems
-    # download the stopwords list
-    nltk.download('stopwords')
-    # get the list of stopwords
-    stop_words = stopwords.words('english')
-    # Escape stop words containing single quotes (replace ' with '' to avoid SQL errors)
-    stop_words_escaped = [word.replace("'", "''") for word in stop_words]
-    # convert the stop words list to a format that can be used in SQL queries
-    stopwords_sql = "', '".join(stop_words_escaped)
-
-    # SQL query to get the top 20 most common words across all poems
-    theme_words_query = f"""
-        SELECT LOWER(word) as word, COUNT(*) as frequency
-        FROM poems p
-        JOIN lines l ON p.poem_id = l.poem_id,
-        LATERAL UNNEST(STRING_TO_ARRAY(l.line_content, ' ')) AS word
-        WHERE LENGTH(word) > 2
-        AND LOWER(word) NOT IN ('{stopwords_sql}', 'thy', 'thou', 'thee', 'shall', 'unto', 'thine', 'yet', 'thee', 'would', 'upon',
-        'let', 'still', 'though', 'like', 'could', 'must', 'whose', 'thus', 'made', 'till', 'every', 'might', 'many', 'make', 'ever',
-        'hath', 'first', 'know', 'come', 'even', 'last', 'much')
-        AND LOWER(word) NOT LIKE '%''%'
-        AND LOWER(word) NOT LIKE '%,'
-        GROUP BY LOWER(word)
-        ORDER BY frequency DESC
-        LIMIT 20
-    """
-
-    theme_words = execute_query(theme_words_query)
+    # nltk stopwords and our own custom stopwords are left out, see analytics.excluded_words
+    theme_words = analytics.load(analytics.THEME_WORDS).head(20)
 
     print("\n4. Top 20 most frequent words (potential themes) across all poems:")
     print(theme_words)
 
 
+# parse the command line and print the analysis
+def command_line(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Print the exploratory analysis of the poetry database")
+    parser.add_argument("--backend", choices=wordfreq.BACKENDS, default=wordfreq.BACKEND,
+                        help="where the word frequencies are counted")
+    parser.add_argument("--snapshot", help="read the corpus from this snapshot directory instead of the database")
+    parser.add_argument("--approximate", action="store_true",
+                        help="estimate the word frequencies from streaming sketches, with error bounds")
+    args = parser.parse_args(argv)
+    if args.approximate and args.snapshot:
+        parser.error("--approximate reads the sketches stored in the database, it can't be used with --snapshot")
+    wordfreq.BACKEND = args.backend
+    if args.snapshot:
+        analytics.use_snapshot(args.snapshot)
+    analytics.use_approximate(args.approximate)
+    advanced_poetry_database_eda()
+    if args.approximate:
+        print("\nError bounds of the estimates:")
+        for line in sketches.describe_errors():
+            print("  " + line)
+
 
 if __name__ == "__main__":
-    advanced_poetry_database_eda()
\ No newline at end of file
+    command_line()
\ No newline at end of file
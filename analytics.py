@@ -0,0 +1,304 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import db
+import frames
+import schema
+import sketches
+import stopwords
+import wordfreq
+
+# datasets are cached here as <name>-<version>.parquet, so EDA.py and visualization.py share one computation
+CACHE_DIR = os.path.join(".cache", "analytics")
+
+# names of the shared datasets
+POEM_LENGTHS = "poem_length_distribution"
+AUTHOR_PRODUCTIVITY = "author_productivity"
+TIME_REFERENCES = "time_references"
+THEME_WORDS = "theme_words"
+WORD_DIVERSITY = "poem_length_word_diversity"
+
+TIME_WORDS = [
+    'morning', 'afternoon', 'evening', 'night',
+    'dawn', 'dusk', 'noon', 'midnight',
+    'spring', 'summer', 'autumn', 'winter',
+    'january', 'february', 'march', 'april', 'may', 'june',
+    'july', 'august', 'september', 'october', 'november', 'december'
+]
+
+# frequent words that aren't themes, on top of the nltk stopwords in stopwords.py
+CUSTOM_STOPWORDS = [
+    'thy', 'thou', 'thee', 'shall', 'unto', 'thine', 'yet', 'thee', 'would', 'upon',
+    'let', 'still', 'though', 'like', 'could', 'must', 'whose', 'thus', 'made', 'till', 'every', 'might', 'many',
+    'make', 'ever', 'hath', 'first', 'know', 'come', 'even', 'last', 'much'
+]
+
+# the charts show the top 50 theme words, the printed report the first 20 of them
+THEME_WORD_LIMIT = 50
+# the one poem longer than this is left out of the word diversity analysis
+MAX_DIVERSITY_LINE_COUNT = 5000
+
+_memo = {}
+_version = None
+_snapshot = None
+_approximate = False
+_disk_cache_warned = False
+
+
+def execute_query(query):
+    # streamed through a server-side cursor and downcast, see frames.execute_query
+    return frames.execute_query(query)
+
+
+# stopwords and custom words left out of the theme word ranking
+def excluded_words():
+    return stopwords.ENGLISH + CUSTOM_STOPWORDS
+
+
+# compute the datasets from a snapshot directory written by snapshot.py instead of the database
+# path=None goes back to the database
+def use_snapshot(path):
+    global _snapshot, _version
+    from snapshot import Snapshot
+
+    _snapshot = None if path is None else Snapshot(path)
+    _version = None
+
+
+# compute the word datasets from the streaming sketches instead of exact counts, see sketches.py
+# they come with an error column bounding how far each estimate can be off
+def use_approximate(enabled):
+    global _approximate
+    _approximate = enabled
+
+
+# a key that changes whenever authors, poems or lines are added, removed or changed in place
+# rows changed in place, e.g. by the legacy clean-up pass or a renamed author, move the counters of schema.py
+def dataset_version(refresh=False):
+    global _version
+    if _snapshot is not None:
+        # the version of the database the snapshot was exported from
+        return _snapshot.version
+    if _version is None or refresh:
+        with db.cursor() as cursor:
+            cursor.execute("""
+                SELECT (SELECT COUNT(*) FROM poems), (SELECT MAX(poem_id) FROM poems),
+                       (SELECT COUNT(*) FROM lines), (SELECT MAX(line_id) FROM lines)
+            """)
+            state = cursor.fetchone() + tuple(sorted(schema.data_versions(cursor).items()))
+        _version = hashlib.sha1(repr(state).encode("utf-8")).hexdigest()[:12]
+    return _version
+
+
+def load_poem_length_distribution():
+    return execute_query("""
+            SELECT
+                CASE
+                    WHEN line_count <= 4 THEN 'Very Short (1-4 lines)'
+                    WHEN line_count <= 14 THEN 'Short (5-14 lines)'
+                    WHEN line_count <= 30 THEN 'Medium (15-30 lines)'
+                    WHEN line_count <= 50 THEN 'Long (31-50 lines)'
+                    ELSE 'Very Long (50+ lines)'
+                END as length_category,
+                COUNT(*) as poem_count
+            FROM poems
+            GROUP BY length_category
+            ORDER BY poem_count DESC
+        """)
+
+
+# by number of poems and total lines
+def load_author_productivity():
+    return execute_query("""
+        SELECT a.author_name,
+               COUNT(DISTINCT p.poem_id) as poem_count,
+               SUM(p.line_count) as total_lines
+        FROM authors a
+        JOIN poems p ON a.author_id = p.author_id
+        GROUP BY a.author_name
+        ORDER BY poem_count DESC
+        LIMIT 10
+    """)
+
+
+# the word datasets run on whichever backend wordfreq picks, both give the same counts
+def load_time_references():
+    return wordfreq.word_frequency(TIME_WORDS)
+
+
+def load_theme_words():
+    return wordfreq.top_words(THEME_WORD_LIMIT, excluded_words())
+
+
+def load_word_diversity():
+    return wordfreq.word_diversity(MAX_DIVERSITY_LINE_COUNT)
+
+
+# the same datasets computed with pandas from a snapshot, no database needed
+def snapshot_poem_length_distribution():
+    line_counts = _snapshot.frame("poems")["line_count"]
+    categories = pd.cut(line_counts, bins=[-np.inf, 4, 14, 30, 50, np.inf], labels=[
+        'Very Short (1-4 lines)', 'Short (5-14 lines)', 'Medium (15-30 lines)', 'Long (31-50 lines)',
+        'Very Long (50+ lines)'
+    ]).astype(object).fillna('Very Long (50+ lines)')
+    counts = categories.value_counts()
+    return pd.DataFrame({"length_category": counts.index, "poem_count": counts.to_numpy()})
+
+
+def snapshot_author_productivity():
+    authors = _snapshot.frame("authors")
+    authors["author_name"] = authors["author_name"].astype(str)
+    poems = authors.merge(_snapshot.frame("poems"), on="author_id")
+    productivity = poems.groupby("author_name").agg(poem_count=("poem_id", "nunique"),
+                                                    total_lines=("line_count", "sum"))
+    return productivity.sort_values("poem_count", ascending=False).head(10).reset_index()
+
+
+def snapshot_time_references():
+    return _snapshot.word_frequencies().word_frequency(TIME_WORDS)
+
+
+def snapshot_theme_words():
+    return _snapshot.word_frequencies().top_words(THEME_WORD_LIMIT, excluded_words())
+
+
+def snapshot_word_diversity():
+    counts = _snapshot.word_frequencies().poem_counts()
+    unique_words = counts[counts["word"].str.len() > 2].groupby("poem_id").size().rename("unique_words")
+    poems = _snapshot.frame("poems")
+    poems = poems[poems["line_count"] < MAX_DIVERSITY_LINE_COUNT][["poem_id", "line_count"]]
+    return poems.join(unique_words, on="poem_id", how="inner").reset_index(drop=True)
+
+
+# the word datasets estimated from the sketches, the other datasets are cheap enough to stay exact
+def approximate_time_references():
+    return sketches.word_frequency(TIME_WORDS)
+
+
+def approximate_theme_words():
+    return sketches.top_words(THEME_WORD_LIMIT, excluded_words())
+
+
+def approximate_word_diversity():
+    return sketches.word_diversity(MAX_DIVERSITY_LINE_COUNT)
+
+
+LOADERS = {
+    POEM_LENGTHS: load_poem_length_distribution,
+    AUTHOR_PRODUCTIVITY: load_author_productivity,
+    TIME_REFERENCES: load_time_references,
+    THEME_WORDS: load_theme_words,
+    WORD_DIVERSITY: load_word_diversity,
+}
+
+SNAPSHOT_LOADERS = {
+    POEM_LENGTHS: snapshot_poem_length_distribution,
+    AUTHOR_PRODUCTIVITY: snapshot_author_productivity,
+    TIME_REFERENCES: snapshot_time_references,
+    THEME_WORDS: snapshot_theme_words,
+    WORD_DIVERSITY: snapshot_word_diversity,
+}
+
+APPROXIMATE_LOADERS = {
+    TIME_REFERENCES: approximate_time_references,
+    THEME_WORDS: approximate_theme_words,
+    WORD_DIVERSITY: approximate_word_diversity,
+}
+
+# settings a dataset depends on besides the data, part of its cache key
+PARAMETERS = {
+    TIME_REFERENCES: TIME_WORDS,
+    THEME_WORDS: (CUSTOM_STOPWORDS, THEME_WORD_LIMIT),
+    WORD_DIVERSITY: MAX_DIVERSITY_LINE_COUNT,
+}
+
+
+# a snapshot is always read exactly, approximate mode only changes the datasets it has estimates for
+def loader_for(name):
+    if _snapshot is not None:
+        return SNAPSHOT_LOADERS[name]
+    if _approximate and name in APPROXIMATE_LOADERS:
+        return APPROXIMATE_LOADERS[name]
+    return LOADERS[name]
+
+
+def cache_key(name):
+    parameters = hashlib.sha1(repr(PARAMETERS.get(name)).encode("utf-8")).hexdigest()[:8]
+    # estimates are cached apart from the exact datasets of the same version
+    if loader_for(name) is APPROXIMATE_LOADERS.get(name):
+        name = "approximate-" + name
+    return "%s-%s-%s" % (name, dataset_version(), parameters)
+
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, key + ".parquet")
+
+
+# get a dataset, computing it at most once per dataset version
+# results are memoized in-process and cached on disk so the other script can reuse them
+def load(name):
+    key = cache_key(name)
+    if key not in _memo:
+        path = cache_path(key)
+        try:
+            data = pd.read_parquet(path)
+        except (OSError, ImportError):
+            data = None
+        # a truncated or corrupt file is computed again rather than failing the run
+        except Exception as e:
+            print("Recomputing %s, its cached file can't be read: %s" % (name, e))
+            os.remove(path)
+            data = None
+        if data is None:
+            data = loader_for(name)()
+            save(data, path)
+        _memo[key] = data
+    # callers get their own copy so filtering one doesn't change the memoized frame
+    return _memo[key].copy()
+
+
+def save(data, path):
+    global _disk_cache_warned
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written next to its final name and moved there, so a run killed while writing leaves no partial file
+        data.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+    # without pyarrow/fastparquet the datasets are still memoized for this run
+    except ImportError as e:
+        if not _disk_cache_warned:
+            print("Not caching analytics datasets on disk: " + str(e))
+            _disk_cache_warned = True
+
+
+# drop every cached dataset, on disk and in-process
+def clear_cache():
+    global _version
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    _memo.clear()
+    _version = None
+
+
+# compute every dataset of the current version
+def load_all():
+    return {name: load(name) for name in LOADERS}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compute and cache the datasets shared by EDA.py and the charts")
+    parser.add_argument("--backend", choices=wordfreq.BACKENDS, default=wordfreq.BACKEND,
+                        help="where the word frequency datasets are counted")
+    parser.add_argument("--approximate", action="store_true",
+                        help="estimate the word datasets from the streaming sketches")
+    args = parser.parse_args()
+
+    wordfreq.BACKEND = args.backend
+    use_approximate(args.approximate)
+    for name, data in load_all().items():
+        print("%s: %d rows (%s)" % (name, len(data), cache_key(name)))
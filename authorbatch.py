@@ -0,0 +1,96 @@
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import db
+import getData
+import metrics
+from initialload import StagingWriter
+from loader import FLUSH_ROWS, MAX_BUFFER_BYTES, POEM_BATCH_SIZE, LineLoader, PoemWriter
+from neardup import NearDuplicateIndex
+
+# /author/<author> requests sent at once
+FETCH_WORKERS = 4
+# processes parsing and writing the responses, None uses one per CPU
+PROCESSES = None
+
+
+# a worker process only needs the database settings of the parent, it borrows one connection at a time
+def start_worker(db_params):
+    db.configure(minconn=1, maxconn=1, **db_params)
+
+
+# parse one author's response and write all of its poems, runs in a worker process
+# returns (author, poems in the response, the task's metrics report) so the parent can add up the counters
+def write_author(author, text, poem_batch_size=POEM_BATCH_SIZE, line_flush_rows=FLUSH_ROWS,
+                 line_buffer_bytes=MAX_BUFFER_BYTES, near_duplicates=True, initial_load=False):
+    task_metrics = metrics.reset()
+    with metrics.stage("parse"):
+        poems = getData.parse_poems(json.loads(text))
+    line_loader = LineLoader(flush_rows=line_flush_rows, max_bytes=line_buffer_bytes)
+    if initial_load:
+        poem_writer = StagingWriter(batch_size=poem_batch_size, flush_rows=line_flush_rows)
+    else:
+        duplicate_index = NearDuplicateIndex() if near_duplicates else None
+        poem_writer = PoemWriter(batch_size=poem_batch_size, line_loader=line_loader,
+                                 duplicate_index=duplicate_index)
+    for poem in poems:
+        with metrics.stage("clean"):
+            poem = getData.clean_poem(poem)
+        poem_writer.add(poem)
+    poem_writer.flush()
+    return author, len(poems), task_metrics.report()
+
+
+# base_url is passed on because getData.BASE_URL is only set by --base-url in the module run as a script
+def fetch_author(author, base_url=None):
+    with metrics.stage("fetch_author_poems"):
+        return getData.get_author_response(author, base_url)
+
+
+# fetch every author's poems with one request per author and write them from a process pool
+# responses are handed to the pool as they arrive, so parsing and writing overlap with the remaining requests
+# returns the number of poems received
+def ingest_authors(authors, base_url=None, fetch_workers=FETCH_WORKERS, processes=PROCESSES, **writer_options):
+    received = 0
+    # spawned rather than forked, the fetch threads are already running when a worker starts
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=start_worker,
+                             initargs=(dict(db.DB_PARAMS),)) as pool, \
+            ThreadPoolExecutor(max_workers=fetch_workers) as fetchers:
+        fetches = {fetchers.submit(fetch_author, author, base_url): author for author in authors}
+        writes = []
+        for future in as_completed(fetches):
+            author = fetches[future]
+            try:
+                text = future.result()
+            except Exception as e:
+                print("Failed to fetch poems by " + author + ": " + str(e))
+                text = None
+            if text is None:
+                metrics.count("authors_failed")
+                continue
+            writes.append(pool.submit(write_author, author, text, **writer_options))
+        for future in as_completed(writes):
+            try:
+                author, count, report = future.result()
+            except Exception as e:
+                print("Failed to write poems: " + str(e))
+                continue
+            received += count
+            metrics.get().merge(report)
+            metrics.count("titles_handled", count)
+    return received
+
+
+# print how many requests the author mode made and how many the per-title mode would have needed
+# the per-title mode asks for /author, /title and then every title once
+def report_requests(authors, poems, started):
+    elapsed = time.perf_counter() - started
+    requests = metrics.get().counters.get("http_requests", 0)
+    per_title = 2 + poems
+    print("Fetched %d poems of %d authors with %d requests in %.1fs" % (poems, len(authors), requests, elapsed))
+    if requests:
+        print("The per-title mode would have made about %d requests, %.0fx as many" % (per_title,
+                                                                                     per_title / requests))
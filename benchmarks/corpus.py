@@ -0,0 +1,147 @@
+import bisect
+import itertools
+import math
+import random
+from urllib.parse import unquote, urlsplit
+
+import stopwords
+from stub_server import StubPoetryDB, WORDS
+
+# poem lengths follow a log-normal like PoetryDB's: most poems are a sonnet or shorter, a few run to thousands
+# of lines
+MEDIAN_LINE_COUNT = 14
+LINE_COUNT_SIGMA = 1.0
+MAX_LINE_COUNT = 5000
+# words per line, roughly normal around a pentameter line
+WORDS_PER_LINE = 7
+WORDS_PER_LINE_SIGMA = 2.5
+# distinct words besides the stopwords, drawn by a Zipf law like natural text
+VOCABULARY_SIZE = 20000
+ZIPF_EXPONENT = 1.1
+# poems per author, a few authors write most of the poems like in PoetryDB
+POEMS_PER_AUTHOR = 25
+# share of lines and titles given the punctuation and numbering the cleaning functions remove
+DIRTY_SHARE = 0.1
+
+SYLLABLES = ["an", "bel", "cor", "da", "el", "fen", "gar", "hol", "is", "jun", "kel", "lo", "mar", "nor",
+             "or", "pel", "quin", "ros", "sel", "tor", "ul", "ven", "wil", "yar", "zel"]
+LINE_ENDINGS = [",", ";", ":", ".", "!", "?", " --", "...", "'"]
+
+
+# made-up words of two to four syllables, different for every index
+def make_word(index):
+    syllables = []
+    while True:
+        index, syllable = divmod(index, len(SYLLABLES))
+        syllables.append(SYLLABLES[syllable])
+        if not index:
+            break
+        index -= 1
+    return "".join(syllables + [SYLLABLES[len(syllables) % len(SYLLABLES)]])
+
+
+# cumulative Zipf weights of n ranks, for random.choices
+def zipf_weights(n, exponent=ZIPF_EXPONENT):
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+
+# a deterministic synthetic PoetryDB corpus of any size
+# poems are generated from their index on demand, so a million poems never have to be held in memory
+class SyntheticCorpus:
+    def __init__(self, count, seed=0, vocabulary_size=VOCABULARY_SIZE, dirty_share=DIRTY_SHARE):
+        self.count = count
+        self.seed = seed
+        self.dirty_share = dirty_share
+        # stopwords first so they are the most frequent words, like in real text
+        self.vocabulary = list(dict.fromkeys(stopwords.ENGLISH + WORDS +
+                                             [make_word(i) for i in range(vocabulary_size)]))
+        self.word_weights = zipf_weights(len(self.vocabulary))
+        authors = max(1, count // POEMS_PER_AUTHOR)
+        self.authors = ["%s %s" % (make_word(i * 7 + 3).title(), make_word(i * 13 + 5).title())
+                        for i in range(authors)]
+        self.author_weights = zipf_weights(authors, 1.0)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+    # a random generator seeded by the poem index, so every poem is the same however the corpus is read
+    def rng(self, index):
+        return random.Random("%d:%d" % (self.seed, index))
+
+    def author(self, index):
+        rng = self.rng(index)
+        return self.authors[bisect.bisect_left(self.author_weights, rng.random() * self.author_weights[-1])]
+
+    # titles are unique and none contains another, so a title search matches exactly one poem
+    # no characters a URL treats specially, titles are sent unquoted in the request path
+    def title(self, index):
+        rng = self.rng(-1 - index)
+        words = " ".join(rng.choices(WORDS, k=rng.randint(1, 4))).title()
+        title = "%s No. %07d" % (words, index)
+        if rng.random() < self.dirty_share:
+            title = rng.choice(["%d. " % rng.randint(1, 99) + title, title + " (draft)", '"%s"' % title,
+                                title + " -"])
+        return title
+
+    def line_count(self, rng):
+        count = math.exp(rng.gauss(math.log(MEDIAN_LINE_COUNT), LINE_COUNT_SIGMA))
+        return min(MAX_LINE_COUNT, max(1, int(round(count))))
+
+    def line(self, rng):
+        words = max(1, int(round(rng.gauss(WORDS_PER_LINE, WORDS_PER_LINE_SIGMA))))
+        line = " ".join(rng.choices(self.vocabulary, cum_weights=self.word_weights, k=words))
+        line = line[0].upper() + line[1:]
+        if rng.random() < self.dirty_share:
+            line = rng.choice(['"', "  ", "-- ", "'"]) + line + rng.choice(LINE_ENDINGS) + rng.choice(['"', "", "  "])
+        else:
+            line += rng.choice(LINE_ENDINGS[:4])
+        return line
+
+    # the poem as PoetryDB returns it
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        rng = self.rng(index)
+        lines = [self.line(rng) for _ in range(self.line_count(rng))]
+        return {
+            "title": self.title(index),
+            "author": self.author(index),
+            "lines": lines,
+            "linecount": str(len(lines)),
+        }
+
+    def titles(self):
+        return [self.title(index) for index in range(self.count)]
+
+
+# the stand-in PoetryDB server serving a synthetic corpus
+# poems are looked up by title in a dict instead of scanning every title, which the stub does to match
+# PoetryDB's substring search; the corpus titles never contain one another, so the answers are the same
+# author names are always matched exactly, as PoetryDB does for /author/<name>:abs
+class CorpusServer(StubPoetryDB):
+    def __init__(self, corpus, **options):
+        super().__init__([], **options)
+        self.corpus = corpus
+        self.title_index = {title: index for index, title in enumerate(corpus.titles())}
+        self.author_index = {}
+        for index in range(len(corpus)):
+            self.author_index.setdefault(corpus.author(index), []).append(index)
+
+    def respond(self, path):
+        with self.lock:
+            self.request_count += 1
+        parts = [unquote(part) for part in urlsplit(path).path.split("/", 2)[1:]]
+        if parts == ["author"]:
+            return 200, {"authors": sorted(set(self.corpus.authors))}
+        if parts == ["title"]:
+            return 200, {"titles": sorted(self.title_index)}
+        if len(parts) == 2 and parts[0] == "title" and parts[1] in self.title_index:
+            return 200, [self.corpus[self.title_index[parts[1]]]]
+        if len(parts) == 2 and parts[0] == "author":
+            author = parts[1][:-len(":abs")] if parts[1].endswith(":abs") else parts[1]
+            if author in self.author_index:
+                return 200, [self.corpus[index] for index in self.author_index[author]]
+        return 200, {"status": 404, "reason": "Not found"}
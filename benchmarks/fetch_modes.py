@@ -0,0 +1,49 @@
+import getData
+import httpcache
+from benchmarks.corpus import CorpusServer, SyntheticCorpus
+from benchmarks.suite import reset_database
+
+# seconds the stand-in server waits before every response, like a remote PoetryDB
+LATENCY = 0.05
+
+
+# load the same corpus per title and per author into the benchmark database, returns {mode: run report}
+def compare_modes(count=2000, latency=LATENCY, concurrency=8, processes=None):
+    corpus = SyntheticCorpus(count)
+    modes = {
+        "per title": {"concurrency": concurrency, "rate": 0},
+        "by author": {"concurrency": concurrency, "by_author": True, "processes": processes},
+    }
+    reports = {}
+    with CorpusServer(corpus, latency=latency) as server:
+        base_url = getData.BASE_URL
+        getData.BASE_URL = server.base_url
+        httpcache.configure(enabled=False)
+        try:
+            for mode, options in modes.items():
+                reset_database()
+                reports[mode] = getData.main(**options)
+        finally:
+            getData.BASE_URL = base_url
+
+    print("%-10s %10s %10s %10s" % ("mode", "requests", "seconds", "poems"))
+    for mode, report in reports.items():
+        print("%-10s %10d %9.1fs %10d" % (mode, report["counters"].get("http_requests", 0),
+                                          report["elapsed_seconds"], report["counters"].get("poems_inserted", 0)))
+    title, author = reports["per title"], reports["by author"]
+    print("by author: %.0fx fewer requests, %.1fx faster" % (
+        title["counters"].get("http_requests", 0) / max(author["counters"].get("http_requests", 0), 1),
+        title["elapsed_seconds"] / author["elapsed_seconds"]))
+    return reports
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare the per-title and per-author ingest on a synthetic corpus")
+    parser.add_argument("--poems", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="seconds the stand-in server waits per response")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests sent at once in both modes")
+    parser.add_argument("--processes", type=int, default=None, help="processes writing the per-author responses")
+    args = parser.parse_args()
+    compare_modes(args.poems, args.latency, args.concurrency, args.processes)
@@ -0,0 +1,90 @@
+import time
+
+import db
+import getData
+import initialload
+import metrics
+from benchmarks.corpus import SyntheticCorpus
+from benchmarks.suite import reset_database
+from loader import LineLoader, PoemWriter
+
+# poems PoetryDB serves, the scales below are multiples of it
+POETRYDB_POEMS = 3010
+SCALES = (10, 100)
+
+
+# seconds spent writing the corpus with writer, the poems are cleaned outside the timed calls
+# both paths get the same cleaned poems, so the difference is only how they reach the tables
+def write_corpus(corpus, writer):
+    seconds = 0.0
+    for poem in corpus:
+        poem = getData.clean_poem(poem)
+        started = time.perf_counter()
+        writer.add(poem)
+        seconds += time.perf_counter() - started
+    started = time.perf_counter()
+    writer.flush()
+    return seconds + time.perf_counter() - started
+
+
+# the current path: keyed and constrained tables, poems in batched INSERTs and their lines by COPY
+def load_rows(corpus):
+    reset_database()
+    started = time.perf_counter()
+    getData.insert_authors(corpus.authors)
+    seconds = time.perf_counter() - started
+    return seconds + write_corpus(corpus, PoemWriter(line_loader=LineLoader()))
+
+
+# the initial-load path: unlogged staging tables, then one set-wise build, the keys and the swap
+def load_initial(corpus):
+    reset_database()
+    started = time.perf_counter()
+    initialload.start_load()
+    initialload.stage_authors(corpus.authors)
+    seconds = time.perf_counter() - started
+    seconds += write_corpus(corpus, initialload.StagingWriter())
+    started = time.perf_counter()
+    initialload.finish_load()
+    return seconds + time.perf_counter() - started
+
+
+def table_counts():
+    with db.cursor() as cursor:
+        cursor.execute("SELECT (SELECT COUNT(*) FROM poems), (SELECT COUNT(*) FROM lines)")
+        return cursor.fetchone()
+
+
+# load a synthetic corpus of every scale both ways into the benchmark database, returns {scale: timings}
+def compare_loads(scales=SCALES, base=POETRYDB_POEMS):
+    results = {}
+    for scale in scales:
+        corpus = SyntheticCorpus(base * scale)
+        metrics.reset()
+        rows_seconds = load_rows(corpus)
+        rows_counts = table_counts()
+        metrics.reset()
+        initial_seconds = load_initial(corpus)
+        initial_counts = table_counts()
+        if rows_counts != initial_counts:
+            print("%dx: the two paths loaded different rows, %s vs %s" % (scale, rows_counts, initial_counts))
+        results[scale] = {"poems": initial_counts[0], "lines": initial_counts[1], "row_by_row": rows_seconds,
+                          "initial_load": initial_seconds, "stages": metrics.get().report()["stages"]}
+
+    print("%-6s %10s %10s %12s %14s %8s" % ("scale", "poems", "lines", "row by row", "initial load", "speedup"))
+    for scale, result in results.items():
+        print("%-6s %10d %10d %11.1fs %13.1fs %7.1fx" % (
+            "%dx" % scale, result["poems"], result["lines"], result["row_by_row"], result["initial_load"],
+            result["row_by_row"] / result["initial_load"]))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time the row-by-row ingest against --initial-load on synthetic "
+                                                 "corpora of multiples of PoetryDB's size")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES, help="multiples of PoetryDB's poems")
+    parser.add_argument("--base", type=int, default=POETRYDB_POEMS, help="poems of a 1x corpus")
+    args = parser.parse_args()
+    compare_loads(args.scales, args.base)
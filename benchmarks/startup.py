@@ -0,0 +1,62 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import cli
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# third-party modules whose import dominates startup
+HEAVY_MODULES = ["matplotlib.pyplot", "seaborn", "wordcloud", "squarify", "PIL.Image", "nltk", "pandas", "numpy",
+                 "requests", "psycopg2"]
+
+# run in a fresh interpreter: import what a subcommand needs and report the time and the heavy modules loaded
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import cli
+cli.import_command(sys.argv[1])
+seconds = time.perf_counter() - started
+print(json.dumps({"seconds": seconds, "loaded": [name for name in json.loads(sys.argv[2]) if name in sys.modules]}))
+"""
+
+
+# start a new interpreter `repeat` times for the subcommand, returns (process seconds, import seconds, modules)
+def measure(command, repeat=5):
+    process_seconds, import_seconds = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", PROBE, command, json.dumps(HEAVY_MODULES)], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        process_seconds.append(time.perf_counter() - started)
+        result = json.loads(output.splitlines()[-1])
+        import_seconds.append(result["seconds"])
+    return statistics.median(process_seconds), statistics.median(import_seconds), result["loaded"]
+
+
+# time a bare interpreter, the part of every start that no import change can remove
+def interpreter_seconds(repeat=5):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure the cold start of every cli.py subcommand")
+    parser.add_argument("commands", nargs="*", help="subcommands to measure, all by default")
+    parser.add_argument("--repeat", type=int, default=5, help="interpreter starts per subcommand, the median is shown")
+    args = parser.parse_args()
+
+    print("%-10s %10s %10s  %s" % ("command", "process", "imports", "heavy modules loaded"))
+    print("%-10s %9.3fs %10s" % ("(python)", interpreter_seconds(args.repeat), "-"))
+    for command in args.commands or cli.COMMANDS:
+        process, imports, loaded = measure(command, args.repeat)
+        print("%-10s %9.3fs %9.3fs  %s" % (command, process, imports, ", ".join(loaded) or "-"))
@@ -0,0 +1,283 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+import analytics
+import cleaning
+import db
+import getData
+import httpcache
+import loader
+import neardup
+import poemstore
+import schema
+import wordfreq
+from tokens import refresh_tokens
+from benchmarks.corpus import SyntheticCorpus, CorpusServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the suite drops and reloads everything in this database, never point it at the real one
+BENCH_DATABASE = os.environ.get("BENCH_DATABASE", "poetry_bench")
+INGEST_DATABASE = db.DB_PARAMS["dbname"]
+# poems in the synthetic corpus of each run
+SCALES = [10000]
+RESULTS_PATH = os.path.join(ROOT, "benchmarks", "results.json")
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+# a timing is a regression when it is this much slower than the baseline...
+TOLERANCE = 0.2
+# ...and slower by more than this many seconds, so noise in tiny timings isn't flagged
+MIN_DELTA = 0.05
+# timed runs of every EDA query and chart, the median is recorded
+REPEAT = 3
+# lines cleaned per call when timing the cleaning functions
+CLEANING_CHUNK = 20000
+
+
+# point the db module at an empty benchmark database, creating it if needed
+def reset_database(name=BENCH_DATABASE):
+    if name == INGEST_DATABASE:
+        raise ValueError("refusing to wipe the database the ingest uses: " + name)
+    params = dict(db.DB_PARAMS, dbname="postgres")
+    conn = psycopg2.connect(**params)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+            if cursor.fetchone() is None:
+                cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+    finally:
+        conn.close()
+    db.configure(dbname=name)
+    with db.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    schema.ensure_schema()
+    loader.forget_authors()
+    neardup.forget_index()
+    poemstore.forget_bodies()
+
+
+# median seconds of repeat calls, and the seconds of the first call
+def time_calls(function, repeat=REPEAT, before=None):
+    timings = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return timings[0], statistics.median(timings)
+
+
+# serve the corpus locally and load it with getData, returns the ingest's run report
+def bench_ingest(corpus, concurrency):
+    server = CorpusServer(corpus).start()
+    base_url = getData.BASE_URL
+    try:
+        getData.BASE_URL = server.base_url
+        httpcache.configure(enabled=False)
+        # rate=0 lifts the per-host request limit, which is there to be polite to the real server
+        return getData.main(concurrency=concurrency, rate=0)
+    finally:
+        getData.BASE_URL = base_url
+        server.stop()
+
+
+# clean every title and line of the corpus the way the ingest does, chunk by chunk
+def bench_cleaning(corpus):
+    results = {}
+    for name, clean, values in (
+            ("clean_titles", cleaning.clean_titles, lambda: [corpus.titles()]),
+            ("clean_lines", cleaning.clean_lines, lambda: chunked_lines(corpus))):
+        seconds = 0.0
+        count = 0
+        for chunk in values():
+            started = time.perf_counter()
+            clean(chunk, processes=1)
+            seconds += time.perf_counter() - started
+            count += len(chunk)
+        results[name] = {"seconds": seconds, "per_second": count / seconds if seconds else 0.0, "count": count}
+    return results
+
+
+def chunked_lines(corpus, size=CLEANING_CHUNK):
+    chunk = []
+    for poem in corpus:
+        chunk.extend(poem["lines"])
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# every EDA dataset computed from the database, bypassing the analytics caches
+# the cold run is the first query after the token tables are rebuilt and the in-process word counts dropped,
+# like after an ingest; the rebuild itself is timed by the ingest's refresh_tokens stage
+def bench_eda():
+    def forget():
+        refresh_tokens(rebuild=True)
+        wordfreq._frequencies = None
+
+    results = {}
+    for name, load_dataset in analytics.LOADERS.items():
+        cold, _ = time_calls(load_dataset, repeat=1, before=forget)
+        _, warm = time_calls(load_dataset)
+        results[name] = {"cold": cold, "warm": warm}
+    return results
+
+
+# draw every chart from its dataset in a scratch directory, the charts are written to the working directory
+def bench_charts():
+    import visualization
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix="bench-charts-")
+    cwd = os.getcwd()
+    try:
+        # the word cloud mask is read from the working directory
+        shutil.copy(os.path.join(ROOT, "img.WEBP"), directory)
+        os.chdir(directory)
+        for name, (dataset, _, _) in visualization.CHARTS.items():
+            data = analytics.LOADERS[dataset]()
+            first, median = time_calls(lambda: visualization.render_chart(name, data))
+            results[name] = {"first": first, "median": median}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+# run every benchmark on a synthetic corpus of count poems
+def run_scale(count, concurrency=8, charts=True, seed=0):
+    corpus = SyntheticCorpus(count, seed)
+    reset_database()
+    results = {"poems": count}
+    print("%d poems: ingest" % count)
+    results["ingest"] = bench_ingest(corpus, concurrency)
+    print("%d poems: cleaning" % count)
+    results["cleaning"] = bench_cleaning(corpus)
+    print("%d poems: EDA queries" % count)
+    results["eda"] = bench_eda()
+    if charts:
+        print("%d poems: charts" % count)
+        results["charts"] = bench_charts()
+    return results
+
+
+# the timings compared with the baseline, as {"<scale>/<name>": seconds}
+def flat_timings(results):
+    timings = {}
+    for scale, result in results["scales"].items():
+        prefix = scale + "/"
+        timings[prefix + "ingest"] = result["ingest"]["elapsed_seconds"]
+        for stage, stage_result in result["ingest"]["stages"].items():
+            timings[prefix + "ingest." + stage] = stage_result["seconds"]
+        for name, cleaning_result in result["cleaning"].items():
+            timings[prefix + name] = cleaning_result["seconds"]
+        for name, eda_result in result["eda"].items():
+            timings[prefix + "eda." + name] = eda_result["warm"]
+            timings[prefix + "eda." + name + ".cold"] = eda_result["cold"]
+        for name, chart_result in result.get("charts", {}).items():
+            timings[prefix + "chart." + name] = chart_result["median"]
+    return timings
+
+
+# timings slower than the baseline by more than the tolerance, as (name, baseline, current)
+def regressions(results, baseline, tolerance=TOLERANCE, min_delta=MIN_DELTA):
+    current = flat_timings(results)
+    before = flat_timings(baseline)
+    return [(name, before[name], seconds) for name, seconds in sorted(current.items())
+            if name in before and seconds > before[name] * (1 + tolerance) and seconds - before[name] > min_delta]
+
+
+def print_comparison(results, baseline):
+    current = flat_timings(results)
+    before = flat_timings(baseline) if baseline else {}
+    print("%-50s %10s %10s %8s" % ("timing", "baseline", "current", "change"))
+    for name, seconds in sorted(current.items()):
+        if name in before:
+            change = "%+7.0f%%" % ((seconds / before[name] - 1) * 100) if before[name] else "-"
+            print("%-50s %9.3fs %9.3fs %8s" % (name, before[name], seconds, change))
+        else:
+            print("%-50s %10s %9.3fs %8s" % (name, "-", seconds, "new"))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def write_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+# run the suite at every scale, write the results and compare them with the baseline
+# returns the regressions found, empty when there is no baseline yet
+def run(scales=None, concurrency=8, charts=True, output=RESULTS_PATH, baseline_path=BASELINE_PATH,
+        save_baseline=False, tolerance=TOLERANCE):
+    results = {
+        "created_at": time.time(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "scales": {},
+    }
+    for count in scales or SCALES:
+        results["scales"][str(count)] = run_scale(count, concurrency, charts)
+    write_results(results, output)
+    print("Results written to " + output)
+
+    baseline = load_results(baseline_path)
+    print_comparison(results, baseline)
+    found = regressions(results, baseline, tolerance) if baseline else []
+    for name, before, seconds in found:
+        print("REGRESSION %s: %.3fs -> %.3fs" % (name, before, seconds))
+    if baseline is None and not save_baseline:
+        print("No baseline at %s, run with --save-baseline to keep these results as one" % baseline_path)
+    if save_baseline:
+        write_results(results, baseline_path)
+        print("Baseline saved to " + baseline_path)
+    return found
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time ingest, cleaning, the EDA queries and the charts on "
+                                                 "synthetic corpora served by a local stand-in PoetryDB")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES,
+                        help="corpus sizes in poems, for example 10000 100000 1000000")
+    parser.add_argument("--concurrency", type=int, default=8, help="titles fetched in parallel by the ingest")
+    parser.add_argument("--no-charts", action="store_true", help="skip the chart rendering benchmarks")
+    parser.add_argument("--output", default=RESULTS_PATH, help="file the results are written to")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="keep these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="slowdown over the baseline flagged as a regression, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    found = run(args.scales, args.concurrency, not args.no_charts, args.output, args.baseline,
+                args.save_baseline, args.tolerance)
+    sys.exit(1 if found else 0)
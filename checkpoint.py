@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+import time
+
+# local file that remembers which titles an incremental ingest has already fetched and loaded
+CHECKPOINT_PATH = "ingest_checkpoint.sqlite"
+# titles handled between two checkpoint writes
+CHECKPOINT_EVERY = 200
+
+
+# titles of an ingest run and whether each one is still pending or done
+# a title is done once its response was fetched and, if it held a poem, that poem was committed
+class Checkpoint:
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        # the concurrent ingest writes from its writer thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS titles (
+                    title TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    updated_at REAL
+                )
+            """)
+
+    # number of titles recorded so far
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM titles").fetchone()[0]
+
+    # add titles as pending, titles already recorded keep their status
+    def add_titles(self, titles):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO titles (title, updated_at) VALUES (?, ?)",
+                                  [(title, now) for title in titles])
+
+    # mark titles as done
+    def mark_done(self, titles):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("""
+                INSERT INTO titles (title, status, updated_at) VALUES (?, 'done', ?)
+                ON CONFLICT (title) DO UPDATE SET status = 'done', updated_at = excluded.updated_at
+            """, [(title, now) for title in titles])
+
+    # titles still to fetch, in the order they were added
+    def remaining(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT title FROM titles WHERE status = 'pending' ORDER BY rowid").fetchall()
+        return [row[0] for row in rows]
+
+    # {status: count}
+    def summary(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM titles GROUP BY status").fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+# record fetched titles and mark them done each time the poems they produced are committed
+class CheckpointTracker:
+    def __init__(self, checkpoint, poem_writer, every=CHECKPOINT_EVERY):
+        self.checkpoint = checkpoint
+        self.poem_writer = poem_writer
+        self.every = every
+        self.handled = []
+
+    # note a title whose response was fetched, whether or not it produced a poem
+    def fetched(self, title):
+        self.handled.append(title)
+        if len(self.handled) >= self.every:
+            self.commit()
+
+    # flush the writer so every poem of the handled titles is in the database, then checkpoint them
+    def commit(self):
+        self.poem_writer.flush()
+        if self.handled:
+            self.checkpoint.mark_done(self.handled)
+            self.handled = []
@@ -0,0 +1,116 @@
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# batches smaller than this are cleaned in this process, a process pool isn't worth starting for them
+PARALLEL_THRESHOLD = 100000
+# strings sent to a worker process at a time
+CHUNK_SIZE = 20000
+
+# inputs and expected outputs recorded from the original regex-per-step functions
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden", "cleaning.json")
+
+# patterns are compiled once instead of on every call
+LEADING_NUMBER = re.compile(r'^\d+\.\s*')
+ENDING_PARENTHESIS = re.compile(r'\s*\([^()]*\)\s*$')
+ENDING_DASH = re.compile(r'\s*-\s*$')
+ENDING_SYMBOLS = re.compile(r'[^a-zA-Z0-9\s“‘”’]+$')
+# non-alphanumeric runs at either end of a line, whitespace included, so it also covers strip()
+LINE_EDGES = re.compile(r'^[^a-zA-Z0-9]+|[^a-zA-Z0-9]+$')
+
+
+# clean poem title
+def clean_title(title):
+    # remove extra spaces, then all double quotes
+    title = ' '.join(title.split()).replace('"', '')
+    # remove leading digits and dot
+    title = LEADING_NUMBER.sub('', title)
+    # remove leading and trailing quotes
+    title = title.strip('\'')
+    # remove ending parenthesis temporarily, will recover later
+    ending_parenthesis = ENDING_PARENTHESIS.search(title)
+    if ending_parenthesis:
+        ending = ending_parenthesis.group().strip()
+        title = title[:ending_parenthesis.start()].strip()
+    else:
+        ending = ''
+    # remove ending dash and spaces
+    title = ENDING_DASH.sub('', title)
+    # remove ending non-alphanumeric characters
+    title = ENDING_SYMBOLS.sub('', title)
+    # recover ending parenthesis
+    if ending:
+        title += ' ' + ending
+    return title
+
+
+# clean poem line content
+def clean_line(line_content):
+    # remove all double quotes, then non-alphanumeric characters at both ends of the line in one pass
+    return LINE_EDGES.sub('', line_content.replace('"', ''))
+
+
+def clean_chunk(clean, values):
+    return [clean(value) for value in values]
+
+
+# clean a list or pandas Series of strings, large batches are split across a process pool
+def clean_batch(clean, values, processes=None, threshold=PARALLEL_THRESHOLD, chunk_size=CHUNK_SIZE):
+    values = list(values)
+    if processes == 1 or len(values) < threshold:
+        return clean_chunk(clean, values)
+    chunks = [values[start:start + chunk_size] for start in range(0, len(values), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        cleaned = []
+        for part in pool.map(clean_chunk, [clean] * len(chunks), chunks):
+            cleaned.extend(part)
+    return cleaned
+
+
+# clean many titles, returns a list in input order
+def clean_titles(titles, processes=None, **options):
+    return clean_batch(clean_title, titles, processes, **options)
+
+
+# clean many lines, returns a list in input order
+def clean_lines(lines, processes=None, **options):
+    return clean_batch(clean_line, lines, processes, **options)
+
+
+# compare the engine with the golden outputs, returns a list of (kind, input, expected, got) mismatches
+def check_golden(path=GOLDEN_PATH):
+    with open(path, encoding="utf-8") as f:
+        golden = json.load(f)
+    mismatches = []
+    for kind, clean_many in (("titles", clean_titles), ("lines", clean_lines)):
+        inputs = [pair[0] for pair in golden[kind]]
+        expected = [pair[1] for pair in golden[kind]]
+        # run every case through the single-string path and the process pool path
+        single = clean_many(inputs, processes=1)
+        pooled = clean_many(inputs, processes=2, threshold=0, chunk_size=max(1, len(inputs) // 4))
+        for value, want, got_single, got_pooled in zip(inputs, expected, single, pooled):
+            for got in (got_single, got_pooled):
+                if got != want:
+                    mismatches.append((kind, value, want, got))
+    return mismatches
+
+
+if __name__ == '__main__':
+    mismatches = check_golden()
+    for kind, value, want, got in mismatches[:20]:
+        print("%s: %r -> expected %r, got %r" % (kind, value, want, got))
+    if mismatches:
+        raise SystemExit("%d golden cleaning mismatches" % len(mismatches))
+    print("Cleaning output matches the golden corpus")
+
+    # rough throughput on the golden lines repeated to a corpus-sized batch
+    with open(GOLDEN_PATH, encoding="utf-8") as f:
+        lines = [pair[0] for pair in json.load(f)["lines"]] * 170
+    for processes in (1, None):
+        started = time.perf_counter()
+        clean_lines(lines, processes=processes)
+        elapsed = time.perf_counter() - started
+        print("%d lines with processes=%s: %.2fs (%.0f lines/sec)" % (len(lines), processes, elapsed,
+                                                                      len(lines) / elapsed))
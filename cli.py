@@ -0,0 +1,31 @@
+import argparse
+import importlib
+
+# subcommand: (module that runs it, help)
+# a module is only imported when its subcommand runs, so `cli.py ingest` never loads matplotlib or pandas
+COMMANDS = {
+    "eda": ("EDA", "print the exploratory analysis of the poetry database"),
+    "render": ("visualization", "render the charts, or only the ones named"),
+    "ingest": ("getData", "load PoetryDB into PostgreSQL"),
+    "search": ("search", "search the lines of the stored poems"),
+    "duplicates": ("neardup", "list poems stored more than once, or re-cluster the whole corpus"),
+    "snapshot": ("snapshot", "export the corpus to Arrow files that eda and render can read without a database"),
+}
+
+
+def import_command(name):
+    return importlib.import_module(COMMANDS[name][0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Poetry data workflow")
+    subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+    for name, (module, description) in COMMANDS.items():
+        # the options of a subcommand, -h included, are parsed by its module
+        subparsers.add_parser(name, help=description, add_help=False)
+    args, rest = parser.parse_known_args(argv)
+    import_command(args.command).command_line(rest, prog="%s %s" % (parser.prog, args.command))
+
+
+if __name__ == '__main__':
+    main()
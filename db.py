@@ -0,0 +1,100 @@
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool
+
+import metrics
+
+# database connection parameters, the usual libpq environment variables override the defaults
+DB_PARAMS = {
+    'dbname': os.environ.get('PGDATABASE', 'poetry'),
+    'user': os.environ.get('PGUSER', ''),
+    'host': os.environ.get('PGHOST', 'localhost'),
+    'port': os.environ.get('PGPORT', '5432')
+}
+
+# number of connections kept open, and the most that can be borrowed at once
+POOL_MIN = 1
+POOL_MAX = 5
+
+_pool = None
+_pool_pid = None
+_slots = None
+_lock = threading.Lock()
+
+
+# change pool size or connection parameters, the current pool is closed and rebuilt on next use
+def configure(minconn=None, maxconn=None, **params):
+    global POOL_MIN, POOL_MAX
+    close_pool()
+    if minconn is not None:
+        POOL_MIN = minconn
+    if maxconn is not None:
+        POOL_MAX = maxconn
+    DB_PARAMS.update(params)
+
+
+# get the shared pool, creating it on first use
+def get_pool():
+    global _pool, _pool_pid, _slots
+    with _lock:
+        # connections can't be shared with a forked child, so every process builds its own pool
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadedConnectionPool(POOL_MIN, POOL_MAX, **DB_PARAMS)
+            _pool_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(POOL_MAX)
+        return _pool
+
+
+# close every pooled connection
+def close_pool():
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+atexit.register(close_pool)
+
+
+# borrow a connection from the pool, commit on success and roll back on error
+# blocks while all POOL_MAX connections are borrowed instead of failing
+@contextmanager
+def connection():
+    # time spent opening connections or waiting for a free one
+    with metrics.stage("db_connect"):
+        pool = get_pool()
+        slots = _slots
+        slots.acquire()
+        # a failed connect gives the slot back, otherwise POOL_MAX failures would leave every later borrow waiting
+        try:
+            conn = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+    try:
+        yield conn
+        conn.commit()
+        metrics.count("db_commits")
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+            metrics.count("db_rollbacks")
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+        slots.release()
+
+
+# borrow a connection and open a cursor on it, a name makes it a server-side cursor
+@contextmanager
+def cursor(name=None):
+    with connection() as conn:
+        cur = conn.cursor(name) if name else conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
@@ -0,0 +1,181 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+import getData
+import httpcache
+import metrics
+
+# default limits for the concurrent fetcher
+CONCURRENCY = 10
+REQUESTS_PER_SECOND = 20
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+TIMEOUT_SECONDS = 30
+
+
+# space out requests sent to the same host so we stay under a requests/sec limit
+# shared by the coroutines of fetch_poems and by the fetch threads of the ingest pipeline
+class HostRateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    # reserve the next free slot for this host, returns the seconds until it comes
+    def reserve(self, url):
+        if not self.rate:
+            return 0.0
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + 1.0 / self.rate
+        return slot - now
+
+    async def wait(self, url):
+        delay = self.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # the same for a thread
+    def wait_blocking(self, url):
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+
+# get json from url in a worker thread, retry non-200 responses with exponential backoff
+async def fetch_json(url, executor, limiter, retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+    loop = asyncio.get_running_loop()
+    status = None
+    for attempt in range(retries + 1):
+        await limiter.wait(url)
+        try:
+            res = await loop.run_in_executor(executor, lambda: httpcache.http_get(url, timeout=TIMEOUT_SECONDS))
+        except requests.RequestException as e:
+            status = e
+        else:
+            if res.status_code == 200:
+                return res.json()
+            status = res.status_code
+        if attempt < retries:
+            metrics.count("http_retries")
+            await asyncio.sleep(backoff * 2 ** attempt)
+    print("Failed to get " + url + ": " + str(status))
+    return None
+
+
+# the same as fetch_json for a thread
+def get_json(url, limiter, retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+    status = None
+    for attempt in range(retries + 1):
+        limiter.wait_blocking(url)
+        try:
+            res = httpcache.http_get(url, timeout=TIMEOUT_SECONDS)
+        except requests.RequestException as e:
+            status = e
+        else:
+            if res.status_code == 200:
+                return res.json()
+            status = res.status_code
+        if attempt < retries:
+            metrics.count("http_retries")
+            time.sleep(backoff * 2 ** attempt)
+    print("Failed to get " + url + ": " + str(status))
+    return None
+
+
+# fetch poems for all titles concurrently, yield (title, poem, fetched) in completion order
+# poem is None when the response is not a single valid poem, fetched is False when the request failed
+async def fetch_poems(titles, base_url=None, concurrency=CONCURRENCY, rate=REQUESTS_PER_SECOND,
+                      retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+    base_url = base_url or getData.BASE_URL
+    if httpcache.is_offline():
+        # a cache miss won't turn into a hit by waiting
+        retries = 0
+    limiter = HostRateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def fetch_one(title):
+        async with semaphore:
+            res_data = await fetch_json(base_url + "/title/" + title, executor, limiter, retries, backoff)
+        if res_data is None:
+            return title, None, False
+        return title, getData.parse_poem(res_data), True
+
+    tasks = [asyncio.ensure_future(fetch_one(title)) for title in titles]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # stop outstanding requests if the consumer gives up early
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False)
+
+
+# fetch titles concurrently and hand every result to write(title, poem, fetched) as soon as it arrives
+# write() runs on a single background thread so fetching continues while rows are inserted
+async def ingest_titles(titles, write, **options):
+    loop = asyncio.get_running_loop()
+    handled = 0
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        async for title, poem, fetched in fetch_poems(titles, **options):
+            handled += 1
+            await loop.run_in_executor(writer, write, title, poem, fetched)
+    return handled
+
+
+# compare serial and concurrent fetching of the same titles, without writing anything
+def compare_fetch_rates(titles, base_url=None, concurrency=CONCURRENCY, rate=REQUESTS_PER_SECOND):
+    base_url = base_url or getData.BASE_URL
+    previous_url = getData.BASE_URL
+    getData.BASE_URL = base_url
+    try:
+        started = time.perf_counter()
+        for title in titles:
+            getData.get_poem_by_title(title)
+        serial = time.perf_counter() - started
+    finally:
+        getData.BASE_URL = previous_url
+
+    async def drain():
+        async for _ in fetch_poems(titles, base_url=base_url, concurrency=concurrency, rate=rate):
+            pass
+
+    started = time.perf_counter()
+    asyncio.run(drain())
+    concurrent = time.perf_counter() - started
+
+    print("serial:     %.1f titles/sec" % (len(titles) / serial if serial else 0.0))
+    print("concurrent: %.1f titles/sec (concurrency=%d)" % (len(titles) / concurrent if concurrent else 0.0,
+                                                            concurrency))
+    return serial, concurrent
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare serial and concurrent PoetryDB title fetching")
+    parser.add_argument("--base-url", default=None, help="PoetryDB base URL, defaults to a local stand-in server")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND, help="maximum requests per second per host")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated latency of the stand-in server")
+    parser.add_argument("--titles", type=int, default=200, help="number of poems served by the stand-in server")
+    args = parser.parse_args()
+
+    if args.base_url:
+        titles = requests.get(args.base_url + "/title").json()["titles"]
+        compare_fetch_rates(titles, args.base_url, args.concurrency, args.rate)
+    else:
+        from stub_server import StubPoetryDB, make_poems
+
+        with StubPoetryDB(make_poems(args.titles), latency=args.latency) as server:
+            titles = requests.get(server.base_url + "/title").json()["titles"]
+            compare_fetch_rates(titles, server.base_url, args.concurrency, args.rate)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import db
+
+# rows per DataFrame chunk read from the server-side cursor
+CHUNK_ROWS = 50000
+# columns with few distinct values, stored as categories
+CATEGORY_COLUMNS = {"word", "word_lower", "author_name", "length_category"}
+
+INT32_MIN, INT32_MAX = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+
+
+# shrink a chunk: category for repeated strings, int32 for counts and ids that fit
+def downcast(frame, categories=CATEGORY_COLUMNS):
+    for column in frame.columns:
+        values = frame[column]
+        if column in categories:
+            # categories in order of appearance, so sorted results keep their order when plotted
+            frame[column] = pd.Categorical(values, categories=pd.unique(values.dropna()))
+        elif pd.api.types.is_integer_dtype(values) and len(values) and \
+                INT32_MIN <= values.min() and values.max() <= INT32_MAX:
+            frame[column] = values.astype(np.int32)
+    return frame
+
+
+# run a query on a server-side cursor and yield its result as DataFrames of at most chunk_rows rows
+# only one chunk of raw rows is held at a time, and the connection goes back to the pool even if the
+# caller stops early
+# connection runs the query inside that connection's open transaction instead of on one borrowed from the pool
+def query_chunks(query, params=None, chunk_rows=CHUNK_ROWS, categories=CATEGORY_COLUMNS, connection=None):
+    with (db.cursor("query_chunks") if connection is None else connection.cursor("query_chunks")) as cursor:
+        cursor.itersize = chunk_rows
+        cursor.execute(query, params)
+        first = True
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows and not first:
+                return
+            # a named cursor only knows its columns once rows were fetched
+            columns = [column[0] for column in cursor.description]
+            yield downcast(pd.DataFrame.from_records(rows, columns=columns), categories)
+            if len(rows) < chunk_rows:
+                return
+            first = False
+
+
+# one column of several chunks with a dtype every chunk fits, e.g. float64 for int32 in one chunk and NULLs
+# in another; a chunk where the column is all NULL comes out as object and doesn't get a say
+def concat_column(parts):
+    known = [part for part in parts if not part.isna().all()]
+    if known and len(known) < len(parts):
+        # concatenating empty slices finds the common dtype without copying any values
+        dtype = pd.concat([part.iloc[:0] for part in known]).dtype
+        if pd.api.types.is_bool_dtype(dtype):
+            dtype = object
+        elif pd.api.types.is_integer_dtype(dtype):
+            dtype = np.float64
+        parts = [part.astype(dtype) for part in parts]
+    return pd.concat(parts, ignore_index=True)
+
+
+# glue downcast chunks into one frame, categorical columns stay categorical
+# the other columns are downcast again once assembled, a chunk alone can't tell what fits the whole column
+def concat_chunks(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    columns = {}
+    for column in chunks[0].columns:
+        parts = [chunk[column] for chunk in chunks]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            columns[column] = union_categoricals(parts)
+        else:
+            columns[column] = concat_column(parts)
+    return downcast(pd.DataFrame(columns), categories=())
+
+
+# the whole result of a query as one downcast frame, assembled chunk by chunk so at most one chunk of rows
+# is ever held as Python objects, the peak is about twice the compact frame
+def execute_query(query, params=None, chunk_rows=CHUNK_ROWS, categories=CATEGORY_COLUMNS):
+    return concat_chunks(list(query_chunks(query, params, chunk_rows, categories)))
@@ -1,22 +1,33 @@
+import argparse
+import asyncio
 import json
-import psycopg2
-import requests
-import re
+import time
+from contextlib import nullcontext
+from psycopg2.extras import execute_values
+
+import db
+import metrics
+import initialload
+import neardup
+import schema
+from checkpoint import CHECKPOINT_EVERY, CHECKPOINT_PATH, Checkpoint, CheckpointTracker
+from cleaning import clean_line, clean_title
+import httpcache
+from httpcache import CACHE_MAX_BYTES, CACHE_PATH, CACHE_TTL_SECONDS, http_get
+from loader import FLUSH_ROWS, MAX_BUFFER_BYTES, POEM_BATCH_SIZE, LineLoader, PoemWriter, remember_authors
+from tokens import refresh_tokens
 
 # set the base URL
 BASE_URL = "https://poetrydb.org"
 
-# database connection parameters
-DB_PARAMS = {
-    'dbname': 'poetry',
-    'user': '',
-    'host': 'localhost',
-    'port': '5432'
-}
+# rows per UPDATE/DELETE batch in the legacy clean-up pass
+CLEANUP_BATCH_SIZE = 5000
+# functions listed by --profile
+PROFILE_TOP = 25
 
 # get authors from the API
 def get_authors():
-    res = requests.get(BASE_URL + "/author")
+    res = http_get(BASE_URL + "/author")
     if res.status_code == 200:
         res_data = res.json()["authors"]
         return res_data
@@ -26,7 +37,7 @@ def get_authors():
 
 # get poems' titles from the API
 def get_titles():
-    res = requests.get(BASE_URL + "/title")
+    res = http_get(BASE_URL + "/title")
     if res.status_code == 200:
         res_data = res.json()
         return res_data["titles"]
@@ -35,261 +46,503 @@ def get_titles():
 
 # get poem data by poem title
 def get_poem_by_title(title):
-    res = requests.get(BASE_URL + "/title/" + title)
+    res_data = get_title_response(title)
+    if res_data is None:
+        return None
+    return parse_poem(res_data)
+
+# get the raw /title/<title> response, None if the request failed
+def get_title_response(title):
+    res = http_get(BASE_URL + "/title/" + title)
     if res.status_code == 200:
-        res_data = res.json()
-        # check if poem data is a list with only one element, if not, return None
-        if isinstance(res_data, list) and len(res_data) == 1:
-            if "author" not in res_data[0] or "title" not in res_data[0] or "linecount" not in res_data[0]:
-                return None
-            else:
-                return res_data[0]
-        else:
-            return None
+        return res.json()
     else:
         print("Failed to get poem by title: " + str(res.status_code))
         return None
 
+# get the raw /author/<author> response, every poem of the author in one request, None if the request failed
+# the text is returned unparsed so it can be parsed in the process that writes the poems
+# :abs asks for the exact name, without it PoetryDB also returns the poems of every author whose name contains it
+def get_author_response(author, base_url=None):
+    res = http_get((base_url or BASE_URL) + "/author/" + author + ":abs")
+    if res.status_code == 200:
+        return res.text
+    else:
+        print("Failed to get poems by author: " + str(res.status_code))
+        return None
+
+# pick every valid poem out of a response, responses holding several poems keep all of them
+def parse_poems(res_data):
+    if not isinstance(res_data, list):
+        # a not found response
+        return []
+    return [poem for poem in res_data
+            if isinstance(poem, dict) and "author" in poem and "title" in poem and "linecount" in poem]
+
+# pick the poem out of a /title/<title> response
+def parse_poem(res_data):
+    # check if poem data is a list with only one element, if not, return None
+    if isinstance(res_data, list) and len(res_data) == 1:
+        if "author" not in res_data[0] or "title" not in res_data[0] or "linecount" not in res_data[0]:
+            return None
+        else:
+            return res_data[0]
+    else:
+        return None
+
 # insert authors into PostgreSQL
 def insert_authors(authors):
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-    for author in authors:
-        cursor.execute("""
-            INSERT INTO authors (author_name) VALUES (%s)
-            ON CONFLICT (author_name) DO NOTHING;
-        """, (author,))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with db.cursor() as cursor:
+        rows = execute_values(cursor, """
+            INSERT INTO authors (author_name) VALUES %s
+            ON CONFLICT (author_name) DO NOTHING
+            RETURNING author_id, author_name;
+        """, [(author,) for author in authors], fetch=True)
+    metrics.count("authors_inserted", len(rows))
+    metrics.count("authors_conflicts", len(authors) - len(rows))
+    # keep the cached author ids used by the batched poem writer up to date
+    remember_authors(rows)
 
 # insert poem into PostgreSQL
 def insert_poem(poem):
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
+    # check if poem data has required fields
+    if "author" not in poem or "title" not in poem or "linecount" not in poem:
+        print("Poem data missing required fields")
+        return None
 
     try:
-        # check if poem data has required fields
-        if "author" not in poem or "title" not in poem or "linecount" not in poem:
-            print("Poem data missing required fields")
-            return None
-
-        # get author, title, and linecount from poem data
-        author_name = poem["author"]
-        poem_title = poem["title"]
-        line_count = poem["linecount"]
-
-        # get author_id from authors table
-        cursor.execute("""
-            SELECT author_id FROM authors WHERE author_name = %s;
-        """, (author_name,))
-        author_id_result = cursor.fetchone()
-
-        if author_id_result is None:
-            print("Author not found: " + author_name)
-            # skip current poem if author not found
-            return None
+        # the transaction is committed when the cursor block ends, or rolled back if it raises
+        with db.cursor() as cursor:
+            # get author, title, and linecount from poem data
+            author_name = poem["author"]
+            poem_title = poem["title"]
+            line_count = poem["linecount"]
+
+            # get author_id from authors table
+            cursor.execute("""
+                SELECT author_id FROM authors WHERE author_name = %s;
+            """, (author_name,))
+            author_id_result = cursor.fetchone()
 
-        author_id = author_id_result[0]
+            if author_id_result is None:
+                print("Author not found: " + author_name)
+                # skip current poem if author not found
+                return None
 
-        # insert poem data into poems table
-        cursor.execute("""
-            INSERT INTO poems (author_id, poem_title, line_count) VALUES (%s, %s, %s)
-            ON CONFLICT (poem_title) DO NOTHING
-            RETURNING poem_id;
-        """, (author_id, poem_title, line_count))
-        poem_id_result = cursor.fetchone()
+            author_id = author_id_result[0]
 
-        if poem_id_result is None:
-            # print("Poem already exists: " + poem_title)
-            # skip current poem if failed to insert
-            return None
+            # insert poem data into poems table
+            cursor.execute("""
+                INSERT INTO poems (author_id, poem_title, line_count) VALUES (%s, %s, %s)
+                ON CONFLICT (author_id, poem_title) DO NOTHING
+                RETURNING poem_id;
+            """, (author_id, poem_title, line_count))
+            poem_id_result = cursor.fetchone()
+
+            if poem_id_result is None:
+                # print("Poem already exists: " + poem_title)
+                # skip current poem if failed to insert
+                return None
 
-        poem_id = poem_id_result[0]
-        conn.commit()
-        return poem_id
+            return poem_id_result[0]
 
     except Exception as e:
         # exception occurred while inserting repeated poem
         print("Failed to insert poem: " + str(e))
-        # rollback transaction if failed to insert
-        conn.rollback()
-
-    finally:
-        cursor.close()
-        conn.close()
 
 
 # insert lines into PostgreSQL
 def insert_lines(poem_id, lines):
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-
     if poem_id is None:
         return
 
     try:
-        # line_number starts from 1, increment by 1 for each line
-        for line_number, line_content in enumerate(lines, start=1):
-            cursor.execute("""
-                INSERT INTO lines (poem_id, line_number, line_content)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (line_id) DO NOTHING;
-            """, (poem_id, line_number, line_content))
-
-        conn.commit()
+        with db.cursor() as cursor:
+            # line_number starts from 1, increment by 1 for each line
+            for line_number, line_content in enumerate(lines, start=1):
+                cursor.execute("""
+                    INSERT INTO lines (poem_id, line_number, line_content)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (line_id) DO NOTHING;
+                """, (poem_id, line_number, line_content))
 
     # print exception if failed to insert lines, avoid inserting process being interrupted
     except Exception as e:
         print("Failed to insert lines: " + str(e))
-        conn.rollback()
-
-    finally:
-        cursor.close()
-        conn.close()
 
-# clean poem title
+# clean poem title, see cleaning.clean_title for the individual steps
 def clean_poem_title(title):
-    # remove extra spaces
-    title = ' '.join(title.split())
-    # Remove all double quotes
-    title = re.sub(r'"', '', title)
-    # remove leading digits and dot
-    title = re.sub(r'^\d+\.\s*', '', title)
-    # remove leading and trailing quotes
-    title = title.strip('"\'')
-    # remove ending parenthesis temporarily, will recover later
-    ending_parenthesis = re.search(r'\s*\([^()]*\)\s*$', title)
-    if ending_parenthesis:
-        title = title[:ending_parenthesis.start()].strip()
-        ending = ending_parenthesis.group().strip()
-    else:
-        ending = ''
-    # remove ending dash and spaces
-    title = re.sub(r'\s*-\s*$', '', title)
-    # remove ending non-alphanumeric characters
-    title = re.sub(r'[^a-zA-Z0-9\s“‘”’]+$', '', title)
-    # recover ending parenthesis
-    if ending:
-        title += ' ' + ending
-
-    return title
+    return clean_title(title)
 
 
 # update poem titles in database
-def update_poem_titles_in_db():
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-
+# new ingests clean titles before they are written, so this is only needed for legacy data
+def update_poem_titles_in_db(batch_size=CLEANUP_BATCH_SIZE):
     try:
-        # get all poems titles
-        cursor.execute("SELECT poem_id, poem_title FROM poems")
-        poems = cursor.fetchall()
-
-        # update poem titles
-        for poem_id, original_title in poems:
-            cleaned_title = clean_poem_title(original_title)
-            # update if cleaned title is different from original title
-            if cleaned_title != original_title:
-                cursor.execute("""
-                    UPDATE poems
-                    SET poem_title = %s
-                    WHERE poem_id = %s
-                """, (cleaned_title, poem_id))
-
-        conn.commit()
+        with db.connection() as conn:
+            # a named cursor streams the titles from the server instead of fetching the whole table
+            with conn.cursor("poem_titles") as reader, conn.cursor() as writer:
+                reader.itersize = batch_size
+                reader.execute("SELECT poem_id, poem_title FROM poems")
+
+                changed = []
+                for poem_id, original_title in reader:
+                    cleaned_title = clean_poem_title(original_title)
+                    # update if cleaned title is different from original title
+                    if cleaned_title != original_title:
+                        changed.append((poem_id, cleaned_title))
+                    if len(changed) >= batch_size:
+                        update_rows(writer, "poems", "poem_id", "poem_title", changed)
+                        changed = []
+                update_rows(writer, "poems", "poem_id", "poem_title", changed)
 
     except Exception as e:
         print("error in update_poem_titles_in_db" + str(e))
-        conn.rollback()
 
-    finally:
-        cursor.close()
-        conn.close()
-
-import re
 
-# clean poem line content
+# set one column for a batch of (id, value) rows with a single UPDATE ... FROM (VALUES ...)
+def update_rows(cursor, table, id_column, value_column, rows):
+    if not rows:
+        return
+    execute_values(cursor, """
+        UPDATE {table} AS t
+        SET {value_column} = v.value
+        FROM (VALUES %s) AS v(id, value)
+        WHERE t.{id_column} = v.id
+    """.format(table=table, id_column=id_column, value_column=value_column), rows, page_size=len(rows))
+
+# clean poem line content, see cleaning.clean_line for the individual steps
 def clean_poem_line_content(line_content):
-    # Remove all double quotes
-    line_content = re.sub(r'"', '', line_content)
-    # remove extra spaces at the beginning and end of the line
-    line_content = line_content.strip()
-    # remove non-alphanumeric characters at the beginning of the line
-    line_content = re.sub(r'^[^a-zA-Z0-9]*', '', line_content)
-    # remove non-alphanumeric characters at the end of the line
-    line_content = re.sub(r'[^a-zA-Z0-9]*$', '', line_content)
-
-    return line_content
+    return clean_line(line_content)
 
 
 # update poem lines in database
-def update_poem_lines_in_db():
-    conn = psycopg2.connect(**DB_PARAMS)
-    cursor = conn.cursor()
-
+# new ingests clean lines before they are written, so this is only needed for legacy data
+def update_poem_lines_in_db(batch_size=CLEANUP_BATCH_SIZE):
     try:
-        # get all lines
-        cursor.execute("SELECT line_id, line_content FROM lines")
-        lines = cursor.fetchall()
-
-        # update lines
-        for line_id, original_line_content in lines:
-            cleaned_line_content = clean_poem_line_content(original_line_content)
-            # update if cleaned title is different from original line content
-            if cleaned_line_content != original_line_content:
-                cursor.execute("""
-                    UPDATE lines
-                    SET line_content = %s
-                    WHERE line_id = %s
-                """, (cleaned_line_content, line_id))
-            # remove line if line content is empty
-            if not cleaned_line_content:
-                cursor.execute("""
-                    DELETE FROM lines
-                    WHERE line_id = %s
-                """, (line_id,))
-
-        conn.commit()
+        with db.connection() as conn:
+            # a named cursor streams the lines from the server instead of fetching the whole table
+            with conn.cursor("poem_lines") as reader, conn.cursor() as writer:
+                reader.itersize = batch_size
+                reader.execute("SELECT line_id, line_content FROM lines")
+
+                changed = []
+                empty = []
+                for line_id, original_line_content in reader:
+                    cleaned_line_content = clean_poem_line_content(original_line_content)
+                    # remove line if line content is empty
+                    if not cleaned_line_content:
+                        empty.append(line_id)
+                    # update if cleaned line is different from original line content
+                    elif cleaned_line_content != original_line_content:
+                        changed.append((line_id, cleaned_line_content))
+                    if len(changed) + len(empty) >= batch_size:
+                        update_rows(writer, "lines", "line_id", "line_content", changed)
+                        delete_lines(writer, empty)
+                        changed = []
+                        empty = []
+                update_rows(writer, "lines", "line_id", "line_content", changed)
+                delete_lines(writer, empty)
 
     except Exception as e:
-        print("error in update_poem_lines_in_db" + str(e) + str(line_id))
-        conn.rollback()
+        print("error in update_poem_lines_in_db" + str(e))
 
-    finally:
-        cursor.close()
-        conn.close()
+
+# delete a batch of lines by line_id
+def delete_lines(cursor, line_ids):
+    if line_ids:
+        cursor.execute("DELETE FROM lines WHERE line_id = ANY(%s)", (line_ids,))
+
+
+# clean a fetched poem before it is written
+# empty lines are dropped, the remaining lines keep their original line numbers
+def clean_poem(poem):
+    cleaned = dict(poem)
+    cleaned["title"] = clean_poem_title(poem["title"])
+    numbered_lines = []
+    for line_number, line_content in enumerate(poem["lines"], start=1):
+        line_content = clean_poem_line_content(line_content)
+        if line_content:
+            numbered_lines.append((line_number, line_content))
+    cleaned["numbered_lines"] = numbered_lines
+    return cleaned
+
+
+# titles whose cleaned form is already stored in the poems table
+def stored_titles(titles):
+    with db.cursor() as cursor:
+        cursor.execute("SELECT poem_title FROM poems")
+        stored = {row[0] for row in cursor}
+    return [title for title in titles if clean_poem_title(title) in stored]
+
+
+# print how many titles were processed per second
+def report_throughput(count, started):
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print("Processed %d titles in %.1fs (%.1f titles/sec)" % (count, elapsed, rate))
 
 
 # main function
-def main():
+# resume: keep track of loaded titles in a checkpoint file and only work on titles not loaded yet
+# diff: compare the current /title list with the checkpoint and the database, and fetch only new titles
+# report_path: write the run's timers and counters there as JSON, progress: keep a live progress line on stderr
+# pipeline: number of fetch threads of the fetch -> clean -> write pipeline, 0 keeps the other modes;
+# clean_workers and queue_size tune the pipeline, None keeps the pipeline module's defaults
+# by_author: fetch every author's poems in one request instead of one request per title, concurrency requests at
+# a time, and parse and write them in a pool of processes worker processes
+# near_duplicates: sign every new poem into the MinHash index of neardup and flag copies of earlier poems
+# initial_load: load into empty tables through unlogged staging tables, building keys and constraints once at the
+# end instead of maintaining them per row, see initialload.py
+def main(concurrency=0, rate=None, poem_batch_size=POEM_BATCH_SIZE, line_flush_rows=FLUSH_ROWS,
+         line_buffer_bytes=MAX_BUFFER_BYTES, legacy_cleanup=False, resume=False, diff=False,
+         checkpoint_path=CHECKPOINT_PATH, checkpoint_every=CHECKPOINT_EVERY, report_path=None, progress=False,
+         pipeline=0, clean_workers=None, queue_size=None, by_author=False, processes=None,
+         near_duplicates=True, initial_load=False):
+    run_metrics = metrics.reset()
+    # create the tables, or bring an existing schema up to date, before anything is written
+    schema.ensure_schema()
+    if initial_load:
+        if not initialload.target_empty():
+            print("An initial load needs empty authors, poems and lines tables, run without --initial-load")
+            return run_metrics.report()
+        initialload.start_load()
+    elif near_duplicates:
+        neardup.ensure_index()
+
     # step1: fetch and insert authors
-    authors = get_authors()
+    with metrics.stage("fetch_authors"):
+        authors = get_authors()
     # print(authors)
-    insert_authors(authors)
+    with metrics.stage("insert_authors"):
+        if initial_load:
+            initialload.stage_authors(authors)
+        else:
+            insert_authors(authors)
     print("Authors inserted successfully")
 
     # step2: fetch and insert poems
-    titles = get_titles()
-    # print(titles)
-    for title in titles:
-        poem_data = get_poem_by_title(title)
-        if poem_data is None:
-            continue
-        # insert poem data into PostgreSQL
-        poem = poem_data
-        # if poem data is invalid, skip current poem
-        if poem is None:
-            continue
-        poem_id = insert_poem(poem)
-        insert_lines(poem_id, poem["lines"])
-
+    if by_author:
+        import authorbatch
+        started = time.perf_counter()
+        with metrics.ProgressLine(run_metrics) if progress else nullcontext():
+            poems = authorbatch.ingest_authors(authors, base_url=BASE_URL,
+                                               fetch_workers=concurrency or authorbatch.FETCH_WORKERS,
+                                               processes=processes, poem_batch_size=poem_batch_size,
+                                               line_flush_rows=line_flush_rows, line_buffer_bytes=line_buffer_bytes,
+                                               near_duplicates=near_duplicates, initial_load=initial_load)
+        authorbatch.report_requests(authors, poems, started)
+        if initial_load:
+            complete_initial_load(near_duplicates, processes)
+        return finish(run_metrics, legacy_cleanup, report_path, rebuild_tokens=initial_load)
+
+    checkpoint = Checkpoint(checkpoint_path) if resume or diff else None
+    if checkpoint is None or diff or not len(checkpoint):
+        with metrics.stage("fetch_titles"):
+            titles = get_titles()
+        # print(titles)
+        if checkpoint is not None:
+            checkpoint.add_titles(titles)
+    if diff:
+        # titles loaded by runs that didn't keep a checkpoint
+        checkpoint.mark_done(stored_titles(checkpoint.remaining()))
+    if checkpoint is not None:
+        titles = checkpoint.remaining()
+        print("%d titles left to load (%s)" % (len(titles), checkpoint_path))
+    run_metrics.set("titles_total", len(titles))
+
+    started = time.perf_counter()
+    # poems are inserted in batches, their lines are bulk loaded with COPY in the same transaction
+    line_loader = LineLoader(flush_rows=line_flush_rows, max_bytes=line_buffer_bytes)
+    if initial_load:
+        # poems are staged as they come, they are deduplicated and indexed once after the last one
+        poem_writer = initialload.StagingWriter(batch_size=poem_batch_size, flush_rows=line_flush_rows)
+    else:
+        duplicate_index = neardup.NearDuplicateIndex() if near_duplicates else None
+        poem_writer = PoemWriter(batch_size=poem_batch_size, line_loader=line_loader,
+                                 duplicate_index=duplicate_index)
+    tracker = CheckpointTracker(checkpoint, poem_writer, checkpoint_every) if checkpoint is not None else None
+
+    # hand a cleaned poem to the batch writer
+    # fetched is False when the request failed, those titles stay pending in the checkpoint
+    def store(title, poem, fetched):
+        metrics.count("titles_handled")
+        if not fetched:
+            metrics.count("titles_failed")
+        if poem is not None:
+            poem_writer.add(poem)
+        if tracker is not None and fetched:
+            tracker.fetched(title)
+
+    # every poem is cleaned on its way to the writer: fetch -> clean -> batch write
+    def write(title, poem, fetched):
+        if poem is not None:
+            with metrics.stage("clean"):
+                poem = clean_poem(poem)
+        store(title, poem, fetched)
+
+    completed = True
+    with metrics.ProgressLine(run_metrics) if progress else nullcontext():
+        if pipeline:
+            # fetching, cleaning and writing run at once on their own threads, poems arrive cleaned
+            from pipeline import run_pipeline
+            options = {"clean_workers": clean_workers, "queue_size": queue_size, "rate": rate}
+            completed = run_pipeline(titles, store, base_url=BASE_URL, fetch_workers=pipeline,
+                                     **{key: value for key, value in options.items() if value is not None})
+        elif concurrency:
+            # fetch titles in parallel, poems are handed to the writer as soon as they arrive
+            import fetcher
+            options = {"base_url": BASE_URL, "concurrency": concurrency}
+            if rate is not None:
+                options["rate"] = rate
+            asyncio.run(fetcher.ingest_titles(titles, write, **options))
+        else:
+            for title in titles:
+                with metrics.stage("fetch_poems"):
+                    res_data = get_title_response(title)
+                # if poem data is invalid, parse_poem returns None and the title is skipped
+                poem = parse_poem(res_data) if res_data is not None else None
+                write(title, poem, res_data is not None)
+        if tracker is not None:
+            tracker.commit()
+        else:
+            poem_writer.flush()
+    if not completed:
+        # the handled titles are committed, with --resume the next run picks up the rest
+        handled = run_metrics.counters.get("titles_handled", 0)
+        report_throughput(handled, started)
+        print("Stopped after %d of %d titles" % (handled, len(titles)))
+        if initial_load:
+            print("The staged poems weren't loaded, the next --initial-load starts over")
+        if report_path:
+            run_metrics.write_report(report_path)
+        return run_metrics.report()
+    report_throughput(len(titles), started)
+    if initial_load:
+        complete_initial_load(near_duplicates, processes)
+    return finish(run_metrics, legacy_cleanup, report_path, rebuild_tokens=initial_load)
+
+
+# build the staged poems into the tables, then sign them all at once for the near-duplicate index
+def complete_initial_load(near_duplicates=True, processes=None):
+    if initialload.finish_load() and near_duplicates:
+        with metrics.stage("near_duplicates"):
+            neardup.recluster(processes)
+
+
+# the steps after the poems are stored: the legacy clean-up, the token refresh and the run report
+# rebuild_tokens recounts every line, needed when the tables were replaced by an initial load
+def finish(run_metrics, legacy_cleanup=False, report_path=None, rebuild_tokens=False):
     print("Poems inserted successfully")
-    update_poem_titles_in_db()
-    print("Poem titles updated successfully")
-    update_poem_lines_in_db()
-    print("Poem lines updated successfully")
+    if run_metrics.counters.get("poems_near_duplicates"):
+        print("%d poems flagged as near-duplicates of earlier poems, see neardup.py" %
+              run_metrics.counters["poems_near_duplicates"])
+
+    # rows loaded before cleaning moved into ingest still need the old clean-up pass
+    if legacy_cleanup:
+        with metrics.stage("legacy_cleanup"):
+            update_poem_titles_in_db()
+            print("Poem titles updated successfully")
+            update_poem_lines_in_db()
+            print("Poem lines updated successfully")
+            # imported here so an ingest without the clean-up pass doesn't load pandas
+            import analytics
+            analytics.clear_cache()
+
+    # tokenize the new lines for the EDA word counts, the clean-up pass rewrites lines so it needs a full rebuild
+    with metrics.stage("refresh_tokens"):
+        refresh_tokens(rebuild=legacy_cleanup or rebuild_tokens)
+    print("Word tokens updated successfully")
+
+    if report_path:
+        run_metrics.write_report(report_path)
+        print("Run report written to " + report_path)
+    return run_metrics.report()
+
+
+# parse the command line, configure the modules the options belong to and run the ingest
+def command_line(argv=None, prog=None):
+    global BASE_URL
+    parser = argparse.ArgumentParser(prog=prog, description="Load PoetryDB into PostgreSQL")
+    parser.add_argument("--base-url", default=BASE_URL, help="PoetryDB base URL")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="number of titles fetched in parallel, 0 keeps the serial loop")
+    parser.add_argument("--pipeline", type=int, default=0, metavar="FETCH_WORKERS",
+                        help="fetch, clean and write at once on their own threads, with this many fetch threads")
+    parser.add_argument("--clean-workers", type=int, default=None, help="cleaning threads of --pipeline")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="poems waiting between two --pipeline stages before the earlier stage waits")
+    parser.add_argument("--by-author", action="store_true",
+                        help="fetch each author's poems in one request, with --concurrency requests at a time, "
+                             "and keep responses holding several poems")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="processes parsing and writing the --by-author responses, one per CPU by default")
+    parser.add_argument("--no-near-duplicates", dest="near_duplicates", action="store_false",
+                        help="don't sign new poems into the near-duplicate index")
+    parser.add_argument("--initial-load", action="store_true",
+                        help="load into empty tables through unlogged staging tables and build the keys and "
+                             "constraints once at the end, much faster for a first load of a large corpus")
+    parser.add_argument("--rate", type=float, default=None, help="maximum requests per second per host")
+    parser.add_argument("--poem-batch-size", type=int, default=POEM_BATCH_SIZE,
+                        help="number of poems inserted per statement")
+    parser.add_argument("--line-flush-rows", type=int, default=FLUSH_ROWS,
+                        help="number of buffered lines written per COPY")
+    parser.add_argument("--line-buffer-mb", type=float, default=MAX_BUFFER_BYTES / 2 ** 20,
+                        help="memory ceiling of the line buffer in MB")
+    parser.add_argument("--legacy-cleanup", action="store_true",
+                        help="also clean titles and lines stored by earlier, uncleaned ingests")
+    parser.add_argument("--resume", action="store_true",
+                        help="record progress in a checkpoint file and skip titles already loaded")
+    parser.add_argument("--diff", action="store_true",
+                        help="fetch only titles that are not in the checkpoint file or the database yet")
+    parser.add_argument("--checkpoint-path", default=CHECKPOINT_PATH, help="checkpoint file used by --resume/--diff")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY,
+                        help="titles handled between checkpoint writes")
+    parser.add_argument("--no-cache", action="store_true", help="always fetch from the network")
+    parser.add_argument("--offline", action="store_true", help="only serve responses from the local cache")
+    parser.add_argument("--cache-path", default=CACHE_PATH, help="response cache file")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL_SECONDS,
+                        help="seconds a cached response is used before it is revalidated")
+    parser.add_argument("--cache-max-mb", type=float, default=CACHE_MAX_BYTES / 2 ** 20,
+                        help="size of the response cache before least recently used entries are evicted")
+    parser.add_argument("--pool-min", type=int, default=db.POOL_MIN, help="database connections kept open")
+    parser.add_argument("--pool-max", type=int, default=db.POOL_MAX, help="most database connections used at once")
+    parser.add_argument("--report", dest="report_path", help="write the run's timers and counters to this JSON file")
+    parser.add_argument("--progress", action="store_true", help="show a live progress line on stderr")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile and print the hottest functions; only the main thread is profiled, "
+                             "so use the serial loop (--concurrency 0) to see fetching and writing")
+    args = vars(parser.parse_args(argv))
+    if args["by_author"] and (args["resume"] or args["diff"] or args["pipeline"]):
+        parser.error("--by-author can't be combined with --resume, --diff or --pipeline")
+    if args["initial_load"] and (args["resume"] or args["diff"] or args["legacy_cleanup"]):
+        parser.error("--initial-load loads everything into empty tables, it can't be combined with --resume, "
+                     "--diff or --legacy-cleanup")
+    BASE_URL = args.pop("base_url")
+    db.configure(minconn=args.pop("pool_min"), maxconn=args.pop("pool_max"))
+    httpcache.configure(enabled=not args.pop("no_cache"), offline=args.pop("offline"), path=args.pop("cache_path"),
+                        ttl=args.pop("cache_ttl"), max_bytes=int(args.pop("cache_max_mb") * 2 ** 20))
+    args["line_buffer_bytes"] = int(args.pop("line_buffer_mb") * 2 ** 20)
+    if args.pop("profile"):
+        profile(main, **args)
+    else:
+        main(**args)
+
+
+# run function under cProfile and print the functions that took the most time
+def profile(function, *args, **kwargs):
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        stats = pstats.Stats(profiler)
+        stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+
 
 
 if __name__ == '__main__':
-    main()
+    command_line()
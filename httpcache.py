@@ -0,0 +1,186 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+import metrics
+
+# persistent cache of PoetryDB responses, keyed by URL
+CACHE_PATH = "poetrydb_cache.sqlite"
+# responses younger than this are served without asking the server
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+# least recently used responses are evicted once the bodies take more than this
+CACHE_MAX_BYTES = 256 * 2 ** 20
+
+# status returned for a URL that isn't cached while offline
+OFFLINE_MISS_STATUS = 504
+
+
+# GET url over the network, timed into the HTTP latency histogram
+def network_get(url, headers=None, timeout=None):
+    started = time.perf_counter()
+    try:
+        res = requests.get(url, headers=headers, timeout=timeout)
+    except requests.RequestException:
+        metrics.count("http_errors")
+        raise
+    finally:
+        metrics.observe_http(time.perf_counter() - started)
+        metrics.count("http_requests")
+    if res.status_code not in (200, 304):
+        metrics.count("http_errors")
+    return res
+
+
+# the part of requests.Response the fetch functions use, for responses served from the cache
+class CachedResponse:
+    def __init__(self, status_code, content, from_cache=False):
+        self.status_code = status_code
+        self.content = content
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+# SQLite-backed response cache with ETag/Last-Modified revalidation, a TTL and LRU eviction
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # offline mode only serves cached responses, a miss gets OFFLINE_MISS_STATUS
+        self.offline = offline
+        # the concurrent fetcher calls get() from many threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def lookup(self, url):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT body, etag, last_modified, fetched_at FROM responses WHERE url = ?",
+                                    (url,)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url))
+        return row
+
+    def store(self, url, res):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO responses (url, body, etag, last_modified, fetched_at, accessed_at, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (url, res.content, res.headers.get("ETag"), res.headers.get("Last-Modified"), now, now,
+                  len(res.content)))
+            self.evict()
+
+    # a 304 answer means the cached body is still current, so it is fresh for another TTL
+    def revalidated(self, url):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE responses SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+    # drop the least recently used responses until the cache fits in max_bytes, caller holds the lock
+    def evict(self):
+        self.conn.execute("""
+            DELETE FROM responses WHERE url IN (
+                SELECT url FROM (
+                    SELECT url, SUM(size) OVER (ORDER BY accessed_at DESC, url) AS kept_bytes FROM responses
+                ) WHERE kept_bytes > ?
+            )
+        """, (self.max_bytes,))
+
+    # get url through the cache
+    def get(self, url, timeout=None):
+        row = self.lookup(url)
+        if row is not None:
+            body, etag, last_modified, fetched_at = row
+            if self.offline or time.time() - fetched_at < self.ttl:
+                metrics.count("http_cache_hits")
+                return CachedResponse(200, body, from_cache=True)
+        elif self.offline:
+            metrics.count("http_offline_misses")
+            return CachedResponse(OFFLINE_MISS_STATUS, b"", from_cache=True)
+
+        headers = {}
+        if row is not None:
+            # the cached copy expired, ask the server whether it changed
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        res = network_get(url, headers=headers, timeout=timeout)
+        if res.status_code == 304 and row is not None:
+            metrics.count("http_not_modified")
+            self.revalidated(url)
+            return CachedResponse(200, body, from_cache=True)
+        # only successful responses are cached, errors are retried on the next run
+        if res.status_code == 200:
+            self.store(url, res)
+        return res
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+    def close(self):
+        self.conn.close()
+
+
+_cache = None
+_cache_pid = None
+_settings = {"path": CACHE_PATH, "ttl": CACHE_TTL_SECONDS, "max_bytes": CACHE_MAX_BYTES, "offline": False}
+_enabled = True
+_lock = threading.Lock()
+
+
+# change cache settings, enabled=False sends every request straight to the network
+def configure(enabled=None, **settings):
+    global _cache, _enabled
+    with _lock:
+        if enabled is not None:
+            _enabled = enabled
+        _settings.update((key, value) for key, value in settings.items() if value is not None)
+        if _cache is not None and _cache_pid == os.getpid():
+            _cache.close()
+        _cache = None
+
+
+def is_offline():
+    return _enabled and _settings["offline"]
+
+
+# get the shared cache, opening it on first use
+def get_cache():
+    global _cache, _cache_pid
+    with _lock:
+        # a SQLite connection can't be shared with a forked child, so every process opens its own
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = ResponseCache(**_settings)
+            _cache_pid = os.getpid()
+        return _cache
+
+
+# GET url through the shared response cache
+def http_get(url, timeout=None):
+    if not _enabled:
+        return network_get(url, timeout=timeout)
+    return get_cache().get(url, timeout=timeout)
@@ -0,0 +1,202 @@
+import csv
+import io
+import time
+
+import db
+import metrics
+import poemstore
+import schema
+from loader import FLUSH_ROWS, POEM_BATCH_SIZE
+
+# the copy of the schema the load is built in before it is swapped in
+SUFFIX = "_new"
+
+# fetched rows go into unlogged tables without any index or constraint: nothing is written twice to the WAL and
+# nothing is checked per row, the checks run once over the whole load in build()
+# load_id ties lines to their poem until poems get their ids, it also orders the poems as they arrived
+STAGING_SQL = """
+    DROP TABLE IF EXISTS load_authors, load_poems, load_lines, load_kept;
+    DROP SEQUENCE IF EXISTS load_poem_ids;
+    CREATE UNLOGGED TABLE load_authors (
+        author_name TEXT
+    );
+    CREATE UNLOGGED TABLE load_poems (
+        load_id BIGINT,
+        author_name TEXT,
+        poem_title TEXT,
+        line_count TEXT
+    );
+    CREATE UNLOGGED TABLE load_lines (
+        load_id BIGINT,
+        line_number INT,
+        line_content TEXT
+    );
+    CREATE SEQUENCE load_poem_ids;
+"""
+
+
+# true when authors, poems and lines hold no rows, the only state an initial load starts from
+def target_empty():
+    schema.ensure_schema()
+    with db.cursor() as cursor:
+        cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM authors) AND NOT EXISTS (SELECT 1 FROM poems) "
+                       "AND NOT EXISTS (SELECT 1 FROM lines)")
+        return cursor.fetchone()[0]
+
+
+# create empty staging tables, dropping the leftovers of an earlier load
+def start_load():
+    with db.cursor() as cursor:
+        cursor.execute(STAGING_SQL)
+
+
+def copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    # strings are quoted so an empty line is loaded as '' rather than NULL
+    csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert("COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)".format(
+        table=table, columns=", ".join(columns)), buffer)
+
+
+def stage_authors(authors):
+    with db.cursor() as cursor:
+        copy_rows(cursor, "load_authors", ["author_name"], [(author,) for author in authors])
+    metrics.count("authors_staged", len(authors))
+
+
+# buffer poems and COPY them with their lines into the staging tables, a stand-in for loader.PoemWriter
+# nothing is deduplicated or checked here, build() does that for the whole load at once
+class StagingWriter:
+    def __init__(self, batch_size=POEM_BATCH_SIZE, flush_rows=FLUSH_ROWS):
+        self.batch_size = batch_size
+        self.flush_rows = flush_rows
+        self.pending = []
+        self.pending_lines = 0
+        self.inserted = 0
+
+    def add(self, poem):
+        # check if poem data has required fields
+        if "author" not in poem or "title" not in poem or "linecount" not in poem:
+            print("Poem data missing required fields")
+            return {}
+        self.pending.append(poem)
+        self.pending_lines += len(poem.get("numbered_lines", poem.get("lines", [])))
+        if len(self.pending) >= self.batch_size or self.pending_lines >= self.flush_rows:
+            self.flush()
+        return {}
+
+    def flush(self):
+        if not self.pending:
+            return {}
+        pending = self.pending
+        self.pending = []
+        self.pending_lines = 0
+        with db.cursor() as cursor, metrics.stage("stage_poems"):
+            # ids come from a sequence, so writers in several processes never hand out the same one
+            cursor.execute("SELECT nextval('load_poem_ids') FROM generate_series(1, %s)", (len(pending),))
+            load_ids = [row[0] for row in cursor.fetchall()]
+            poems = []
+            lines = []
+            for load_id, poem in zip(load_ids, pending):
+                poems.append((load_id, poem["author"], poem["title"], str(poem["linecount"])))
+                # cleaned poems carry (line_number, line_content) pairs, raw ones a list of lines
+                numbered_lines = poem.get("numbered_lines")
+                if numbered_lines is None:
+                    numbered_lines = enumerate(poem.get("lines", []), start=1)
+                lines.extend((load_id, line_number, line_content) for line_number, line_content in numbered_lines)
+            copy_rows(cursor, "load_poems", ["load_id", "author_name", "poem_title", "line_count"], poems)
+            copy_rows(cursor, "load_lines", ["load_id", "line_number", "line_content"], lines)
+        metrics.count("poems_staged", len(poems))
+        metrics.count("lines_staged", len(lines))
+        self.inserted += len(poems)
+        return {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+
+# fill the suffixed copy of the schema from the staging tables, deduplicating and validating set-wise
+# the same rules as the row-by-row path: an author is stored once, a poem whose author isn't known or whose line
+# count isn't a number is skipped, and the first poem of an author and title to arrive wins
+def build(suffix=SUFFIX):
+    with db.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS " + ", ".join(table + suffix for table in reversed(schema.TABLES)))
+        cursor.execute(schema.tables_sql(suffix))
+        cursor.execute("""
+            INSERT INTO authors{suffix} (author_name)
+            SELECT DISTINCT author_name FROM load_authors WHERE author_name IS NOT NULL ORDER BY author_name
+        """.format(suffix=suffix))
+        metrics.count("authors_inserted", cursor.rowcount)
+
+        cursor.execute("""
+            CREATE UNLOGGED TABLE load_kept AS
+            SELECT ROW_NUMBER() OVER (ORDER BY p.load_id)::INT AS poem_id, p.load_id, a.author_id, p.poem_title,
+                   p.line_count::INT AS line_count
+            FROM (
+                SELECT DISTINCT ON (author_name, poem_title) load_id, author_name, poem_title, line_count
+                FROM load_poems
+                WHERE poem_title IS NOT NULL AND line_count ~ '^[0-9]{{1,9}}$'
+                ORDER BY author_name, poem_title, load_id
+            ) p
+            JOIN authors{suffix} a ON a.author_name = p.author_name
+        """.format(suffix=suffix))
+        kept = cursor.rowcount
+        cursor.execute("SELECT COUNT(*) FROM load_poems")
+        staged = cursor.fetchone()[0]
+        metrics.count("poems_inserted", kept)
+        metrics.count("poems_conflicts", staged - kept)
+
+        cursor.execute("""
+            INSERT INTO poems{suffix} (poem_id, author_id, poem_title, line_count)
+            SELECT poem_id, author_id, poem_title, line_count FROM load_kept
+        """.format(suffix=suffix))
+        cursor.execute("SELECT setval(pg_get_serial_sequence('poems{suffix}', 'poem_id'), GREATEST(%s, 1), %s)"
+                       .format(suffix=suffix), (kept, kept > 0))
+        # lines of skipped poems go with them, which is what the foreign key would have enforced
+        cursor.execute("""
+            INSERT INTO lines{suffix} (poem_id, line_number, line_content)
+            SELECT k.poem_id, l.line_number, l.line_content
+            FROM load_lines l
+            JOIN load_kept k ON k.load_id = l.load_id
+            WHERE l.line_number IS NOT NULL AND l.line_content IS NOT NULL
+        """.format(suffix=suffix))
+        metrics.count("lines_inserted", cursor.rowcount)
+        cursor.execute("ANALYZE " + ", ".join(table + suffix for table in schema.TABLES))
+
+
+# replace the empty tables with the loaded copy in one transaction, readers see either no poems or all of them
+# returns False, leaving the tables as they are, if rows were written to them while the load ran
+def swap(suffix=SUFFIX):
+    with db.cursor() as cursor:
+        cursor.execute("LOCK TABLE " + ", ".join(schema.TABLES) + " IN ACCESS EXCLUSIVE MODE")
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM authors) OR EXISTS (SELECT 1 FROM poems) "
+                       "OR EXISTS (SELECT 1 FROM lines)")
+        if cursor.fetchone()[0]:
+            print("The tables were written to during the initial load, the loaded copy is left in *" + suffix)
+            return False
+        # triggers and indexes other modules added to lines go with the empty tables, those modules recreate them
+        # the next time they are used
+        cursor.execute("DROP TABLE " + ", ".join(reversed(schema.TABLES)) + " CASCADE")
+        schema.rename_schema(cursor, suffix)
+        schema.ensure_data_versions(cursor)
+        cursor.execute("DROP TABLE load_authors, load_poems, load_lines, load_kept")
+        cursor.execute("DROP SEQUENCE load_poem_ids")
+    poemstore.forget_bodies()
+    return True
+
+
+# turn the staged rows into the final tables: validate and deduplicate, build the keys in parallel, swap them in
+def finish_load(workers=schema.KEY_WORKERS):
+    started = time.perf_counter()
+    with metrics.stage("build_tables"):
+        build()
+    with metrics.stage("build_keys"):
+        schema.build_keys(SUFFIX, workers)
+    with metrics.stage("swap_tables"):
+        swapped = swap()
+    print("Built and swapped in the loaded tables in %.1fs" % (time.perf_counter() - started))
+    return swapped
@@ -0,0 +1,281 @@
+import csv
+import io
+
+from psycopg2.extras import execute_values
+
+import db
+import metrics
+
+# number of poems inserted per multi-row INSERT
+POEM_BATCH_SIZE = 200
+# flush buffered lines once either limit is reached
+FLUSH_ROWS = 50000
+MAX_BUFFER_BYTES = 32 * 1024 * 1024
+# rough per-row cost of the tuple and its two integers, on top of the line text
+ROW_OVERHEAD_BYTES = 100
+
+
+# author_name -> author_id, read from the authors table once per process
+_author_ids = None
+
+
+# get the author name to id map, loading it on first use
+def get_author_ids(cursor=None):
+    global _author_ids
+    if _author_ids is None:
+        if cursor is None:
+            with db.cursor() as cursor:
+                return get_author_ids(cursor)
+        cursor.execute("SELECT author_name, author_id FROM authors")
+        _author_ids = dict(cursor.fetchall())
+    return _author_ids
+
+
+# add (author_id, author_name) rows of newly inserted authors to the cache
+def remember_authors(rows):
+    if _author_ids is not None:
+        _author_ids.update((author_name, author_id) for author_id, author_name in rows)
+
+
+# drop the cached map, needed when the authors table was emptied or recreated
+def forget_authors():
+    global _author_ids
+    _author_ids = None
+
+
+# look up author ids for names, only querying names the cache doesn't know yet
+def lookup_author_ids(cursor, author_names):
+    author_ids = get_author_ids(cursor)
+    missing = [name for name in author_names if name not in author_ids]
+    if missing:
+        # authors inserted by another process since the cache was loaded
+        cursor.execute("SELECT author_id, author_name FROM authors WHERE author_name = ANY(%s)", (missing,))
+        remember_authors(cursor.fetchall())
+    return author_ids
+
+
+# copy rows into a per-connection staging table, then move them into lines in one statement
+def copy_lines(cursor, rows):
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS lines_staging (
+            poem_id INT,
+            line_number INT,
+            line_content TEXT
+        ) ON COMMIT DELETE ROWS;
+        TRUNCATE lines_staging;
+    """)
+    buffer = io.StringIO()
+    # strings are quoted so an empty line is loaded as '' rather than NULL
+    csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert("COPY lines_staging (poem_id, line_number, line_content) FROM STDIN WITH (FORMAT csv)",
+                       buffer)
+    cursor.execute("""
+        INSERT INTO lines (poem_id, line_number, line_content)
+        SELECT poem_id, line_number, line_content FROM lines_staging
+        ON CONFLICT (line_id) DO NOTHING;
+    """)
+    return cursor.rowcount
+
+
+# buffer (poem_id, line_number, line_content) rows across many poems and bulk load them with COPY
+class LineLoader:
+    def __init__(self, flush_rows=FLUSH_ROWS, max_bytes=MAX_BUFFER_BYTES):
+        self.flush_rows = flush_rows
+        self.max_bytes = max_bytes
+        # list of (poem_id, rows) so a failed flush can be retried poem by poem
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.loaded = 0
+
+    # queue the lines of one poem, line_number starts from 1
+    def add(self, poem_id, lines, cursor=None):
+        self.add_numbered(poem_id, enumerate(lines, start=1), cursor)
+
+    # queue (line_number, line_content) pairs of one poem
+    # when cursor is given, an automatic flush runs in the caller's transaction
+    def add_numbered(self, poem_id, numbered_lines, cursor=None):
+        if poem_id is None:
+            return
+        rows = [(poem_id, line_number, line_content) for line_number, line_content in numbered_lines]
+        self.pending.append((poem_id, rows))
+        self.pending_rows += len(rows)
+        self.pending_bytes += sum(len(row[2]) for row in rows) + ROW_OVERHEAD_BYTES * len(rows)
+        if self.pending_rows >= self.flush_rows or self.pending_bytes >= self.max_bytes:
+            self.flush(cursor)
+
+    # write everything buffered, returns the number of rows inserted
+    # without a cursor the rows are committed on a pooled connection
+    def flush(self, cursor=None):
+        if not self.pending:
+            return 0
+        pending = self.pending
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        if cursor is None:
+            with db.cursor() as cursor:
+                written = self.write(cursor, pending)
+        else:
+            written = self.write(cursor, pending)
+        self.loaded += written
+        return written
+
+    def write(self, cursor, pending):
+        with metrics.stage("copy_lines"):
+            written, attempted = self.write_rows(cursor, pending)
+        metrics.count("lines_inserted", written)
+        # rows that were already stored
+        metrics.count("lines_conflicts", attempted - written)
+        return written
+
+    # returns (rows inserted, rows that didn't fail)
+    def write_rows(self, cursor, pending):
+        rows_count = sum(len(rows) for _, rows in pending)
+        cursor.execute("SAVEPOINT line_loader")
+        try:
+            written = copy_lines(cursor, [row for _, rows in pending for row in rows])
+            cursor.execute("RELEASE SAVEPOINT line_loader")
+            return written, rows_count
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT line_loader")
+
+        # the batch failed, retry poem by poem and skip the poems that still fail
+        written = 0
+        for poem_id, rows in pending:
+            cursor.execute("SAVEPOINT line_loader")
+            try:
+                written += copy_lines(cursor, rows)
+                cursor.execute("RELEASE SAVEPOINT line_loader")
+            # print exception if failed to insert lines, avoid inserting process being interrupted
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT line_loader")
+                print("Failed to insert lines: " + str(e))
+                metrics.count("lines_failed", len(rows))
+                rows_count -= len(rows)
+        return written, rows_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+
+# buffer poems and insert them in multi-row batches, together with their lines
+class PoemWriter:
+    def __init__(self, batch_size=POEM_BATCH_SIZE, line_loader=None, duplicate_index=None):
+        self.batch_size = batch_size
+        # lines of inserted poems are queued here and flushed in the same transaction as the poems
+        self.line_loader = line_loader
+        # a neardup.NearDuplicateIndex the inserted poems are signed into and checked against
+        self.duplicate_index = duplicate_index
+        self.pending = []
+        self.inserted = 0
+
+    # queue one poem, returns the (author_id, title) -> poem_id map of a batch if this add flushed one
+    def add(self, poem):
+        # check if poem data has required fields
+        if "author" not in poem or "title" not in poem or "linecount" not in poem:
+            print("Poem data missing required fields")
+            return {}
+        self.pending.append(poem)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return {}
+
+    # insert the buffered poems and their lines in one transaction
+    # returns (author_id, title) -> poem_id for the poems that were inserted, poems already in the table are skipped
+    def flush(self):
+        if not self.pending:
+            return {}
+        pending = self.pending
+        self.pending = []
+        with db.cursor() as cursor:
+            with metrics.stage("insert_poems"):
+                poem_ids = self.write(cursor, pending)
+            if self.line_loader is not None or self.duplicate_index is not None:
+                author_ids = get_author_ids(cursor)
+                stored = []
+                seen = set()
+                for poem in pending:
+                    # when a poem repeats in the batch only its first copy was inserted
+                    poem_id = poem_ids.get((author_ids.get(poem["author"]), poem["title"]))
+                    if poem_id is not None and poem_id not in seen:
+                        seen.add(poem_id)
+                        # cleaned poems carry (line_number, line_content) pairs, raw ones a list of lines
+                        numbered_lines = poem.get("numbered_lines")
+                        if numbered_lines is None:
+                            numbered_lines = list(enumerate(poem.get("lines", []), start=1))
+                        stored.append((poem_id, numbered_lines))
+                if self.line_loader is not None:
+                    for poem_id, numbered_lines in stored:
+                        self.line_loader.add_numbered(poem_id, numbered_lines, cursor)
+                    self.line_loader.flush(cursor)
+                if self.duplicate_index is not None:
+                    self.duplicate_index.add(cursor, [(poem_id, [line for _, line in numbered_lines])
+                                                      for poem_id, numbered_lines in stored])
+        self.inserted += len(poem_ids)
+        return poem_ids
+
+    def write(self, cursor, pending):
+        author_ids = lookup_author_ids(cursor, {poem["author"] for poem in pending})
+        rows = []
+        for poem in pending:
+            author_id = author_ids.get(poem["author"])
+            if author_id is None:
+                # skip current poem if author not found
+                print("Author not found: " + poem["author"])
+                metrics.count("poems_author_missing")
+                continue
+            rows.append((author_id, poem["title"], poem["linecount"]))
+        if not rows:
+            return {}
+        poem_ids, attempted = self.write_rows(cursor, rows)
+        metrics.count("poems_inserted", len(poem_ids))
+        # poems that were already stored, or repeated within the batch
+        metrics.count("poems_conflicts", attempted - len(poem_ids))
+        return poem_ids
+
+    # returns ((author_id, title) -> poem_id of the inserted poems, rows that didn't fail)
+    def write_rows(self, cursor, rows):
+        cursor.execute("SAVEPOINT poem_writer")
+        try:
+            poem_ids = insert_poem_rows(cursor, rows)
+            cursor.execute("RELEASE SAVEPOINT poem_writer")
+            return poem_ids, len(rows)
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT poem_writer")
+
+        # the batch failed, retry poem by poem and skip the poems that still fail
+        poem_ids = {}
+        attempted = len(rows)
+        for row in rows:
+            cursor.execute("SAVEPOINT poem_writer")
+            try:
+                poem_ids.update(insert_poem_rows(cursor, [row]))
+                cursor.execute("RELEASE SAVEPOINT poem_writer")
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT poem_writer")
+                print("Failed to insert poem: " + str(e))
+                metrics.count("poems_failed")
+                attempted -= 1
+        return poem_ids, attempted
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+
+# insert (author_id, poem_title, line_count) rows in one statement
+# returns (author_id, poem_title) -> poem_id of new poems, poems are keyed by author and title
+def insert_poem_rows(cursor, rows):
+    result = execute_values(cursor, """
+        INSERT INTO poems (author_id, poem_title, line_count) VALUES %s
+        ON CONFLICT (author_id, poem_title) DO NOTHING
+        RETURNING poem_id, author_id, poem_title;
+    """, rows, page_size=len(rows), fetch=True)
+    return {(author_id, poem_title): poem_id for poem_id, author_id, poem_title in result}
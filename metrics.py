@@ -0,0 +1,190 @@
+import bisect
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the HTTP latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# seconds between two refreshes of the live progress line
+PROGRESS_INTERVAL = 1.0
+# counters turned into rows/sec in the report
+RATE_COUNTERS = ["authors_inserted", "poems_inserted", "lines_inserted", "titles_handled"]
+
+
+# counts of observed values per bucket, percentiles are read off the bucket bounds
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # one count per bound plus one for values above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    # upper bound of the bucket holding the given fraction of the values
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        labels = ["<=%gs" % bound for bound in self.bounds] + [">%gs" % self.bounds[-1]]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+# stage timers, counters and the HTTP latency histogram of one ingest run, safe to update from any thread
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.values = {}
+        self.http_latency = Histogram()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # a value that is set rather than added up, like the number of titles to load
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    # add the time spent in the block to a stage, stages running on several threads add up
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                seconds, calls = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (seconds + elapsed, calls + 1)
+
+    # add the counters and stage timers of a report made in another process
+    def merge(self, report):
+        with self.lock:
+            for name, value in report["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, stage in report["stages"].items():
+                seconds, calls = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (seconds + stage["seconds"], calls + stage["calls"])
+
+    def observe_http(self, seconds):
+        with self.lock:
+            self.http_latency.observe(seconds)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def report(self):
+        with self.lock:
+            elapsed = self.elapsed()
+            return {
+                "elapsed_seconds": elapsed,
+                # seconds are summed over threads, so concurrent stages can add up to more than elapsed_seconds
+                "stages": {name: {"seconds": seconds, "calls": calls}
+                           for name, (seconds, calls) in sorted(self.stages.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "values": dict(self.values),
+                "rows_per_second": {name: self.counters.get(name, 0) / elapsed if elapsed else 0.0
+                                    for name in RATE_COUNTERS},
+                "http_latency": self.http_latency.to_dict(),
+            }
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    # one line summing up the run so far
+    def progress_line(self):
+        with self.lock:
+            counters = dict(self.counters)
+            total = self.values.get("titles_total")
+            elapsed = self.elapsed()
+            p50 = self.http_latency.percentile(0.5)
+        handled = counters.get("titles_handled", 0)
+        return "%s titles, %d poems, %d lines, %.0f lines/s, http p50 %.0fms, %d retries, %.0fs" % (
+            "%d/%d" % (handled, total) if total else str(handled), counters.get("poems_inserted", 0),
+            counters.get("lines_inserted", 0), counters.get("lines_inserted", 0) / elapsed if elapsed else 0.0,
+            p50 * 1000, counters.get("http_retries", 0), elapsed)
+
+
+# rewrite the progress line on stderr every interval until stopped
+class ProgressLine:
+    def __init__(self, metrics, interval=PROGRESS_INTERVAL, stream=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.stream.write("\r\033[K" + self.metrics.progress_line())
+            self.stream.flush()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.stream.write("\r\033[K" + self.metrics.progress_line() + "\n")
+        self.stream.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+# the metrics of the current run, shared by every module that reports into it
+_current = Metrics()
+
+
+def get():
+    return _current
+
+
+# start a new run, returns its metrics
+def reset():
+    global _current
+    _current = Metrics()
+    return _current
+
+
+def count(name, n=1):
+    _current.count(name, n)
+
+
+def stage(name):
+    return _current.stage(name)
+
+
+def observe_http(seconds):
+    _current.observe_http(seconds)
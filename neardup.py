@@ -0,0 +1,381 @@
+import argparse
+import csv
+import io
+import multiprocessing
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from psycopg2 import Binary
+from psycopg2.extras import execute_values
+
+import db
+import metrics
+import schema
+
+# a signature is BANDS x ROWS MinHash values; two poems become candidates when all ROWS values of any band
+# match, which happens for about (1 / BANDS) ** (1 / ROWS) ~ 0.6 Jaccard similarity and up
+BANDS = 20
+ROWS = 6
+NUM_PERM = BANDS * ROWS
+# candidates whose signatures agree on at least this share of values are flagged as near-duplicates
+SIMILARITY_THRESHOLD = 0.8
+# poems are compared as sets of overlapping word n-grams of their cleaned, lower-cased lines
+SHINGLE_WORDS = 3
+# shingles hashed against every permutation at a time, bounds the memory of very long poems
+SHINGLE_BLOCK = 4096
+# poems a recluster worker reads per round trip
+RECLUSTER_FETCH = 500
+
+# the seed of each MinHash permutation, the same in every process
+SEEDS = np.random.RandomState(1).randint(0, 2 ** 63, size=NUM_PERM, dtype=np.int64).astype(np.uint64)
+
+NEAR_DUPLICATE_SQL = """
+    CREATE TABLE IF NOT EXISTS poem_signatures (
+        poem_id INT PRIMARY KEY,
+        signature BYTEA NOT NULL
+    );
+    -- the LSH index: one row per poem and band, poems sharing a (band, bucket) are candidates
+    CREATE TABLE IF NOT EXISTS poem_lsh_buckets (
+        band SMALLINT NOT NULL,
+        bucket BIGINT NOT NULL,
+        poem_id INT NOT NULL,
+        PRIMARY KEY (band, bucket, poem_id)
+    );
+    -- poems flagged as near-duplicates of an earlier poem, duplicate_of is the first poem of their cluster
+    CREATE TABLE IF NOT EXISTS poem_duplicates (
+        poem_id INT PRIMARY KEY,
+        duplicate_of INT NOT NULL,
+        similarity REAL NOT NULL
+    );
+"""
+
+_ready = False
+
+
+# create the index tables if that wasn't done yet
+# the schema is brought up to date first, it moves poems from the title key to the (author_id, poem_title) key
+def ensure_index():
+    global _ready
+    if _ready:
+        return
+    schema.ensure_schema()
+    with db.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('ensure_near_duplicate_index'))")
+        cursor.execute(NEAR_DUPLICATE_SQL)
+    _ready = True
+
+
+# check the tables again on next use, needed when the schema was dropped and recreated
+def forget_index():
+    global _ready
+    _ready = False
+
+
+# splitmix64 finalizer, spreads every input bit over the whole 64-bit value
+def mix(values):
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+# hashes of the word n-grams of a poem, a poem shorter than one n-gram is a single shingle
+# crc32 rather than pandas' hashing keeps pandas out of the ingest, mix() widens it to 64 bits
+def shingles(lines):
+    words = " ".join(lines).lower().split()
+    if len(words) <= SHINGLE_WORDS:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+    return mix(np.unique(np.array([zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint64)))
+
+
+# MinHash signature of a poem's lines as NUM_PERM uint32 values, None for a poem without words
+def signature(lines):
+    hashes = shingles(lines)
+    if not len(hashes):
+        return None
+    minimum = np.full(NUM_PERM, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(hashes), SHINGLE_BLOCK):
+        block = hashes[start:start + SHINGLE_BLOCK, None] ^ SEEDS[None, :]
+        np.minimum(minimum, mix(block).min(axis=0), out=minimum)
+    return (minimum >> np.uint64(32)).astype(np.uint32)
+
+
+# the bucket of every band of each signature, one row per signature
+def band_buckets(signatures):
+    signatures = np.atleast_2d(signatures).astype(np.uint64)
+    buckets = np.empty((len(signatures), BANDS), dtype=np.uint64)
+    for band in range(BANDS):
+        bucket = np.full(len(signatures), band, dtype=np.uint64)
+        for column in range(band * ROWS, (band + 1) * ROWS):
+            bucket = mix(bucket ^ signatures[:, column])
+        buckets[:, band] = bucket
+    return buckets.view(np.int64)
+
+
+# estimated Jaccard similarity of paired signatures, the share of values they agree on
+def similarity(first, second):
+    return (np.atleast_2d(first) == np.atleast_2d(second)).mean(axis=1)
+
+
+def signature_from_bytes(data):
+    return np.frombuffer(data, dtype=np.uint32)
+
+
+# signatures and LSH buckets of new poems, kept up to date by the ingest
+# add() runs in the writer's transaction, so a poem is indexed and flagged together with its lines
+# poems written by another process at the same moment can't see each other until they commit,
+# recluster() catches what that misses
+class NearDuplicateIndex:
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        # here rather than in add(), which runs while the writer holds a connection: a worker process has only one
+        ensure_index()
+        self.threshold = threshold
+        self.flagged = 0
+
+    # index (poem_id, lines) pairs and flag the ones close to an earlier poem
+    # returns {poem_id: (duplicate_of, similarity)} of the poems flagged
+    def add(self, cursor, poems):
+        with metrics.stage("near_duplicates"):
+            signed = [(poem_id, signature(lines)) for poem_id, lines in poems]
+            signed = [(poem_id, values) for poem_id, values in signed if values is not None]
+            if not signed:
+                return {}
+            poem_ids = [poem_id for poem_id, _ in signed]
+            signatures = np.stack([values for _, values in signed])
+            buckets = band_buckets(signatures)
+            self.store(cursor, poem_ids, signatures, buckets)
+            flags = self.flag(cursor, poem_ids, signatures, buckets)
+        self.flagged += len(flags)
+        metrics.count("poems_near_duplicates", len(flags))
+        return flags
+
+    def store(self, cursor, poem_ids, signatures, buckets):
+        execute_values(cursor, """
+            INSERT INTO poem_signatures (poem_id, signature) VALUES %s
+            ON CONFLICT (poem_id) DO UPDATE SET signature = EXCLUDED.signature
+        """, [(poem_id, Binary(values.tobytes())) for poem_id, values in zip(poem_ids, signatures)],
+                       page_size=1000)
+        execute_values(cursor, """
+            INSERT INTO poem_lsh_buckets (band, bucket, poem_id) VALUES %s ON CONFLICT DO NOTHING
+        """, [(band, int(bucket), poem_id) for poem_id, row in zip(poem_ids, buckets)
+              for band, bucket in enumerate(row)], page_size=10000)
+
+    # look the new poems up in the index, only earlier poems (those of this batch included) count
+    def flag(self, cursor, poem_ids, signatures, buckets):
+        count = len(poem_ids)
+        cursor.execute("""
+            SELECT DISTINCT q.poem_id, b.poem_id
+            FROM UNNEST(%s::int[], %s::smallint[], %s::bigint[]) AS q(poem_id, band, bucket)
+            JOIN poem_lsh_buckets b ON b.band = q.band AND b.bucket = q.bucket
+            WHERE b.poem_id < q.poem_id
+        """, (np.repeat(poem_ids, BANDS).tolist(), np.tile(np.arange(BANDS), count).tolist(),
+              buckets.ravel().tolist()))
+        candidates = cursor.fetchall()
+        if not candidates:
+            return {}
+
+        cursor.execute("""
+            SELECT s.poem_id, s.signature, d.duplicate_of
+            FROM poem_signatures s
+            LEFT JOIN poem_duplicates d ON d.poem_id = s.poem_id
+            WHERE s.poem_id = ANY(%s)
+        """, (sorted({candidate for _, candidate in candidates}),))
+        earlier = {poem_id: (signature_from_bytes(data), duplicate_of)
+                   for poem_id, data, duplicate_of in cursor.fetchall()}
+        rows = {poem_id: i for i, poem_id in enumerate(poem_ids)}
+
+        flags = {}
+        # in poem_id order, so a poem matching one flagged earlier in this batch points at the same first poem
+        for poem_id, candidate in sorted(candidates):
+            if candidate not in earlier:
+                continue
+            values, duplicate_of = earlier[candidate]
+            score = float(similarity(signatures[rows[poem_id]], values)[0])
+            if score < self.threshold or score <= flags.get(poem_id, (None, -1.0))[1]:
+                continue
+            first = flags[candidate][0] if candidate in flags else (duplicate_of or candidate)
+            flags[poem_id] = (first, score)
+        if flags:
+            execute_values(cursor, """
+                INSERT INTO poem_duplicates (poem_id, duplicate_of, similarity) VALUES %s
+                ON CONFLICT (poem_id) DO UPDATE SET duplicate_of = EXCLUDED.duplicate_of,
+                    similarity = EXCLUDED.similarity
+            """, [(poem_id, first, score) for poem_id, (first, score) in flags.items()])
+        return flags
+
+
+# a recluster worker only needs the database settings of the parent
+def start_worker(db_params):
+    db.configure(minconn=1, maxconn=1, **db_params)
+
+
+# compute and store the signatures of the poems with low <= poem_id < high, runs in a worker process
+# returns the number of poems signed
+def sign_range(low, high):
+    signed = 0
+    with db.connection() as conn:
+        with conn.cursor("poem_signature_scan") as reader, conn.cursor() as writer:
+            reader.itersize = RECLUSTER_FETCH
+            reader.execute("SELECT poem_id, lines FROM poem_bodies WHERE poem_id >= %s AND poem_id < %s",
+                           (low, high))
+            rows = []
+            for poem_id, lines in reader:
+                values = signature(lines)
+                if values is not None:
+                    rows.append((poem_id, Binary(values.tobytes())))
+                if len(rows) >= RECLUSTER_FETCH:
+                    write_signatures(writer, rows)
+                    signed += len(rows)
+                    rows = []
+            write_signatures(writer, rows)
+            signed += len(rows)
+    return signed
+
+
+def write_signatures(cursor, rows):
+    if rows:
+        execute_values(cursor, """
+            INSERT INTO poem_signatures (poem_id, signature) VALUES %s
+            ON CONFLICT (poem_id) DO UPDATE SET signature = EXCLUDED.signature
+        """, rows, page_size=len(rows))
+
+
+# pairs of rows sharing a bucket in any band
+# each member of a bucket is paired with the bucket's first member and the member before it, rather than with
+# every member: a bucket of k copies of one poem would otherwise give k^2 / 2 pairs
+def candidate_pairs(buckets):
+    pairs = []
+    for band in range(buckets.shape[1]):
+        order = np.argsort(buckets[:, band], kind="stable")
+        keys = buckets[order, band]
+        same = np.flatnonzero(keys[1:] == keys[:-1]) + 1
+        if not len(same):
+            continue
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        first = order[starts[np.searchsorted(starts, same, side="right") - 1]]
+        pairs.append(np.stack([order[same - 1], order[same]], axis=1))
+        pairs.append(np.stack([first, order[same]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+
+
+# the smallest row connected to every row through the given pairs
+def connected_components(count, pairs):
+    labels = np.arange(count)
+    while True:
+        low = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        updated = labels.copy()
+        np.minimum.at(updated, pairs[:, 0], low)
+        np.minimum.at(updated, pairs[:, 1], low)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+# sign every poem in parallel, then rebuild the LSH index and the duplicate flags of the whole corpus
+# returns the number of poems flagged
+def recluster(processes=None, threshold=SIMILARITY_THRESHOLD):
+    import poemstore
+
+    ensure_index()
+    poemstore.ensure_poem_bodies()
+    started = time.perf_counter()
+    with db.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MIN(poem_id), 0), COALESCE(MAX(poem_id), 0) FROM poems")
+        low, high = cursor.fetchone()
+    processes = processes or multiprocessing.cpu_count()
+    bounds = np.linspace(low, high + 1, processes * 4 + 1).astype(int).tolist()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=start_worker,
+                             initargs=(dict(db.DB_PARAMS),)) as pool:
+        signed = sum(pool.map(sign_range, bounds[:-1], bounds[1:]))
+    print("Signed %d poems in %.1fs" % (signed, time.perf_counter() - started))
+
+    with db.cursor() as cursor:
+        # signatures of poems that were deleted since they were signed don't belong in the index
+        cursor.execute("""
+            SELECT s.poem_id, s.signature FROM poem_signatures s JOIN poems p ON p.poem_id = s.poem_id
+            ORDER BY s.poem_id
+        """)
+        rows = cursor.fetchall()
+        poem_ids = np.array([poem_id for poem_id, _ in rows], dtype=np.int64)
+        signatures = np.stack([signature_from_bytes(data) for _, data in rows]) if rows else \
+            np.empty((0, NUM_PERM), dtype=np.uint32)
+        buckets = band_buckets(signatures) if rows else np.empty((0, BANDS), dtype=np.int64)
+
+        pairs = candidate_pairs(buckets)
+        scores = similarity(signatures[pairs[:, 0]], signatures[pairs[:, 1]]) if len(pairs) else np.empty(0)
+        matched = pairs[scores >= threshold]
+        labels = connected_components(len(poem_ids), matched)
+        flagged = np.flatnonzero(labels != np.arange(len(poem_ids)))
+        # the similarity recorded is the poem's best match, which may not be the first poem of the cluster
+        best = {}
+        for (first, second), score in zip(matched, scores[scores >= threshold]):
+            for row in (first, second):
+                best[row] = max(best.get(row, 0.0), float(score))
+
+        cursor.execute("TRUNCATE poem_lsh_buckets, poem_duplicates")
+        # a row per poem and band, COPY loads them much faster than multi-row INSERTs
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(zip(np.tile(np.arange(BANDS), len(poem_ids)).tolist(),
+                                         buckets.ravel().tolist(), np.repeat(poem_ids, BANDS).tolist()))
+        buffer.seek(0)
+        cursor.copy_expert("COPY poem_lsh_buckets (band, bucket, poem_id) FROM STDIN WITH (FORMAT csv)", buffer)
+        execute_values(cursor, "INSERT INTO poem_duplicates (poem_id, duplicate_of, similarity) VALUES %s",
+                       [(int(poem_ids[row]), int(poem_ids[labels[row]]), best[row]) for row in flagged],
+                       page_size=10000)
+    print("%d candidate pairs, %d near-duplicates in %d clusters (%.1fs)" % (
+        len(pairs), len(flagged), len(set(labels[flagged].tolist())), time.perf_counter() - started))
+    return len(flagged)
+
+
+# clusters of near-duplicate poems, the first poem of each cluster and the poems flagged as its copies
+def print_clusters(limit=20):
+    ensure_index()
+    with db.cursor() as cursor:
+        cursor.execute("""
+            SELECT d.duplicate_of, f.poem_title, fa.author_name,
+                   ARRAY_AGG(p.poem_title || ' / ' || a.author_name || ' (' || ROUND(d.similarity::numeric, 2) || ')'
+                             ORDER BY d.poem_id)
+            FROM poem_duplicates d
+            JOIN poems p ON p.poem_id = d.poem_id
+            JOIN authors a ON a.author_id = p.author_id
+            JOIN poems f ON f.poem_id = d.duplicate_of
+            JOIN authors fa ON fa.author_id = f.author_id
+            GROUP BY d.duplicate_of, f.poem_title, fa.author_name
+            ORDER BY COUNT(*) DESC, d.duplicate_of
+            LIMIT %s
+        """, (limit,))
+        clusters = cursor.fetchall()
+    if not clusters:
+        print("No near-duplicate poems flagged")
+    for poem_id, title, author, copies in clusters:
+        print("%d %s / %s" % (poem_id, title, author))
+        for copy in copies:
+            print("    " + copy)
+
+
+# parse the command line, then recluster or list the flagged poems
+def command_line(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Find poems stored more than once, even under "
+                                                             "different titles or with small edits")
+    parser.add_argument("--recluster", action="store_true", help="re-sign every poem and rebuild the index")
+    parser.add_argument("--processes", type=int, default=None, help="processes signing poems, one per CPU by default")
+    parser.add_argument("--threshold", type=float, default=SIMILARITY_THRESHOLD,
+                        help="estimated Jaccard similarity from which poems are near-duplicates")
+    parser.add_argument("--limit", type=int, default=20, help="clusters to list")
+    args = parser.parse_args(argv)
+    if args.recluster:
+        recluster(args.processes, args.threshold)
+    print_clusters(args.limit)
+
+
+if __name__ == '__main__':
+    command_line()
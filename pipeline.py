@@ -0,0 +1,156 @@
+import queue
+import threading
+import time
+
+import getData
+import metrics
+from fetcher import BACKOFF_SECONDS, MAX_RETRIES, REQUESTS_PER_SECOND, HostRateLimiter, get_json
+
+# default number of threads per stage, there is always a single writer
+FETCH_WORKERS = 8
+CLEAN_WORKERS = 2
+# items waiting between two stages, a full queue makes the stage before it wait
+QUEUE_SIZE = 500
+# seconds the supervising thread sleeps between checks, short enough for Ctrl-C to be noticed quickly
+POLL_SECONDS = 0.2
+
+# marks the end of a queue's items
+DONE = object()
+
+
+# fetch -> clean -> write ingest with every stage running at once
+# fetch threads keep the HTTP side busy and the single writer keeps the database side busy; the bounded queues
+# between them apply backpressure, so a slow database makes fetching wait instead of filling memory
+# write(title, poem, fetched) gets cleaned poems on the writer thread, poem is None when the response held no
+# single valid poem and fetched is False when the request failed
+class IngestPipeline:
+    def __init__(self, titles, write, base_url=None, fetch_workers=FETCH_WORKERS, clean_workers=CLEAN_WORKERS,
+                 queue_size=QUEUE_SIZE, rate=REQUESTS_PER_SECOND, retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+        self.titles = iter(titles)
+        self.write = write
+        self.base_url = base_url or getData.BASE_URL
+        self.fetch_workers = max(1, fetch_workers)
+        self.clean_workers = max(1, clean_workers)
+        self.limiter = HostRateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.fetched = queue.Queue(queue_size)
+        self.cleaned = queue.Queue(queue_size)
+        # set on Ctrl-C: no new title is started, titles already fetched still go through clean and write
+        self.stopping = threading.Event()
+        # set once the writer has handed over its last poem
+        self.written = threading.Event()
+        self.lock = threading.Lock()
+        self.running = {"fetch": self.fetch_workers, "clean": self.clean_workers}
+        self.threads = []
+
+    def next_title(self):
+        if self.stopping.is_set():
+            return None
+        with self.lock:
+            return next(self.titles, None)
+
+    # the last thread of a stage to finish tells every consumer of the next stage to stop
+    def finished(self, stage, next_queue, consumers):
+        with self.lock:
+            self.running[stage] -= 1
+            last = not self.running[stage]
+        if last:
+            for _ in range(consumers):
+                next_queue.put(DONE)
+
+    # put an item on the next queue, timing how long a full queue holds the stage back
+    def hand_over(self, next_queue, item, stage):
+        try:
+            next_queue.put_nowait(item)
+        except queue.Full:
+            with metrics.stage(stage):
+                next_queue.put(item)
+
+    def fetch(self):
+        try:
+            while True:
+                title = self.next_title()
+                if title is None:
+                    return
+                try:
+                    with metrics.stage("fetch_poems"):
+                        res_data = get_json(self.base_url + "/title/" + title, self.limiter, self.retries,
+                                            self.backoff)
+                except Exception as e:
+                    print("Failed to fetch " + title + ": " + str(e))
+                    res_data = None
+                self.hand_over(self.fetched, (title, res_data), "fetch_blocked")
+        finally:
+            self.finished("fetch", self.fetched, self.clean_workers)
+
+    def clean(self):
+        try:
+            while True:
+                item = self.fetched.get()
+                if item is DONE:
+                    return
+                title, res_data = item
+                poem = None
+                try:
+                    # if poem data is invalid, parse_poem returns None and the title is skipped
+                    poem = getData.parse_poem(res_data) if res_data is not None else None
+                    if poem is not None:
+                        with metrics.stage("clean"):
+                            poem = getData.clean_poem(poem)
+                except Exception as e:
+                    print("Failed to clean " + title + ": " + str(e))
+                    poem = None
+                self.hand_over(self.cleaned, (title, poem, res_data is not None), "clean_blocked")
+        finally:
+            self.finished("clean", self.cleaned, 1)
+
+    def write_all(self):
+        try:
+            while True:
+                # time the writer spends waiting for poems, the share of the run the database side sat idle
+                with metrics.stage("writer_idle"):
+                    item = self.cleaned.get()
+                if item is DONE:
+                    return
+                try:
+                    self.write(*item)
+                except Exception as e:
+                    print("Failed to write " + item[0] + ": " + str(e))
+        finally:
+            self.written.set()
+
+    def start(self):
+        for target, count in ((self.fetch, self.fetch_workers), (self.clean, self.clean_workers),
+                              (self.write_all, 1)):
+            for _ in range(count):
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    # wait until every title went through the pipeline, returns False if it was stopped by Ctrl-C
+    # after Ctrl-C the titles in flight are still cleaned and handed to write; a second Ctrl-C gives up on them
+    def join(self):
+        interrupted = False
+        # sleep rather than Thread.join: a Ctrl-C landing inside join can make is_alive() report a running
+        # writer as finished, and the caller would then flush while poems are still being added
+        while not self.written.is_set():
+            try:
+                time.sleep(POLL_SECONDS)
+            except KeyboardInterrupt:
+                if interrupted:
+                    raise
+                interrupted = True
+                self.stopping.set()
+                print("\nInterrupted, finishing the titles already fetched (Ctrl-C again to quit now)")
+        return not interrupted
+
+
+# run titles through the pipeline, returns False if it was interrupted
+def run_pipeline(titles, write, **options):
+    started = time.perf_counter()
+    pipeline = IngestPipeline(titles, write, **options)
+    completed = pipeline.start().join()
+    metrics.get().set("pipeline_seconds", time.perf_counter() - started)
+    return completed
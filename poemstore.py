@@ -0,0 +1,197 @@
+import time
+from functools import lru_cache
+
+import db
+
+# poems read per round trip by iter_poems
+POEM_FETCH_SIZE = 500
+# whole poems kept in memory by get_poem
+POEM_CACHE_SIZE = 1024
+
+# poem_bodies holds every poem's lines as one array, in line_number order
+# statement-level triggers on lines rebuild the bodies of the poems a statement touched, using its
+# transition tables, so a COPY of thousands of lines rebuilds each poem once rather than once per line
+POEM_BODIES_SQL = """
+    CREATE TABLE IF NOT EXISTS poem_bodies (
+        poem_id INT PRIMARY KEY,
+        lines TEXT[] NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS lines_poem_id_line_number_idx ON lines (poem_id, line_number);
+
+    CREATE OR REPLACE FUNCTION rebuild_poem_bodies(poem_ids INT[]) RETURNS VOID LANGUAGE sql AS $$
+        DELETE FROM poem_bodies b
+        WHERE b.poem_id = ANY(poem_ids)
+        AND NOT EXISTS (SELECT 1 FROM lines l WHERE l.poem_id = b.poem_id);
+
+        INSERT INTO poem_bodies (poem_id, lines)
+        SELECT poem_id, ARRAY_AGG(line_content ORDER BY line_number, line_id)
+        FROM lines
+        WHERE poem_id = ANY(poem_ids)
+        GROUP BY poem_id
+        ON CONFLICT (poem_id) DO UPDATE SET lines = EXCLUDED.lines;
+    $$;
+
+    CREATE OR REPLACE FUNCTION sync_poem_bodies() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM rebuild_poem_bodies(ARRAY(SELECT DISTINCT poem_id FROM new_lines WHERE poem_id IS NOT NULL));
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM rebuild_poem_bodies(ARRAY(
+                SELECT poem_id FROM old_lines WHERE poem_id IS NOT NULL
+                UNION SELECT poem_id FROM new_lines WHERE poem_id IS NOT NULL
+            ));
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM rebuild_poem_bodies(ARRAY(SELECT DISTINCT poem_id FROM old_lines WHERE poem_id IS NOT NULL));
+        ELSE
+            TRUNCATE poem_bodies;
+        END IF;
+        RETURN NULL;
+    END
+    $$;
+
+    DROP TRIGGER IF EXISTS poem_bodies_insert ON lines;
+    DROP TRIGGER IF EXISTS poem_bodies_update ON lines;
+    DROP TRIGGER IF EXISTS poem_bodies_delete ON lines;
+    DROP TRIGGER IF EXISTS poem_bodies_truncate ON lines;
+    CREATE TRIGGER poem_bodies_insert AFTER INSERT ON lines
+        REFERENCING NEW TABLE AS new_lines FOR EACH STATEMENT EXECUTE FUNCTION sync_poem_bodies();
+    CREATE TRIGGER poem_bodies_update AFTER UPDATE ON lines
+        REFERENCING OLD TABLE AS old_lines NEW TABLE AS new_lines
+        FOR EACH STATEMENT EXECUTE FUNCTION sync_poem_bodies();
+    CREATE TRIGGER poem_bodies_delete AFTER DELETE ON lines
+        REFERENCING OLD TABLE AS old_lines FOR EACH STATEMENT EXECUTE FUNCTION sync_poem_bodies();
+    CREATE TRIGGER poem_bodies_truncate AFTER TRUNCATE ON lines
+        FOR EACH STATEMENT EXECUTE FUNCTION sync_poem_bodies();
+"""
+
+_ready = False
+
+
+# create the body table and its triggers, filling it from lines whenever they were missing
+def ensure_poem_bodies():
+    global _ready
+    if _ready:
+        return
+    with db.cursor() as cursor:
+        cursor.execute("""
+            SELECT to_regclass('poem_bodies') IS NOT NULL,
+                   (SELECT COUNT(*) FROM pg_trigger WHERE tgrelid = 'lines'::regclass AND tgname LIKE 'poem_bodies_%%')
+        """)
+        exists, triggers = cursor.fetchone()
+        if not exists or triggers < 4:
+            # keep writers out until the triggers are in place, so no line change is missed
+            cursor.execute("LOCK TABLE lines IN SHARE ROW EXCLUSIVE MODE")
+            cursor.execute(POEM_BODIES_SQL)
+            rebuild_all(cursor)
+    _ready = True
+
+
+# check the table and its triggers again on next use, needed when lines was dropped and recreated
+def forget_bodies():
+    global _ready
+    _ready = False
+
+
+# rebuild every body from lines, needed after lines changed while the triggers didn't exist
+def rebuild_all(cursor):
+    cursor.execute("""
+        TRUNCATE poem_bodies;
+        INSERT INTO poem_bodies (poem_id, lines)
+        SELECT poem_id, ARRAY_AGG(line_content ORDER BY line_number, line_id)
+        FROM lines
+        WHERE poem_id IS NOT NULL
+        GROUP BY poem_id;
+    """)
+    get_poem.cache_clear()
+
+
+# a whole poem as {"poem_id", "title", "author", "lines"}, or None if there is no such poem
+# cached, so a poem changed by another process may be served stale until get_poem.cache_clear()
+@lru_cache(maxsize=POEM_CACHE_SIZE)
+def get_poem(poem_id):
+    ensure_poem_bodies()
+    with db.cursor() as cursor:
+        cursor.execute("""
+            SELECT p.poem_id, p.poem_title, a.author_name, COALESCE(b.lines, '{}')
+            FROM poems p
+            LEFT JOIN authors a ON a.author_id = p.author_id
+            LEFT JOIN poem_bodies b ON b.poem_id = p.poem_id
+            WHERE p.poem_id = %s
+        """, (poem_id,))
+        row = cursor.fetchone()
+    # lines is a tuple so the cached poem can't be changed by a caller
+    return None if row is None else poem_dict(row)
+
+
+def poem_dict(row):
+    poem_id, title, author, lines = row
+    return {"poem_id": poem_id, "title": title, "author": author, "lines": tuple(lines)}
+
+
+# every poem in poem_id order, read batch_size poems per round trip through a server-side cursor
+def iter_poems(batch_size=POEM_FETCH_SIZE):
+    ensure_poem_bodies()
+    with db.cursor("poem_bodies_scan") as cursor:
+        cursor.itersize = batch_size
+        cursor.execute("""
+            SELECT p.poem_id, p.poem_title, a.author_name, COALESCE(b.lines, '{}')
+            FROM poems p
+            LEFT JOIN authors a ON a.author_id = p.author_id
+            LEFT JOIN poem_bodies b ON b.poem_id = p.poem_id
+            ORDER BY p.poem_id
+        """)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield poem_dict(row)
+
+
+# lines of one poem read the old way, one row per line
+def read_poem_lines(cursor, poem_id):
+    cursor.execute("SELECT line_content FROM lines WHERE poem_id = %s ORDER BY line_number, line_id", (poem_id,))
+    return tuple(row[0] for row in cursor.fetchall())
+
+
+# check the bodies against lines and time whole-poem reads both ways
+def compare_reads(sample=200):
+    ensure_poem_bodies()
+    with db.cursor() as cursor:
+        cursor.execute("SELECT poem_id FROM poems ORDER BY poem_id")
+        poem_ids = [row[0] for row in cursor.fetchall()]
+
+        started = time.perf_counter()
+        from_lines = {poem_id: read_poem_lines(cursor, poem_id) for poem_id in poem_ids}
+        line_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    from_bodies = {poem["poem_id"]: poem["lines"] for poem in iter_poems()}
+    body_seconds = time.perf_counter() - started
+
+    mismatched = [poem_id for poem_id in poem_ids if from_lines[poem_id] != from_bodies.get(poem_id)]
+    print("%d poems, %d bodies differ from lines" % (len(poem_ids), len(mismatched)))
+    print("query per poem from lines:  %.3fs" % line_seconds)
+    print("iter_poems from bodies:     %.3fs" % body_seconds)
+
+    get_poem.cache_clear()
+    for cached in (False, True):
+        started = time.perf_counter()
+        for poem_id in poem_ids[:sample]:
+            get_poem(poem_id)
+        print("get_poem x%d %-8s %.3fs" % (min(sample, len(poem_ids)), "cached" if cached else "cold",
+                                           time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the whole-poem body store")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild every poem body from lines")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        ensure_poem_bodies()
+        with db.cursor() as cursor:
+            rebuild_all(cursor)
+    compare_reads()
@@ -0,0 +1,205 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# the ingest's tables, the same as readme-pics/DB-Schema.jpg, in the order they reference each other
+TABLES = ("authors", "poems", "lines")
+
+# columns only, the keys below are added separately so a bulk load can build them after the data is in
+# {suffix} names a copy of the schema, the initial load fills authors_new etc. and swaps them in
+TABLES_SQL = """
+    CREATE {unlogged}TABLE {exists}authors{suffix} (
+        author_id SERIAL NOT NULL,
+        author_name VARCHAR NOT NULL
+    );
+    CREATE {unlogged}TABLE {exists}poems{suffix} (
+        poem_id SERIAL NOT NULL,
+        author_id INT,
+        poem_title VARCHAR NOT NULL,
+        line_count INT NOT NULL
+    );
+    CREATE {unlogged}TABLE {exists}lines{suffix} (
+        line_id SERIAL NOT NULL,
+        poem_id INT,
+        line_number INT NOT NULL,
+        line_content TEXT NOT NULL
+    );
+"""
+
+# (table, constraint, kind, columns) of the primary and unique keys
+# poems are keyed by author and title, distinct poems sharing a title are both kept
+KEYS = [
+    ("authors", "authors_pkey", "PRIMARY KEY", "author_id"),
+    ("authors", "authors_author_name_key", "UNIQUE", "author_name"),
+    ("poems", "poems_pkey", "PRIMARY KEY", "poem_id"),
+    ("poems", "poems_author_id_poem_title_key", "UNIQUE", "author_id, poem_title"),
+    ("lines", "lines_pkey", "PRIMARY KEY", "line_id"),
+]
+
+# (table, constraint, column, referenced table, referenced column)
+FOREIGN_KEYS = [
+    ("poems", "poems_author_id_fkey", "author_id", "authors", "author_id"),
+    ("lines", "lines_poem_id_fkey", "poem_id", "poems", "poem_id"),
+]
+
+# constraints of earlier versions of the schema, dropped when they are found
+LEGACY_CONSTRAINTS = [
+    ("poems", "poems_poem_title_key"),
+]
+
+# a counter per table bumped in the same transaction by every UPDATE, DELETE or TRUNCATE of it, so anything
+# derived from the tables can tell rows were changed in place; inserts show in row counts and the highest ids
+# instead, bumping on them would make concurrent ingest writers wait on each other for the counter row
+DATA_VERSIONS_SQL = """
+    CREATE TABLE IF NOT EXISTS data_versions (
+        table_name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    );
+    INSERT INTO data_versions (table_name) SELECT UNNEST(%(tables)s) ON CONFLICT (table_name) DO NOTHING;
+
+    CREATE OR REPLACE FUNCTION bump_data_version() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+        RETURN NULL;
+    END
+    $$;
+"""
+
+DATA_VERSION_TRIGGER_SQL = """
+    CREATE TRIGGER {table}_data_version AFTER UPDATE OR DELETE OR TRUNCATE ON {table}
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+"""
+
+# connections building keys at once when they are rebuilt after a bulk load
+KEY_WORKERS = 4
+# memory each index build may sort in, the server default of 64MB spills large indexes to disk
+INDEX_MEMORY = "256MB"
+
+
+def tables_sql(suffix="", unlogged=False, if_not_exists=False):
+    return TABLES_SQL.format(suffix=suffix, unlogged="UNLOGGED " if unlogged else "",
+                             exists="IF NOT EXISTS " if if_not_exists else "")
+
+
+# names of the constraints that exist on the given tables
+def existing_constraints(cursor, tables):
+    cursor.execute("""
+        SELECT conname FROM pg_constraint
+        WHERE conrelid IN (SELECT oid FROM pg_class WHERE relname = ANY(%s) AND relkind = 'r'
+                           AND relnamespace = 'public'::regnamespace)
+    """, (list(tables),))
+    return {row[0] for row in cursor.fetchall()}
+
+
+# create the version counters and the triggers the tables are missing
+# a table that had no trigger gets its counter bumped, it may have been changed while nothing was counting
+def ensure_data_versions(cursor):
+    cursor.execute(DATA_VERSIONS_SQL, {"tables": list(TABLES)})
+    cursor.execute("""
+        SELECT c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid
+        WHERE c.relname = ANY(%s) AND c.relnamespace = 'public'::regnamespace
+        AND t.tgname = c.relname || '_data_version'
+    """, (list(TABLES),))
+    present = {row[0] for row in cursor.fetchall()}
+    for table in TABLES:
+        if table not in present:
+            cursor.execute(DATA_VERSION_TRIGGER_SQL.format(table=table))
+            cursor.execute("UPDATE data_versions SET version = version + 1 WHERE table_name = %s", (table,))
+
+
+# {table: version} of the tables, empty if the counters were never created
+def data_versions(cursor):
+    cursor.execute("SELECT to_regclass('data_versions') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return {}
+    cursor.execute("SELECT table_name, version FROM data_versions")
+    return dict(cursor.fetchall())
+
+
+# create the tables and any key or foreign key they are missing, and drop the legacy constraints
+# safe to run on every start: a complete schema is left as it is
+def ensure_schema():
+    with db.cursor() as cursor:
+        # two processes starting at once would both try to add the same constraint
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('ensure_schema'))")
+        cursor.execute(tables_sql(if_not_exists=True))
+        existing = existing_constraints(cursor, TABLES)
+        for table, name in LEGACY_CONSTRAINTS:
+            if name in existing:
+                cursor.execute("ALTER TABLE {table} DROP CONSTRAINT {name}".format(table=table, name=name))
+        for table, name, kind, columns in KEYS:
+            if name not in existing:
+                cursor.execute("ALTER TABLE {table} ADD CONSTRAINT {name} {kind} ({columns})".format(
+                    table=table, name=name, kind=kind, columns=columns))
+        for table, name, column, referenced, referenced_column in FOREIGN_KEYS:
+            if name not in existing:
+                cursor.execute("ALTER TABLE {table} ADD CONSTRAINT {name} FOREIGN KEY ({column}) "
+                               "REFERENCES {referenced} ({referenced_column})".format(
+                                   table=table, name=name, column=column, referenced=referenced,
+                                   referenced_column=referenced_column))
+        ensure_data_versions(cursor)
+
+
+# run statements at once, each on its own pooled connection and in its own transaction
+def run_parallel(statements, workers=KEY_WORKERS):
+    def run(statement):
+        with db.cursor() as cursor:
+            cursor.execute("SET LOCAL maintenance_work_mem = %s", (INDEX_MEMORY,))
+            cursor.execute(statement)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, db.POOL_MAX, len(statements)))) as pool:
+        # list() so an error in any statement is raised here
+        list(pool.map(run, statements))
+
+
+# add the keys and foreign keys to tables filled without them, the suffixed copy of the schema by default
+# the unique indexes are built in parallel, CREATE INDEX only blocks writes so indexes of one table build at once;
+# they then become constraints without another scan, and the foreign keys are added unchecked and validated in
+# parallel, which doesn't lock out the other validations
+def build_keys(suffix="", workers=KEY_WORKERS):
+    run_parallel(["CREATE UNIQUE INDEX {name}{suffix} ON {table}{suffix} ({columns})".format(
+        name=name, suffix=suffix, table=table, columns=columns) for table, name, _, columns in KEYS], workers)
+    with db.cursor() as cursor:
+        for table, name, kind, _ in KEYS:
+            cursor.execute("ALTER TABLE {table}{suffix} ADD CONSTRAINT {name}{suffix} {kind} USING INDEX {name}{suffix}"
+                           .format(table=table, suffix=suffix, name=name, kind=kind))
+        for table, name, column, referenced, referenced_column in FOREIGN_KEYS:
+            cursor.execute("ALTER TABLE {table}{suffix} ADD CONSTRAINT {name}{suffix} FOREIGN KEY ({column}) "
+                           "REFERENCES {referenced}{suffix} ({referenced_column}) NOT VALID".format(
+                               table=table, suffix=suffix, name=name, column=column, referenced=referenced,
+                               referenced_column=referenced_column))
+    run_parallel(["ALTER TABLE {table}{suffix} VALIDATE CONSTRAINT {name}{suffix}".format(
+        table=table, suffix=suffix, name=name) for table, name, _, _, _ in FOREIGN_KEYS], workers)
+
+
+# rename the suffixed tables, their sequences and their constraints to the names of the schema
+def rename_schema(cursor, suffix):
+    for table in TABLES:
+        cursor.execute("ALTER TABLE {table}{suffix} RENAME TO {table}".format(table=table, suffix=suffix))
+    cursor.execute("""
+        SELECT s.relname, a.attname, t.relname
+        FROM pg_depend d
+        JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_class t ON t.oid = d.refobjid
+        JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = d.refobjsubid
+        WHERE t.relname = ANY(%s) AND d.deptype = 'a'
+    """, (list(TABLES),))
+    for sequence, column, table in cursor.fetchall():
+        if sequence.startswith(table + suffix):
+            cursor.execute("ALTER SEQUENCE {sequence} RENAME TO {table}_{column}_seq".format(
+                sequence=sequence, table=table, column=column))
+    for table, name, _, _ in KEYS:
+        cursor.execute("ALTER TABLE {table} RENAME CONSTRAINT {name}{suffix} TO {name}".format(
+            table=table, name=name, suffix=suffix))
+    for table, name, _, _, _ in FOREIGN_KEYS:
+        cursor.execute("ALTER TABLE {table} RENAME CONSTRAINT {name}{suffix} TO {name}".format(
+            table=table, name=name, suffix=suffix))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the authors, poems and lines tables, or add what is "
+                                                 "missing from them")
+    parser.parse_args()
+    ensure_schema()
+    print("Schema is up to date")
@@ -0,0 +1,266 @@
+import argparse
+import statistics
+import time
+
+import db
+
+# text search configuration: stems words and drops English stopwords, so "loved" finds "love"
+SEARCH_CONFIG = "english"
+# results per page
+SEARCH_LIMIT = 20
+# lines shown before and after each matching line
+CONTEXT_LINES = 1
+# "words" matches stemmed words and quoted phrases, "substring" matches any part of a line
+MODES = ("words", "substring")
+
+# the expression indexed by lines_search_idx, queries must repeat it exactly for the index to be used
+LINE_VECTOR = "to_tsvector('%s', COALESCE(l.line_content, ''))" % SEARCH_CONFIG
+
+# (name, definition) of the indexes each mode uses, built by create_search_indexes rather than by a search
+# context lines are looked up by position in their poem
+SEARCH_INDEXES = {
+    "words": [
+        ("lines_search_idx", "lines USING GIN (to_tsvector('{config}', COALESCE(line_content, '')))".format(
+            config=SEARCH_CONFIG)),
+        ("lines_poem_id_line_number_idx", "lines (poem_id, line_number)"),
+    ],
+    # substring search needs the pg_trgm extension, without it substring queries scan the table
+    "substring": [
+        ("lines_trigram_idx", "lines USING GIN (line_content gin_trgm_ops)"),
+        ("lines_poem_id_line_number_idx", "lines (poem_id, line_number)"),
+    ],
+}
+
+# set once pg_trgm is known to be installed, it isn't looked up again
+_trigram = False
+
+
+# build the indexes of the given modes without blocking writes to lines, a concurrent ingest keeps going
+# CREATE INDEX CONCURRENTLY can't run in a transaction, so the connection is switched to autocommit
+def create_search_indexes(modes=MODES):
+    with db.connection() as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for mode in modes:
+                    if mode == "substring":
+                        try:
+                            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                        except Exception as e:
+                            print("Substring search is not indexed, pg_trgm is unavailable: " +
+                                  str(e).splitlines()[0])
+                            continue
+                    for name, definition in SEARCH_INDEXES[mode]:
+                        # an interrupted concurrent build leaves an invalid index that IF NOT EXISTS would keep
+                        cursor.execute("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+                                       (name,))
+                        row = cursor.fetchone()
+                        if row and row[0]:
+                            cursor.execute("DROP INDEX CONCURRENTLY " + name)
+                        cursor.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}".format(
+                            name=name, definition=definition))
+        finally:
+            conn.autocommit = False
+
+
+# names of the indexes a mode uses that don't exist, searches still work without them but scan lines
+def missing_indexes(cursor, mode="words"):
+    names = [name for name, _ in SEARCH_INDEXES[mode]]
+    cursor.execute("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = ANY(%s) AND i.indisvalid
+    """, (names,))
+    found = {row[0] for row in cursor.fetchall()}
+    return [name for name in names if name not in found]
+
+
+# true when pg_trgm is installed, which gives substring matches a similarity rank
+def has_trigram(cursor):
+    global _trigram
+    if not _trigram:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        _trigram = cursor.fetchone()[0]
+    return _trigram
+
+
+def match_sql(mode, trigram=False):
+    if mode == "words":
+        # websearch syntax: plain words are ANDed, "quoted text" is a phrase, -word excludes, or is OR
+        return ("{vector} @@ websearch_to_tsquery('{config}', %(query)s)".format(vector=LINE_VECTOR,
+                                                                                config=SEARCH_CONFIG),
+                "ts_rank({vector}, websearch_to_tsquery('{config}', %(query)s))".format(vector=LINE_VECTOR,
+                                                                                      config=SEARCH_CONFIG))
+    if mode == "substring":
+        return ("l.line_content ILIKE '%%' || %(pattern)s || '%%'",
+                # without pg_trgm every substring match ranks the same
+                "1 - (%(query)s <<-> l.line_content)" if trigram else "1.0")
+    raise ValueError("Unknown search mode: " + mode)
+
+
+# escape LIKE wildcards so a substring query matches literally
+def like_pattern(query):
+    return query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# lines matching the query, best ranked first, with the poem title, author, line number and context
+# after is the "cursor" of the last result of the previous page; pages are read by keyset instead of OFFSET,
+# so skipped pages aren't fetched again and lines added between pages don't shift the results
+def search_lines(query, author=None, limit=SEARCH_LIMIT, after=None, mode="words", context=CONTEXT_LINES,
+                 cursor=None):
+    if cursor is None:
+        with db.cursor() as cursor:
+            return search_lines(query, author, limit, after, mode, context, cursor)
+    match, rank = match_sql(mode, mode == "substring" and has_trigram(cursor))
+    filters = [match, "l.poem_id IS NOT NULL"]
+    params = {"query": query, "pattern": like_pattern(query), "author": author, "limit": limit,
+              "context": context}
+    if author is not None:
+        filters.append("a.author_name = %(author)s")
+    keyset = ""
+    if after is not None:
+        # ts_rank gives a real, compare as real so the rank of the last result round-trips exactly
+        keyset = "WHERE rank < %(rank)s::real OR (rank = %(rank)s::real AND line_id > %(line_id)s)"
+        params["rank"], params["line_id"] = after
+
+    cursor.execute("""
+        WITH hits AS (
+            SELECT * FROM (
+                SELECT l.line_id, l.poem_id, l.line_number, l.line_content,
+                       p.poem_title, a.author_name, ({rank})::real AS rank
+                FROM lines l
+                JOIN poems p ON p.poem_id = l.poem_id
+                LEFT JOIN authors a ON a.author_id = p.author_id
+                WHERE {filters}
+            ) matches
+            {keyset}
+            ORDER BY rank DESC, line_id
+            LIMIT %(limit)s
+        )
+        SELECT h.line_id, h.poem_id, h.poem_title, h.author_name, h.line_number, h.line_content, h.rank,
+               ARRAY(
+                   SELECT c.line_content FROM lines c
+                   WHERE c.poem_id = h.poem_id
+                   AND c.line_number BETWEEN h.line_number - %(context)s AND h.line_number + %(context)s
+                   ORDER BY c.line_number
+               ) AS context
+        FROM hits h
+        ORDER BY h.rank DESC, h.line_id
+    """.format(rank=rank, filters=" AND ".join(filters), keyset=keyset), params)
+    rows = cursor.fetchall()
+
+    return [{
+        "line_id": line_id,
+        "poem_id": poem_id,
+        "title": title,
+        "author": author_name,
+        "line_number": line_number,
+        "line": line,
+        "context": list(context_lines),
+        "rank": rank,
+        # pass as after= to get the next page
+        "cursor": (rank, line_id),
+    } for line_id, poem_id, title, author_name, line_number, line, rank, context_lines in rows]
+
+
+# every result of a query, page by page
+def iter_search(query, page_size=SEARCH_LIMIT, **options):
+    after = None
+    while True:
+        results = search_lines(query, limit=page_size, after=after, **options)
+        yield from results
+        if len(results) < page_size:
+            return
+        after = results[-1]["cursor"]
+
+
+def print_results(results):
+    for result in results:
+        print("%s (%s), line %d  [%.3f]" % (result["title"], result["author"], result["line_number"],
+                                            result["rank"]))
+        for line in result["context"]:
+            print("    " + (line or ""))
+
+
+# time first and deeper pages of each query, with the indexes and with the planner told to avoid them
+def benchmark(queries, pages=5, page_size=SEARCH_LIMIT, repeat=5, mode="words"):
+    create_search_indexes([mode])
+    print("%-20s %-10s %12s %12s %12s" % ("query", "plan", "first page", "page %d" % pages, "results"))
+    for query in queries:
+        for plan in ("indexed", "seq scan"):
+            first, deep = [], []
+            for _ in range(repeat):
+                with db.cursor() as cursor:
+                    if plan == "seq scan":
+                        # only for this transaction
+                        cursor.execute("SET LOCAL enable_bitmapscan = off; SET LOCAL enable_indexscan = off")
+                    started = time.perf_counter()
+                    page = search_lines(query, limit=page_size, mode=mode, cursor=cursor)
+                    first.append(time.perf_counter() - started)
+                    started = time.perf_counter()
+                    for _ in range(pages - 1):
+                        if len(page) < page_size:
+                            break
+                        page = search_lines(query, limit=page_size, after=page[-1]["cursor"], mode=mode,
+                                            cursor=cursor)
+                    deep.append((time.perf_counter() - started) / max(pages - 1, 1))
+            count = sum(1 for _ in iter_search(query, page_size=500, mode=mode))
+            print("%-20s %-10s %10.2fms %10.2fms %12d" % (query[:20], plan, statistics.median(first) * 1000,
+                                                          statistics.median(deep) * 1000, count))
+
+
+# a few of the most frequent words, for benchmarking against whatever corpus is loaded
+def sample_queries(count=5):
+    with db.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('word_counts') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return ["love", "night", "summer day"]
+        cursor.execute("""
+            SELECT word_lower FROM word_counts
+            WHERE LENGTH(word_lower) > 3 AND word_lower ~ '^[a-z]+$'
+            ORDER BY frequency DESC
+            LIMIT %s
+        """, (count,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+# parse the command line and print the results of a search, or run the benchmark
+def command_line(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Search the lines of the stored poems")
+    parser.add_argument("query", nargs="?", help='words to find, "quoted text" for a phrase')
+    parser.add_argument("--author", help="only search poems by this author")
+    parser.add_argument("--limit", type=int, default=SEARCH_LIMIT, help="results per page")
+    parser.add_argument("--page", type=int, default=1, help="page of results to show")
+    parser.add_argument("--mode", choices=MODES, default="words")
+    parser.add_argument("--context", type=int, default=CONTEXT_LINES, help="lines shown around each match")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time searches for the most frequent words with and without the indexes")
+    parser.add_argument("--create-indexes", action="store_true",
+                        help="build the search indexes without blocking writes, needed once per database")
+    args = parser.parse_args(argv)
+
+    if args.create_indexes:
+        create_search_indexes()
+        print("Search indexes are up to date")
+        if not args.query:
+            return
+    if args.benchmark:
+        benchmark([args.query] if args.query else sample_queries(), page_size=args.limit, mode=args.mode)
+        return
+    if not args.query:
+        parser.error("a query is needed unless --benchmark or --create-indexes is given")
+    with db.cursor() as cursor:
+        missing = missing_indexes(cursor, args.mode)
+    if missing:
+        print("Searching without " + ", ".join(missing) + ", run with --create-indexes once to build them")
+    after = None
+    for _ in range(args.page):
+        results = search_lines(args.query, author=args.author, limit=args.limit, after=after, mode=args.mode,
+                               context=args.context)
+        if not results:
+            break
+        after = results[-1]["cursor"]
+    print_results(results)
+
+
+if __name__ == '__main__':
+    command_line()
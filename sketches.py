@@ -0,0 +1,436 @@
+import json
+import math
+import time
+
+import numpy as np
+import pandas as pd
+from psycopg2 import Binary
+from psycopg2.extras import execute_values
+
+import db
+import schema
+from frames import query_chunks
+
+# counters per Count-Min row and number of rows: estimates overshoot by at most e / width of all words counted,
+# with probability 1 - exp(-depth)
+COUNT_MIN_WIDTH = 2 ** 16
+COUNT_MIN_DEPTH = 5
+# words tracked by the Space-Saving top-k summary, any word making up more than 1 / capacity of the eligible
+# words is guaranteed to be in it
+TOP_WORDS_CAPACITY = 1000
+# 2 ** precision registers per HyperLogLog, the relative standard error is 1.04 / sqrt(registers)
+HLL_PRECISION = 8
+# lines read per chunk of the streaming pass
+FETCH_ROWS = 50000
+
+HLL_REGISTERS = 2 ** HLL_PRECISION
+HLL_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+
+# the word sketches are one row, the distinct-word sketch of every poem one row per poem
+# authors' sketches aren't stored, they are merged from their poems' sketches when asked for
+SKETCH_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS word_sketches (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        -- highest line_id counted, and how many lines up to it there were, to notice deleted lines
+        last_line_id INT NOT NULL,
+        lines_counted BIGINT NOT NULL,
+        count_min BYTEA NOT NULL,
+        count_min_total BIGINT NOT NULL,
+        top_words JSONB NOT NULL,
+        -- schema.py's version of lines when they were counted, it moves when lines are changed in place
+        lines_version BIGINT
+    );
+    ALTER TABLE word_sketches ADD COLUMN IF NOT EXISTS lines_version BIGINT;
+    CREATE TABLE IF NOT EXISTS poem_sketches (
+        poem_id INT PRIMARY KEY,
+        registers BYTEA NOT NULL
+    );
+"""
+
+
+# stable 64-bit hashes of words, the same in every process
+def word_hashes(words):
+    return pd.util.hash_array(np.asarray(words, dtype=object))
+
+
+# occurrences of every word, estimated from depth rows of width counters
+class CountMinSketch:
+    def __init__(self, width=COUNT_MIN_WIDTH, depth=COUNT_MIN_DEPTH, table=None, total=0):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64) if table is None else table
+        self.total = total
+
+    # the counter of each hash in every row, derived from two halves of the hash
+    def columns(self, hashes):
+        first = hashes & np.uint64(0xFFFFFFFF)
+        second = (hashes >> np.uint64(32)) | np.uint64(1)
+        return [((first + np.uint64(row) * second) % np.uint64(self.width)).astype(np.int64)
+                for row in range(self.depth)]
+
+    def add(self, hashes, counts):
+        for row, columns in enumerate(self.columns(hashes)):
+            self.table[row] += np.bincount(columns, weights=counts, minlength=self.width).astype(np.int64)
+        self.total += int(counts.sum())
+
+    # never below the true count
+    def estimate(self, hashes):
+        return np.min([self.table[row, columns] for row, columns in enumerate(self.columns(hashes))], axis=0)
+
+    def merge(self, other):
+        self.table += other.table
+        self.total += other.total
+
+    # how far an estimate can overshoot, and the probability that it doesn't
+    def error(self):
+        return math.e / self.width * self.total
+
+    def confidence(self):
+        return 1 - math.exp(-self.depth)
+
+    def to_bytes(self):
+        return self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, total, width=COUNT_MIN_WIDTH, depth=COUNT_MIN_DEPTH):
+        return cls(width, depth, np.frombuffer(data, dtype=np.int64).reshape(depth, width).copy(), total)
+
+
+# the capacity most frequent words, each with an upper bound on its count and how much of that may be overcounted
+# the true count of a tracked word lies in [count - error, count], any word left out occurred at most
+# floor() times
+class SpaceSaving:
+    def __init__(self, capacity=TOP_WORDS_CAPACITY, counts=None, errors=None, total=0):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64) if counts is None else counts
+        self.errors = pd.Series(dtype=np.int64) if errors is None else errors
+        self.total = total
+
+    # the most a word that isn't tracked can have occurred
+    def floor(self):
+        return int(self.counts.min()) if len(self.counts) >= self.capacity else 0
+
+    # fold in another summary: a word missing from one side may have occurred up to that side's floor
+    def merge_counts(self, counts, errors, floor):
+        own_floor = self.floor()
+        words = self.counts.index.union(counts.index)
+        merged = self.counts.reindex(words, fill_value=own_floor) + counts.reindex(words, fill_value=floor)
+        merged_errors = self.errors.reindex(words, fill_value=own_floor) + errors.reindex(words, fill_value=floor)
+        keep = merged.sort_values(ascending=False, kind="stable").index[:self.capacity]
+        self.counts = merged[keep].astype(np.int64)
+        self.errors = merged_errors[keep].astype(np.int64)
+
+    # add exact counts of a chunk of words
+    def add(self, words, counts):
+        counts = pd.Series(counts, index=pd.Index(words, dtype=object), dtype=np.int64)
+        self.merge_counts(counts, pd.Series(0, index=counts.index, dtype=np.int64), 0)
+        self.total += int(counts.sum())
+
+    def merge(self, other):
+        self.merge_counts(other.counts, other.errors, other.floor())
+        self.total += other.total
+
+    # word, frequency, error of the most frequent tracked words that aren't excluded
+    def top(self, limit, excluded_words=()):
+        frame = pd.DataFrame({"word": self.counts.index.to_numpy(dtype=object),
+                              "frequency": self.counts.to_numpy(), "error": self.errors.to_numpy()})
+        frame = frame[~frame["word"].isin(set(excluded_words))]
+        return frame.sort_values(["frequency", "word"], ascending=[False, True], ignore_index=True).head(limit)
+
+    def to_json(self):
+        return json.dumps({"capacity": self.capacity, "total": self.total, "words": self.counts.index.tolist(),
+                           "counts": self.counts.tolist(), "errors": self.errors.tolist()})
+
+    @classmethod
+    def from_json(cls, data):
+        index = pd.Index(data["words"], dtype=object)
+        return cls(data["capacity"], pd.Series(data["counts"], index=index, dtype=np.int64),
+                   pd.Series(data["errors"], index=index, dtype=np.int64), data["total"])
+
+
+# words the top-k summary tracks, the filters of tokens.top_words_query that don't depend on the stopword list
+def top_word_candidates(words):
+    words = pd.Series(words, dtype=object)
+    return ((words.str.len() > 2) & ~words.str.contains("'", regex=False) & ~words.str.endswith(",")).to_numpy()
+
+
+# bit length of each uint64, counted in 32-bit halves so the float conversion is exact
+def bit_lengths(values):
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+
+# register and rank of each hash: the first precision bits pick the register, the rank is the position of the
+# first set bit in the rest
+def hll_positions(hashes, precision=HLL_PRECISION):
+    registers = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes << np.uint64(precision)
+    ranks = 64 - bit_lengths(rest) + 1
+    return registers, np.minimum(ranks, 64 - precision + 1).astype(np.uint8)
+
+
+# distinct counts estimated from HyperLogLog registers, one row of registers per sketch
+# small counts use linear counting, which is much more precise than HLL_ERROR below 2.5 x registers
+def hll_estimate(registers):
+    registers = np.atleast_2d(registers)
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)), axis=1)
+    zeros = np.count_nonzero(registers == 0, axis=1)
+    with np.errstate(divide="ignore"):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+def ensure_sketch_tables(cursor):
+    cursor.execute(SKETCH_TABLES_SQL)
+
+
+# the stored word sketches and the line state they cover, empty sketches if there are none yet
+def read_state(cursor):
+    cursor.execute("SELECT last_line_id, lines_counted, count_min, count_min_total, top_words FROM word_sketches")
+    row = cursor.fetchone()
+    if row is None:
+        return 0, 0, CountMinSketch(), SpaceSaving()
+    last_line_id, lines_counted, count_min, total, top_words = row
+    return last_line_id, lines_counted, CountMinSketch.from_bytes(bytes(count_min), total), \
+        SpaceSaving.from_json(top_words)
+
+
+# fold a chunk of (poem_id, line_content) rows into the sketches, splitting lines like tokens.refresh_tokens
+def add_chunk(cursor, frame, count_min, top_words):
+    words = frame["line_content"].str.lower().str.split(" ").explode()
+    codes, uniques = pd.factorize(words.to_numpy())
+    counts = np.bincount(codes, minlength=len(uniques))
+    hashes = word_hashes(uniques)
+    count_min.add(hashes, counts)
+    candidates = top_word_candidates(uniques)
+    top_words.add(uniques[candidates], counts[candidates])
+
+    # distinct words longer than two characters per poem, like poem_word_stats
+    long_words = pd.Series(uniques, dtype=object).str.len().to_numpy() > 2
+    poem_ids = frame["poem_id"].to_numpy(dtype=np.int64)[frame.index.get_indexer(words.index)]
+    keep = long_words[codes]
+    pairs = np.unique((poem_ids[keep] << 32) | codes[keep])
+    positions, ranks = hll_positions(hashes[pairs & 0xFFFFFFFF])
+    poem_index, poems = pd.factorize(pairs >> 32)
+    registers = np.zeros((len(poems), HLL_REGISTERS), dtype=np.uint8)
+    np.maximum.at(registers, (poem_index, positions), ranks)
+    merge_poem_registers(cursor, poems, registers)
+
+
+# merge registers into the stored sketches of the same poems, a poem's lines can arrive over several refreshes
+def merge_poem_registers(cursor, poem_ids, registers):
+    if not len(poem_ids):
+        return
+    rows = {int(poem_id): i for i, poem_id in enumerate(poem_ids)}
+    cursor.execute("SELECT poem_id, registers FROM poem_sketches WHERE poem_id = ANY(%s)", (list(rows),))
+    for poem_id, stored in cursor.fetchall():
+        i = rows[poem_id]
+        registers[i] = np.maximum(registers[i], np.frombuffer(stored, dtype=np.uint8))
+    execute_values(cursor, """
+        INSERT INTO poem_sketches (poem_id, registers) VALUES %s
+        ON CONFLICT (poem_id) DO UPDATE SET registers = EXCLUDED.registers
+    """, [(poem_id, Binary(registers[i].tobytes())) for poem_id, i in rows.items()], page_size=1000)
+
+
+# fold lines added since the last refresh into the sketches, in one streaming pass over them
+# sketches can only count up: rebuild=True starts over, which happens by itself when lines were deleted or
+# changed in place (e.g. by the legacy clean-up pass)
+def refresh_sketches(rebuild=False, fetch_rows=FETCH_ROWS):
+    with db.cursor() as cursor:
+        # serialize refreshes like refresh_tokens, two at once would count the same lines twice
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('refresh_sketches'))")
+        ensure_sketch_tables(cursor)
+        watermark, lines_counted, count_min, top_words = read_state(cursor)
+        cursor.execute("SELECT COUNT(*) FILTER (WHERE line_id <= %s), COALESCE(MAX(line_id), 0) FROM lines",
+                       (watermark,))
+        still_there, upto = cursor.fetchone()
+        lines_version = schema.data_versions(cursor).get("lines")
+        cursor.execute("SELECT lines_version FROM word_sketches")
+        row = cursor.fetchone()
+        if rebuild or still_there != lines_counted or row is None or row[0] != lines_version:
+            cursor.execute("TRUNCATE word_sketches, poem_sketches")
+            watermark, lines_counted, count_min, top_words = 0, 0, CountMinSketch(), SpaceSaving()
+        elif upto <= watermark:
+            return 0
+
+        # streamed on this connection, in the transaction holding the lock, so a refresh never waits for a second
+        # pooled connection; every line the stream sees is counted, and only those, so a line committing after
+        # the stream started is caught by the count check next time
+        counted = 0
+        for frame in query_chunks("""
+            SELECT poem_id, line_content FROM lines WHERE line_id > %s AND line_id <= %s
+        """, (watermark, upto), chunk_rows=fetch_rows, categories=(), connection=cursor.connection):
+            lines_counted += len(frame)
+            frame = frame[frame["poem_id"].notna() & (frame["line_content"] != "")]
+            if len(frame):
+                add_chunk(cursor, frame, count_min, top_words)
+                counted += len(frame)
+
+        cursor.execute("""
+            INSERT INTO word_sketches (last_line_id, lines_counted, count_min, count_min_total, top_words,
+                                       lines_version)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (id) DO UPDATE SET last_line_id = EXCLUDED.last_line_id,
+                lines_counted = EXCLUDED.lines_counted, count_min = EXCLUDED.count_min,
+                count_min_total = EXCLUDED.count_min_total, top_words = EXCLUDED.top_words,
+                lines_version = EXCLUDED.lines_version
+        """, (upto, lines_counted, Binary(count_min.to_bytes()), count_min.total, top_words.to_json(),
+              lines_version))
+        return counted
+
+
+# the word sketches, brought up to date first
+def load_word_sketches():
+    refresh_sketches()
+    with db.cursor() as cursor:
+        _, _, count_min, top_words = read_state(cursor)
+    return count_min, top_words
+
+
+# estimated frequency of each of the given words that occurs, error is how far it may overshoot
+def word_frequency(words):
+    count_min, _ = load_word_sketches()
+    words = sorted(set(words))
+    frame = pd.DataFrame({"word": words, "frequency": count_min.estimate(word_hashes(words)),
+                          "error": int(math.ceil(count_min.error()))})
+    frame = frame[frame["frequency"] > 0]
+    return frame.sort_values(["frequency", "word"], ascending=[False, True], ignore_index=True)
+
+
+# most frequent words with the filters of tokens.top_words_query, the true count lies in
+# [frequency - error, frequency]
+def top_words(limit, excluded_words=()):
+    _, top = load_word_sketches()
+    return top.top(limit, excluded_words)
+
+
+# estimated distinct words per poem next to its line count, error is one standard error
+def word_diversity(max_line_count):
+    refresh_sketches()
+    parts = []
+    for frame in query_chunks("""
+        SELECT p.poem_id, p.line_count, s.registers
+        FROM poems p
+        JOIN poem_sketches s ON s.poem_id = p.poem_id
+        WHERE p.line_count < %s
+    """, (max_line_count,), categories=()):
+        registers = np.frombuffer(b"".join(bytes(value) for value in frame["registers"]), dtype=np.uint8)
+        estimates = hll_estimate(registers.reshape(len(frame), HLL_REGISTERS))
+        parts.append(pd.DataFrame({"poem_id": frame["poem_id"], "line_count": frame["line_count"],
+                                   "unique_words": np.rint(estimates).astype(np.int64),
+                                   "error": np.ceil(estimates * HLL_ERROR).astype(np.int64)}))
+    if not parts:
+        return pd.DataFrame(columns=["poem_id", "line_count", "unique_words", "error"])
+    return pd.concat(parts, ignore_index=True)
+
+
+# estimated distinct words of every author, merged from the sketches of their poems
+def author_diversity():
+    refresh_sketches()
+    authors = {}
+    for frame in query_chunks("""
+        SELECT a.author_id, a.author_name, s.registers
+        FROM poem_sketches s
+        JOIN poems p ON p.poem_id = s.poem_id
+        JOIN authors a ON a.author_id = p.author_id
+    """, categories=()):
+        for author_id, author_name, registers in frame.itertuples(index=False):
+            registers = np.frombuffer(registers, dtype=np.uint8)
+            if author_id in authors:
+                np.maximum(authors[author_id][1], registers, out=authors[author_id][1])
+            else:
+                authors[author_id] = (author_name, registers.copy())
+    if not authors:
+        return pd.DataFrame(columns=["author_id", "author_name", "unique_words", "error"])
+    estimates = hll_estimate(np.stack([registers for _, registers in authors.values()]))
+    frame = pd.DataFrame({"author_id": list(authors), "author_name": [name for name, _ in authors.values()],
+                          "unique_words": np.rint(estimates).astype(np.int64),
+                          "error": np.ceil(estimates * HLL_ERROR).astype(np.int64)})
+    return frame.sort_values("unique_words", ascending=False, ignore_index=True)
+
+
+# what the error columns of the approximate datasets mean
+def describe_errors():
+    count_min, top = load_word_sketches()
+    return [
+        "word frequencies (Count-Min, %dx%d): overestimate by at most %d of %d words with probability %.1f%%" % (
+            count_min.depth, count_min.width, math.ceil(count_min.error()), count_min.total,
+            count_min.confidence() * 100),
+        "top words (Space-Saving, %d words): true count in [frequency - error, frequency], words left out "
+        "occurred at most %d times" % (top.capacity, top.floor()),
+        "distinct words (HyperLogLog, %d registers): relative standard error %.1f%%" % (
+            HLL_REGISTERS, HLL_ERROR * 100),
+    ]
+
+
+# time the exact SQL datasets against the sketches and measure how far apart they are
+def compare_exact(limit=50, excluded_words=(), words=(), max_line_count=5000):
+    from frames import execute_query
+    from tokens import refresh_tokens, top_words_query, word_diversity_query, word_frequency_query
+
+    timings = {}
+    started = time.perf_counter()
+    refresh_tokens(rebuild=True)
+    timings["exact build"] = time.perf_counter() - started
+    started = time.perf_counter()
+    exact_top = execute_query(top_words_query(excluded_words, limit))
+    exact_words = execute_query(word_frequency_query(words)) if words else None
+    exact_diversity = execute_query(word_diversity_query(max_line_count))
+    timings["exact queries"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    refresh_sketches(rebuild=True)
+    timings["sketch build"] = time.perf_counter() - started
+    started = time.perf_counter()
+    approximate_top = top_words(limit, excluded_words)
+    approximate_words = word_frequency(words) if words else None
+    approximate_diversity = word_diversity(max_line_count)
+    timings["sketch queries"] = time.perf_counter() - started
+
+    with db.cursor() as cursor:
+        cursor.execute("""
+            SELECT pg_total_relation_size('tokens') + pg_total_relation_size('word_counts')
+                   + pg_total_relation_size('poem_word_stats'),
+                   pg_total_relation_size('word_sketches') + pg_total_relation_size('poem_sketches')
+        """)
+        exact_bytes, sketch_bytes = cursor.fetchone()
+
+    for name, seconds in timings.items():
+        print("%-16s %8.2fs" % (name, seconds))
+    print("%-16s %8.1f MB exact, %.1f MB sketches" % ("storage", exact_bytes / 2 ** 20, sketch_bytes / 2 ** 20))
+    recall = len(set(exact_top["word"]) & set(approximate_top["word"])) / max(len(exact_top), 1)
+    print("top %d words: %.0f%% of the exact list found" % (limit, recall * 100))
+    if words and len(exact_words):
+        joined = exact_words.merge(approximate_words, on="word", suffixes=("_exact", "_sketch"))
+        overshoot = (joined["frequency_sketch"] - joined["frequency_exact"]).max()
+        print("word frequencies: largest overshoot %d, bound %d" % (overshoot, approximate_words["error"].max()))
+    joined = exact_diversity.merge(approximate_diversity, on="poem_id", suffixes=("_exact", "_sketch"))
+    relative = (joined["unique_words_sketch"] - joined["unique_words_exact"]).abs() / joined["unique_words_exact"]
+    print("distinct words per poem: mean error %.2f%%, 95th percentile %.2f%%, max %.2f%%" % (
+        relative.mean() * 100, relative.quantile(0.95) * 100, relative.max() * 100))
+    return timings
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the approximate word sketches")
+    parser.add_argument("--rebuild", action="store_true", help="recount every line instead of only new ones")
+    parser.add_argument("--compare", action="store_true", help="time and check the sketches against the exact SQL")
+    parser.add_argument("--authors", type=int, default=0, help="also print the authors with the most distinct words")
+    args = parser.parse_args()
+
+    if args.compare:
+        from analytics import TIME_WORDS, excluded_words
+
+        compare_exact(excluded_words=excluded_words(), words=TIME_WORDS)
+    else:
+        started = time.perf_counter()
+        print("Counted %d lines in %.1fs" % (refresh_sketches(args.rebuild), time.perf_counter() - started))
+        for line in describe_errors():
+            print(line)
+        if args.authors:
+            print(author_diversity().head(args.authors))
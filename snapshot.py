@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import pyarrow as pa
+
+import db
+
+# directory the corpus is exported to
+SNAPSHOT_DIR = "snapshot"
+# rows per partition file of the large tables
+PARTITION_ROWS = 250000
+
+# exported tables: the query reading them and the Arrow type of each column
+# repeated strings are dictionary-encoded, lines and titles are nearly all distinct so they stay plain
+TABLES = {
+    "authors": ("SELECT author_id, author_name FROM authors ORDER BY author_id", [
+        ("author_id", pa.int32()),
+        ("author_name", pa.dictionary(pa.int32(), pa.string())),
+    ]),
+    "poems": ("SELECT poem_id, author_id, poem_title, line_count FROM poems ORDER BY poem_id", [
+        ("poem_id", pa.int32()),
+        ("author_id", pa.int32()),
+        ("poem_title", pa.string()),
+        ("line_count", pa.int32()),
+    ]),
+    "lines": ("""
+        SELECT line_id, poem_id, line_number, line_content FROM lines ORDER BY poem_id, line_number, line_id
+    """, [
+        ("line_id", pa.int32()),
+        ("poem_id", pa.int32()),
+        ("line_number", pa.int32()),
+        ("line_content", pa.string()),
+    ]),
+    # only exported if the token tables exist
+    "tokens": ("SELECT poem_id, line_id, position, word_lower FROM tokens ORDER BY line_id, position", [
+        ("poem_id", pa.int32()),
+        ("line_id", pa.int32()),
+        ("position", pa.int32()),
+        ("word_lower", pa.dictionary(pa.int32(), pa.string())),
+    ]),
+}
+OPTIONAL_TABLES = {"tokens"}
+
+
+# build an Arrow record batch from fetched rows
+def record_batch(rows, schema):
+    arrays = []
+    for values, field in zip(list(zip(*rows)) or [()] * len(schema), schema):
+        if pa.types.is_dictionary(field.type):
+            array = pa.array(values, type=field.type.value_type).dictionary_encode()
+        else:
+            array = pa.array(values, type=field.type)
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+# stream a table through a server-side cursor into Arrow IPC files of at most partition_rows rows
+# IPC files are uncompressed, so the loader can memory-map them instead of decoding them
+def export_table(name, directory, partition_rows=PARTITION_ROWS):
+    query, columns = TABLES[name]
+    schema = pa.schema([pa.field(column, column_type) for column, column_type in columns])
+    files = []
+    rows_written = 0
+    with db.cursor("snapshot_" + name) as cursor:
+        cursor.itersize = partition_rows
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(partition_rows)
+            # an empty table still gets one file, so its schema is known
+            if not rows and files:
+                break
+            batch = record_batch(rows, schema)
+            file_name = "%s-%05d.arrow" % (name, len(files))
+            with pa.OSFile(os.path.join(directory, file_name), "wb") as sink:
+                with pa.ipc.new_file(sink, batch.schema) as writer:
+                    writer.write_batch(batch)
+            files.append(file_name)
+            rows_written += len(rows)
+            if len(rows) < partition_rows:
+                break
+    return {"files": files, "rows": rows_written}
+
+
+# write every table to a new snapshot directory, replacing the previous snapshot once it is complete
+def export_snapshot(path=SNAPSHOT_DIR, partition_rows=PARTITION_ROWS):
+    # analytics imports this module to read snapshots
+    from analytics import dataset_version
+
+    started = time.perf_counter()
+    staging = path + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    with db.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('tokens') IS NOT NULL")
+        has_tokens = cursor.fetchone()[0]
+    manifest = {"version": dataset_version(refresh=True), "created_at": time.time(), "tables": {}}
+    for name in TABLES:
+        if name in OPTIONAL_TABLES and not has_tokens:
+            continue
+        table_started = time.perf_counter()
+        manifest["tables"][name] = export_table(name, staging, partition_rows)
+        print("Exported %d %s in %.1fs" % (manifest["tables"][name]["rows"], name,
+                                           time.perf_counter() - table_started))
+    with open(os.path.join(staging, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(staging, path)
+    print("Snapshot written to %s in %.1fs" % (path, time.perf_counter() - started))
+    return manifest
+
+
+# a snapshot directory, read through memory maps so the column buffers are never copied
+class Snapshot:
+    def __init__(self, path=SNAPSHOT_DIR):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self._frequencies = None
+
+    @property
+    def version(self):
+        return self.manifest["version"]
+
+    def has_table(self, name):
+        return name in self.manifest["tables"]
+
+    # the partitions of a table one at a time, as Arrow tables backed by the mapped file
+    def partitions(self, name):
+        for file_name in self.manifest["tables"][name]["files"]:
+            source = pa.memory_map(os.path.join(self.path, file_name), "r")
+            yield pa.ipc.open_file(source).read_all()
+
+    def table(self, name):
+        return pa.concat_tables(list(self.partitions(name)))
+
+    # a table as a DataFrame, dictionary-encoded columns become categoricals
+    def frame(self, name):
+        return self.table(name).to_pandas()
+
+    # word counts of the snapshot's lines, counted partition by partition
+    def word_frequencies(self):
+        if self._frequencies is None:
+            from wordfreq import WordFrequencies
+
+            poems = self.frame("poems")
+            poem_authors = poems.set_index("poem_id")["author_id"]
+            frequencies = WordFrequencies()
+            for partition in self.partitions("lines"):
+                lines = partition.select(["poem_id", "line_content"]).to_pandas()
+                lines["author_id"] = lines["poem_id"].map(poem_authors)
+                frequencies.add_lines(lines)
+            self._frequencies = frequencies
+        return self._frequencies
+
+
+# parse the command line and export the corpus
+def command_line(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Export the corpus to memory-mappable Arrow files")
+    parser.add_argument("--path", default=SNAPSHOT_DIR, help="snapshot directory")
+    parser.add_argument("--partition-rows", type=int, default=PARTITION_ROWS, help="rows per partition file")
+    args = parser.parse_args(argv)
+    export_snapshot(args.path, args.partition_rows)
+
+
+if __name__ == '__main__':
+    command_line()
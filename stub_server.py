@@ -0,0 +1,188 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+# a few canned PoetryDB records, including a title that matches more than one poem
+SAMPLE_POEMS = [
+    {
+        "title": "Ozymandias",
+        "author": "Percy Bysshe Shelley",
+        "lines": [
+            "I met a traveller from an antique land",
+            "Who said: \"Two vast and trunkless legs of stone",
+            "Stand in the desert. Near them, on the sand,",
+            "Half sunk, a shattered visage lies...\"",
+        ],
+        "linecount": "4",
+    },
+    {
+        "title": "'Twould ease -- a Butterfly --",
+        "author": "Emily Dickinson",
+        "lines": [
+            "'Twould ease -- a Butterfly --",
+            "Elate -- a Bee --",
+            "Thou'rt neither --",
+            "Neither -- thy capacity --",
+        ],
+        "linecount": "4",
+    },
+    {
+        "title": "Sonnet 18: Shall I compare thee to a summer's day?",
+        "author": "William Shakespeare",
+        "lines": [
+            "Shall I compare thee to a summer's day?",
+            "Thou art more lovely and more temperate:",
+            "Rough winds do shake the darling buds of May,",
+            "And summer's lease hath all too short a date;",
+        ],
+        "linecount": "4",
+    },
+    {
+        "title": "Sonnet 18: Shall I compare thee to a summer's day? (draft)",
+        "author": "William Shakespeare",
+        "lines": [
+            "Shall I compare thee to a summer's day?",
+            "  \"Thou art more lovely and more temperate\"  ",
+        ],
+        "linecount": "2",
+    },
+]
+
+WORDS = ["night", "love", "heart", "dawn", "winter", "sea", "light", "god", "rose", "spring",
+         "shadow", "soul", "morning", "grave", "dream", "fire", "stone", "bird", "summer", "tear"]
+
+
+# generate simple fake poems so the fetcher can be timed over many titles
+def make_poems(count, seed=0):
+    rng = random.Random(seed)
+    poems = []
+    for i in range(count):
+        lines = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 9)))
+                 for _ in range(rng.randint(2, 30))]
+        poems.append({
+            "title": "Poem %d %s" % (i, rng.choice(WORDS).title()),
+            "author": "Author %d" % (i % 50),
+            "lines": lines,
+            "linecount": str(len(lines)),
+        })
+    return poems
+
+
+# local stand-in for the PoetryDB API serving canned /author, /author/<a>, /title and /title/<t> responses
+# responses carry an ETag and conditional requests get a 304, like a caching web server
+class StubPoetryDB:
+    def __init__(self, poems=None, host="127.0.0.1", port=0, latency=0.0, failures=0):
+        self.poems = list(SAMPLE_POEMS if poems is None else poems)
+        # seconds slept before every response, to simulate a remote server
+        self.latency = latency
+        # the first `failures` requests to each path get a 503, to exercise retries
+        self.failures = failures
+        self.request_count = 0
+        self.failed_paths = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    # route a request path to (status code, json body)
+    def respond(self, path):
+        with self.lock:
+            self.request_count += 1
+            if self.failures and self.failed_paths.get(path, 0) < self.failures:
+                self.failed_paths[path] = self.failed_paths.get(path, 0) + 1
+                return 503, {"status": 503, "reason": "Service Unavailable"}
+
+        parts = [unquote(part) for part in urlsplit(path).path.split("/", 2)[1:]]
+        if parts == ["author"]:
+            return 200, {"authors": sorted({poem["author"] for poem in self.poems})}
+        if parts == ["title"]:
+            return 200, {"titles": sorted({poem["title"] for poem in self.poems})}
+        if len(parts) == 2 and parts[0] == "author":
+            # every poem of the author in one response, PoetryDB matches author names by substring unless the
+            # name ends with :abs
+            if parts[1].endswith(":abs"):
+                matches = [poem for poem in self.poems if poem["author"] == parts[1][:-len(":abs")]]
+            else:
+                matches = [poem for poem in self.poems if parts[1] in poem["author"]]
+            if matches:
+                return 200, matches
+        if len(parts) == 2 and parts[0] == "title":
+            # like PoetryDB, a title search matches every title containing the text
+            matches = [poem for poem in self.poems if parts[1] in poem["title"]]
+            if matches:
+                return 200, matches
+        # PoetryDB reports missing records with a 200 response and a status field
+        return 200, {"status": 404, "reason": "Not found"}
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, body = stub.respond(self.path)
+                payload = json.dumps(body).encode("utf-8")
+                etag = '"%s"' % hashlib.md5(payload).hexdigest()
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 200:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve canned PoetryDB responses locally")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--poems", type=int, default=0, help="serve this many generated poems instead of the samples")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failures", type=int, default=0)
+    args = parser.parse_args()
+
+    stub = StubPoetryDB(make_poems(args.poems) if args.poems else None, port=args.port,
+                        latency=args.latency, failures=args.failures)
+    print("Serving stand-in PoetryDB at " + stub.base_url)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
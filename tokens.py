@@ -0,0 +1,253 @@
+import db
+
+# tokens splits every line the same way the EDA queries did, STRING_TO_ARRAY(line_content, ' '),
+# so counts read from the precomputed tables match the old full-corpus UNNEST scans
+# word_counts and poem_word_stats are tables rather than materialized views so they can be updated
+# incrementally, a materialized view can only be recomputed from scratch
+TOKEN_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS tokens (
+        poem_id INT NOT NULL,
+        line_id INT NOT NULL,
+        position INT NOT NULL,
+        word_lower TEXT NOT NULL,
+        PRIMARY KEY (line_id, position)
+    );
+    CREATE INDEX IF NOT EXISTS tokens_word_lower_idx ON tokens (word_lower);
+    CREATE INDEX IF NOT EXISTS tokens_poem_id_idx ON tokens (poem_id);
+
+    -- occurrences of every lower-cased word across the corpus
+    CREATE TABLE IF NOT EXISTS word_counts (
+        word_lower TEXT PRIMARY KEY,
+        frequency BIGINT NOT NULL
+    );
+
+    -- distinct lower-cased words longer than two characters in each poem
+    CREATE TABLE IF NOT EXISTS poem_word_stats (
+        poem_id INT PRIMARY KEY,
+        unique_words INT NOT NULL
+    );
+
+    -- highest line_id that has been tokenized and how many lines up to it were
+    CREATE TABLE IF NOT EXISTS token_watermark (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        last_line_id INT NOT NULL,
+        lines_counted BIGINT
+    );
+    -- watermarks of earlier versions have no count, which makes the next refresh start over
+    ALTER TABLE token_watermark ADD COLUMN IF NOT EXISTS lines_counted BIGINT;
+    INSERT INTO token_watermark (last_line_id, lines_counted) VALUES (0, 0) ON CONFLICT (id) DO NOTHING;
+
+    -- lines updated or deleted since the last refresh, recorded by the triggers below
+    CREATE TABLE IF NOT EXISTS token_changes (
+        line_id INT NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION record_token_changes() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            INSERT INTO token_changes (line_id) SELECT line_id FROM old_lines UNION SELECT line_id FROM new_lines;
+        ELSE
+            INSERT INTO token_changes (line_id) SELECT line_id FROM old_lines;
+        END IF;
+        RETURN NULL;
+    END
+    $$;
+"""
+
+# statement-level like poemstore's triggers, an UPDATE of many lines records them in one INSERT
+TOKEN_TRIGGERS_SQL = """
+    DROP TRIGGER IF EXISTS token_changes_update ON lines;
+    DROP TRIGGER IF EXISTS token_changes_delete ON lines;
+    CREATE TRIGGER token_changes_update AFTER UPDATE ON lines
+        REFERENCING OLD TABLE AS old_lines NEW TABLE AS new_lines
+        FOR EACH STATEMENT EXECUTE FUNCTION record_token_changes();
+    CREATE TRIGGER token_changes_delete AFTER DELETE ON lines
+        REFERENCING OLD TABLE AS old_lines FOR EACH STATEMENT EXECUTE FUNCTION record_token_changes();
+"""
+
+
+# create the token and aggregate tables if they don't exist yet, and the triggers on lines if they are missing
+# returns True when the triggers had to be created: changes made without them weren't recorded
+def ensure_token_tables(cursor):
+    cursor.execute(TOKEN_TABLES_SQL)
+    cursor.execute("SELECT COUNT(*) FROM pg_trigger "
+                   "WHERE tgrelid = 'lines'::regclass AND tgname LIKE 'token_changes_%%'")
+    if cursor.fetchone()[0] == 2:
+        return False
+    cursor.execute(TOKEN_TRIGGERS_SQL)
+    return True
+
+
+# (highest tokenized line_id, lines counted up to it, whether changes are waiting), None before the first refresh
+def token_state(cursor):
+    cursor.execute("SELECT to_regclass('token_watermark') IS NOT NULL AND to_regclass('token_changes') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return None
+    cursor.execute("SELECT last_line_id, lines_counted, EXISTS (SELECT 1 FROM token_changes) FROM token_watermark")
+    return cursor.fetchone()
+
+
+# tokenize the lines of a temporary (line_id, poem_id, line_content) table and add their words to word_counts
+def add_lines(cursor, table):
+    cursor.execute("""
+        INSERT INTO tokens (poem_id, line_id, position, word_lower)
+        SELECT l.poem_id, l.line_id, t.position, LOWER(t.word)
+        FROM {table} l,
+        LATERAL UNNEST(STRING_TO_ARRAY(l.line_content, ' ')) WITH ORDINALITY AS t(word, position)
+        WHERE l.poem_id IS NOT NULL
+    """.format(table=table))
+    token_count = cursor.rowcount
+    cursor.execute("""
+        INSERT INTO word_counts (word_lower, frequency)
+        SELECT word_lower, COUNT(*)
+        FROM tokens
+        WHERE line_id IN (SELECT line_id FROM {table})
+        GROUP BY word_lower
+        ON CONFLICT (word_lower) DO UPDATE SET frequency = word_counts.frequency + EXCLUDED.frequency
+    """.format(table=table))
+    return token_count
+
+
+# recount distinct words of the poems a query selects
+def update_poem_stats(cursor, poems_sql):
+    cursor.execute("""
+        INSERT INTO poem_word_stats (poem_id, unique_words)
+        SELECT poem_id, COUNT(DISTINCT word_lower)
+        FROM tokens
+        WHERE poem_id IN ({poems})
+        AND LENGTH(word_lower) > 2
+        GROUP BY poem_id
+        ON CONFLICT (poem_id) DO UPDATE SET unique_words = EXCLUDED.unique_words
+    """.format(poems=poems_sql))
+
+
+# take the tokens of the lines in token_changed out of the aggregates and tokenize their current content
+def apply_changes(cursor):
+    cursor.execute("""
+        CREATE TEMP TABLE token_changed_poems ON COMMIT DROP AS
+        SELECT poem_id FROM tokens WHERE line_id IN (SELECT line_id FROM token_changed)
+        UNION SELECT poem_id FROM token_changed WHERE poem_id IS NOT NULL
+    """)
+    cursor.execute("""
+        UPDATE word_counts w SET frequency = w.frequency - o.frequency
+        FROM (
+            SELECT word_lower, COUNT(*) AS frequency FROM tokens
+            WHERE line_id IN (SELECT line_id FROM token_changed)
+            GROUP BY word_lower
+        ) o
+        WHERE w.word_lower = o.word_lower
+    """)
+    cursor.execute("DELETE FROM tokens WHERE line_id IN (SELECT line_id FROM token_changed)")
+    token_count = add_lines(cursor, "token_changed")
+    cursor.execute("DELETE FROM word_counts WHERE frequency <= 0")
+    update_poem_stats(cursor, "SELECT poem_id FROM token_changed_poems")
+    # poems left without words longer than two characters
+    cursor.execute("""
+        DELETE FROM poem_word_stats s
+        WHERE s.poem_id IN (SELECT poem_id FROM token_changed_poems)
+        AND NOT EXISTS (SELECT 1 FROM tokens t WHERE t.poem_id = s.poem_id AND LENGTH(t.word_lower) > 2)
+    """)
+    return token_count
+
+
+# tokenize lines added since the last refresh, retokenize lines updated in place, drop deleted lines, and fold
+# it all into the aggregates; run by the ingest when it's done, readers only read the tables
+# rebuild=True starts over, cheaper than retokenizing when most lines changed (e.g. by the legacy clean-up pass)
+# it also starts over by itself when lines committed after the watermark passed them, which happens when several
+# ingest processes write while a refresh runs
+def refresh_tokens(rebuild=False):
+    with db.cursor() as cursor:
+        # serialize refreshes, two running at once would count the same lines twice
+        # taken before the tables are touched, so two refreshes can't each hold a lock the other waits for
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('refresh_tokens'))")
+        if ensure_token_tables(cursor):
+            rebuild = True
+        cursor.execute("SELECT last_line_id, lines_counted FROM token_watermark")
+        watermark, lines_counted = cursor.fetchone()
+        # changes are taken in one statement, one committing later stays recorded for the next refresh
+        # lines past the watermark are tokenized with their current content below anyway
+        cursor.execute("""
+            CREATE TEMP TABLE token_changed ON COMMIT DROP AS
+            WITH taken AS (DELETE FROM token_changes RETURNING line_id)
+            SELECT DISTINCT t.line_id, l.poem_id, l.line_content, l.line_id IS NULL AS deleted
+            FROM taken t
+            LEFT JOIN lines l ON l.line_id = t.line_id
+            WHERE t.line_id <= %s
+        """, (watermark,))
+        changed = cursor.rowcount
+        cursor.execute("SELECT COUNT(*) FROM token_changed WHERE deleted")
+        lines_counted -= cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FILTER (WHERE line_id <= %s), COALESCE(MAX(line_id), 0) FROM lines",
+                       (watermark,))
+        still_there, upto = cursor.fetchone()
+        token_count = 0
+        if rebuild or still_there != lines_counted:
+            cursor.execute("TRUNCATE tokens, word_counts, poem_word_stats")
+            watermark, lines_counted = 0, 0
+        elif changed:
+            token_count = apply_changes(cursor)
+        if upto <= watermark:
+            cursor.execute("UPDATE token_watermark SET last_line_id = %s, lines_counted = %s",
+                           (watermark, lines_counted))
+            return token_count
+
+        window = {"watermark": watermark, "upto": upto}
+        # every statement of a transaction reads its own snapshot, so the window is read once and the lines
+        # tokenized are exactly the ones counted; a line committing later is caught by the count next time
+        cursor.execute("""
+            CREATE TEMP TABLE token_window ON COMMIT DROP AS
+            SELECT line_id, poem_id, line_content FROM lines
+            WHERE line_id > %(watermark)s AND line_id <= %(upto)s
+        """, window)
+        lines_counted += cursor.rowcount
+        token_count += add_lines(cursor, "token_window")
+        # recount distinct words of every poem that received new lines
+        update_poem_stats(cursor, "SELECT DISTINCT poem_id FROM token_window WHERE poem_id IS NOT NULL")
+
+        cursor.execute("UPDATE token_watermark SET last_line_id = %s, lines_counted = %s", (upto, lines_counted))
+        return token_count
+
+
+# frequency of each of the given words
+def word_frequency_query(words):
+    word_list = ", ".join("'%s'" % word.replace("'", "''") for word in words)
+    return """
+        SELECT word_lower AS word, frequency
+        FROM word_counts
+        WHERE word_lower IN ({word_list})
+        ORDER BY frequency DESC
+    """.format(word_list=word_list)
+
+
+# most frequent words longer than two characters that aren't excluded
+def top_words_query(excluded_words, limit):
+    excluded = ", ".join("'%s'" % word.replace("'", "''") for word in excluded_words)
+    return """
+        SELECT word_lower AS word, frequency
+        FROM word_counts
+        WHERE LENGTH(word_lower) > 2
+        AND word_lower NOT IN ({excluded})
+        AND word_lower NOT LIKE '%''%'
+        AND word_lower NOT LIKE '%,'
+        ORDER BY frequency DESC
+        LIMIT {limit}
+    """.format(excluded=excluded, limit=int(limit))
+
+
+# number of distinct words per poem next to its line count
+def word_diversity_query(max_line_count):
+    return """
+        SELECT p.poem_id, p.line_count, s.unique_words
+        FROM poems p
+        JOIN poem_word_stats s ON s.poem_id = p.poem_id
+        WHERE p.line_count < {max_line_count}
+    """.format(max_line_count=int(max_line_count))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fill the tokens table and the word aggregates")
+    parser.add_argument("--rebuild", action="store_true", help="drop every token and tokenize all lines again")
+    args = parser.parse_args()
+    print("Tokenized %d words" % refresh_tokens(rebuild=args.rebuild))
@@ -1,45 +1,38 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import matplotlib
+# the charts are only saved to files, so use the non-interactive backend (also safe in worker processes)
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import seaborn as sns
 import pandas as pd
-import numpy as np
-from wordcloud import WordCloud
-import squarify
-import nltk
-from nltk.corpus import stopwords
-import psycopg2
-from PIL import Image
-
-DB_PARAMS = {
-    'dbname': 'poetry',
-    'user': '',
-    'host': 'localhost',
-    'port': '5432'
-}
 
-# Set the style for all plots
-plt.style.use('seaborn')
-sns.set_palette("deep")
+import analytics
+
+# content hash of the data each chart was last rendered from
+RENDER_STATE_PATH = os.path.join(".cache", "charts.json")
+# processes rendering charts at once
+RENDER_WORKERS = 4
+
+# seaborn, squarify, wordcloud and PIL are imported by the charts that use them, so rendering one chart
+# or importing this module doesn't load them all
+
 
-def execute_query(query):
-    conn = psycopg2.connect(**DB_PARAMS)
-    return pd.read_sql_query(query, conn)
+# Set the style for all plots, the 'seaborn' style is called 'seaborn-v0_8' since matplotlib 3.6
+def set_style():
+    import seaborn as sns
+
+    plt.style.use('seaborn' if 'seaborn' in plt.style.available else 'seaborn-v0_8')
+    sns.set_palette("deep")
 
 # 1. Distribution of poem lengths (Pie Chart)
-def draw_distribution_of_poem_lengths():
-    poem_length_distribution = execute_query("""
-            SELECT 
-                CASE 
-                    WHEN line_count <= 4 THEN 'Very Short (1-4 lines)'
-                    WHEN line_count <= 14 THEN 'Short (5-14 lines)'
-                    WHEN line_count <= 30 THEN 'Medium (15-30 lines)'
-                    WHEN line_count <= 50 THEN 'Long (31-50 lines)'
-                    ELSE 'Very Long (50+ lines)'
-                END as length_category,
-                COUNT(*) as poem_count
-            FROM poems
-            GROUP BY length_category
-            ORDER BY poem_count DESC
-        """)
+def draw_distribution_of_poem_lengths(poem_length_distribution=None):
+    if poem_length_distribution is None:
+        poem_length_distribution = analytics.load(analytics.POEM_LENGTHS)
 
     plt.figure(figsize=(14, 10))
     colors = ["#8ECFC9", "#FFBE7A", "#FA7F6F", "#82B0D2", "#BEB8DC" ]
@@ -58,17 +51,11 @@ def draw_distribution_of_poem_lengths():
     plt.close()
 
 # 2. Top 10 most productive authors (Horizontal Bar Chart)
-def draw_top_10_most_productive_authors():
-    author_productivity = execute_query("""
-        SELECT a.author_name, 
-               COUNT(DISTINCT p.poem_id) as poem_count,
-               SUM(p.line_count) as total_lines
-        FROM authors a
-        JOIN poems p ON a.author_id = p.author_id
-        GROUP BY a.author_name
-        ORDER BY poem_count DESC
-        LIMIT 10
-    """)
+def draw_top_10_most_productive_authors(author_productivity=None):
+    import seaborn as sns
+
+    if author_productivity is None:
+        author_productivity = analytics.load(analytics.AUTHOR_PRODUCTIVITY)
 
     plt.figure(figsize=(12, 8))
     barplot = sns.barplot(
@@ -89,21 +76,13 @@ def draw_top_10_most_productive_authors():
     plt.close()
 
 # 3. Time-related words frequency (Treemap)
-# delete the word 'may' from the query, because it has more possibility to be recognized as "might"
-def draw_time_related_words_frequency():
-    time_references = execute_query("""
-        SELECT LOWER(word) as word, COUNT(*) as frequency
-        FROM poems p
-        JOIN lines l ON p.poem_id = l.poem_id,
-        LATERAL UNNEST(STRING_TO_ARRAY(l.line_content, ' ')) AS word
-        WHERE LOWER(word) IN ('morning', 'afternoon', 'evening', 'night', 
-                              'dawn', 'dusk', 'noon', 'midnight',
-                              'spring', 'summer', 'autumn', 'winter',
-                              'january', 'february', 'march', 'april', 'june',
-                              'july', 'august', 'september', 'october', 'november', 'december')
-        GROUP BY LOWER(word)
-        ORDER BY frequency DESC
-    """)
+# delete the word 'may' from the results, because it has more possibility to be recognized as "might"
+def draw_time_related_words_frequency(time_references=None):
+    import squarify
+
+    if time_references is None:
+        time_references = analytics.load(analytics.TIME_REFERENCES)
+    time_references = time_references[time_references['word'] != 'may']
 
     plt.figure(figsize=(22, 14))
     color = ["#BEB8DC", "#E7DAD2", "#E7EFFA","#f2d9aa","#edfff5"]
@@ -122,34 +101,14 @@ def draw_time_related_words_frequency():
 
 
 # 4. Top 50 most common words (Word Cloud)
-def draw_top_50_most_common_words():
-    # download the stopwords list
-    nltk.download('stopwords')
-    # get the list of stopwords
-    stop_words = stopwords.words('english')
-    # Escape stop words containing single quotes (replace ' with '' to avoid SQL errors)
-    stop_words_escaped = [word.replace("'", "''") for word in stop_words]
-    # convert the stop words list to a format that can be used in SQL queries
-    stopwords_sql = "', '".join(stop_words_escaped)
-
-    # SQL query to get the top 20 most common words across all poems
-    theme_words_query = f"""
-        SELECT LOWER(word) as word, COUNT(*) as frequency
-        FROM poems p
-        JOIN lines l ON p.poem_id = l.poem_id,
-        LATERAL UNNEST(STRING_TO_ARRAY(l.line_content, ' ')) AS word
-        WHERE LENGTH(word) > 2
-        AND LOWER(word) NOT IN ('{stopwords_sql}', 'thy', 'thou', 'thee', 'shall', 'unto', 'thine', 'yet', 'thee', 'would', 'upon',
-        'let', 'still', 'though', 'like', 'could', 'must', 'whose', 'thus', 'made', 'till', 'every', 'might', 'many', 'make', 'ever',
-        'hath', 'first', 'know', 'come', 'even', 'last', 'much')
-        AND LOWER(word) NOT LIKE '%''%'
-        AND LOWER(word) NOT LIKE '%,'
-        GROUP BY LOWER(word)
-        ORDER BY frequency DESC
-        LIMIT 50
-    """
-
-    theme_words = execute_query(theme_words_query)
+def draw_top_50_most_common_words(theme_words=None):
+    import numpy as np
+    from PIL import Image
+    from wordcloud import WordCloud
+
+    # nltk stopwords and our own custom stopwords are left out, see analytics.excluded_words
+    if theme_words is None:
+        theme_words = analytics.load(analytics.THEME_WORDS)
     # set the path to the image that will be used as a mask for the word cloud
     cloud_image = np.array(Image.open('./img.WEBP'))
     # use the 'Set2' colormap for the word cloud
@@ -173,16 +132,11 @@ def draw_top_50_most_common_words():
     plt.close()
 
 # 5. Correlation between poem length and word diversity (Scatter plot)
-def draw_poem_length_word_diversity():
-    poem_diversity = execute_query("""
-        SELECT p.poem_id, p.line_count, COUNT(DISTINCT LOWER(word)) as unique_words
-        FROM poems p
-        JOIN lines l ON p.poem_id = l.poem_id,
-        LATERAL UNNEST(STRING_TO_ARRAY(l.line_content, ' ')) AS word
-        WHERE LENGTH(word) > 2
-        AND line_count < 5000
-        GROUP BY p.poem_id, p.line_count
-    """)
+def draw_poem_length_word_diversity(poem_diversity=None):
+    import seaborn as sns
+
+    if poem_diversity is None:
+        poem_diversity = analytics.load(analytics.WORD_DIVERSITY)
 
     plt.figure(figsize=(10, 6))
     sns.scatterplot(x='line_count', y='unique_words', data=poem_diversity, alpha=0.6)
@@ -194,11 +148,137 @@ def draw_poem_length_word_diversity():
     plt.close()
 
 
-print("All visualizations have been created and saved.")
+# chart name: (dataset it is drawn from, function drawing it, image it saves)
+CHARTS = {
+    'poem_lengths': (analytics.POEM_LENGTHS, draw_distribution_of_poem_lengths,
+                     'poem_length_distribution.png'),
+    'productive_authors': (analytics.AUTHOR_PRODUCTIVITY, draw_top_10_most_productive_authors,
+                           'top_10_productive_authors.png'),
+    'time_words': (analytics.TIME_REFERENCES, draw_time_related_words_frequency,
+                   'time_related_words_treemap.png'),
+    'word_cloud': (analytics.THEME_WORDS, draw_top_50_most_common_words,
+                   'top_50_words_wordcloud.png'),
+    'word_diversity': (analytics.WORD_DIVERSITY, draw_poem_length_word_diversity,
+                       'poem_length_word_diversity.png'),
+}
+
+
+# content hash of a query result, equal results give equal hashes
+def data_hash(data):
+    digest = hashlib.sha1(",".join(data.columns).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def load_render_state():
+    try:
+        with open(RENDER_STATE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_render_state(state):
+    os.makedirs(os.path.dirname(RENDER_STATE_PATH), exist_ok=True)
+    with open(RENDER_STATE_PATH, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+# load datasets concurrently, returns {dataset: (data, seconds it took)}
+def fetch_datasets(names):
+    # work out the dataset version once instead of in every thread
+    analytics.dataset_version()
+
+    def fetch(name):
+        started = time.perf_counter()
+        data = analytics.load(name)
+        return data, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=max(len(names), 1)) as executor:
+        return dict(zip(names, executor.map(fetch, names)))
+
+
+# draw one chart from its data, returns the seconds it took
+def render_chart(name, data):
+    started = time.perf_counter()
+    set_style()
+    CHARTS[name][1](data)
+    return time.perf_counter() - started
+
+
+# fetch the data of the charts concurrently and draw them in a process pool
+# changed_only skips charts whose data hashes the same as on the last run and whose image still exists
+def render_charts(names=None, changed_only=False, workers=RENDER_WORKERS):
+    started = time.perf_counter()
+    names = list(names or CHARTS)
+    datasets = fetch_datasets(sorted({CHARTS[name][0] for name in names}))
+    state = load_render_state()
+
+    hashes = {}
+    timings = {}
+    for name in names:
+        dataset, draw, path = CHARTS[name]
+        data, fetch_seconds = datasets[dataset]
+        hashes[name] = data_hash(data)
+        timings[name] = [fetch_seconds, None, "pending"]
+        if changed_only and state.get(name) == hashes[name] and os.path.exists(path):
+            timings[name][2] = "unchanged"
+    pending = [name for name in names if timings[name][2] == "pending"]
+
+    def finished(name, result):
+        try:
+            timings[name][1] = result()
+            timings[name][2] = "rendered"
+            state[name] = hashes[name]
+        except Exception as e:
+            print("Failed to render " + name + ": " + str(e))
+            timings[name][2] = "failed"
+
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = {name: executor.submit(render_chart, name, datasets[CHARTS[name][0]][0]) for name in pending}
+            for name, future in futures.items():
+                finished(name, future.result)
+    else:
+        for name in pending:
+            finished(name, lambda: render_chart(name, datasets[CHARTS[name][0]][0]))
+    save_render_state(state)
+    print_timings(timings, time.perf_counter() - started)
+    if all(status != "failed" for _, _, status in timings.values()):
+        print("All visualizations have been created and saved.")
+    return timings
+
+
+def print_timings(timings, total_seconds):
+    print("%-20s %10s %10s  %s" % ("chart", "fetch", "render", "status"))
+    for name, (fetch_seconds, render_seconds, status) in timings.items():
+        render = "-" if render_seconds is None else "%.3fs" % render_seconds
+        print("%-20s %9.3fs %10s  %s" % (name, fetch_seconds, render, status))
+    print("%-20s %10s %9.3fs" % ("total (wall clock)", "", total_seconds))
+
+
+# parse the command line and render the charts
+def command_line(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Render the charts")
+    parser.add_argument("charts", nargs="*", help="charts to render, all by default: " + ", ".join(CHARTS))
+    parser.add_argument("--changed-only", action="store_true",
+                        help="skip charts whose data didn't change since the last run")
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS, help="rendering processes, 1 renders in-process")
+    parser.add_argument("--snapshot", help="read the corpus from this snapshot directory instead of the database")
+    parser.add_argument("--approximate", action="store_true",
+                        help="draw the word charts from streaming sketch estimates")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.charts if name not in CHARTS]
+    if unknown:
+        parser.error("unknown chart: " + ", ".join(unknown))
+    if args.approximate and args.snapshot:
+        parser.error("--approximate reads the sketches stored in the database, it can't be used with --snapshot")
+    if args.snapshot:
+        analytics.use_snapshot(args.snapshot)
+    analytics.use_approximate(args.approximate)
+
+    render_charts(args.charts, changed_only=args.changed_only, workers=args.workers)
+
 
 if __name__ == '__main__':
-    draw_distribution_of_poem_lengths()
-    draw_top_10_most_productive_authors()
-    draw_time_related_words_frequency()
-    draw_top_50_most_common_words()
-    draw_poem_length_word_diversity()
\ No newline at end of file
+    command_line()
\ No newline at end of file
@@ -0,0 +1,325 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import db
+from frames import execute_query
+from tokens import token_state, top_words_query, word_diversity_query, word_frequency_query
+
+# lines pulled from the server-side cursor per round trip
+FETCH_SIZE = 50000
+
+# "sql" reads the token tables, "python" counts in this process, "auto" picks per query
+BACKENDS = ("auto", "sql", "python")
+BACKEND = "auto"
+
+_frequencies = None
+_lock = threading.Lock()
+
+
+# word counts of the whole corpus kept in this process
+# every distinct lower-cased word gets an integer id, counts are numpy arrays indexed by it
+class WordFrequencies:
+    def __init__(self):
+        self.words = []
+        self.word_ids = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.poem_authors = {}
+        # (poem_id << 32 | word_id, count) pairs of every chunk, merged on first use
+        self.pair_chunks = []
+        self._poem_pairs = None
+        # (line count, highest line_id) of the lines counted, to tell when the counts are out of date
+        self.state = (0, 0)
+
+    # global ids of a chunk's distinct words, adding the new ones to the vocabulary
+    def vocabulary_ids(self, uniques):
+        ids = np.empty(len(uniques), dtype=np.int64)
+        for i, word in enumerate(uniques):
+            word_id = self.word_ids.get(word)
+            if word_id is None:
+                word_id = self.word_ids[word] = len(self.words)
+                self.words.append(word)
+            ids[i] = word_id
+        return ids
+
+    # count the words of a chunk of (poem_id, author_id, line_content) rows
+    def add_lines(self, rows):
+        frame = pd.DataFrame(rows, columns=["poem_id", "author_id", "line_content"])
+        # STRING_TO_ARRAY(line_content, ' ') splits on every single space and gives no words for ''
+        frame = frame[frame["poem_id"].notna() & frame["line_content"].notna() & (frame["line_content"] != "")]
+        if frame.empty:
+            return
+        self.poem_authors.update(zip(frame["poem_id"], frame["author_id"]))
+        words = frame["line_content"].str.lower().str.split(" ").explode()
+        codes, uniques = pd.factorize(words.to_numpy())
+        word_ids = self.vocabulary_ids(uniques)[codes]
+
+        chunk_counts = np.bincount(word_ids, minlength=len(self.words))
+        if len(self.counts) < len(chunk_counts):
+            self.counts = np.pad(self.counts, (0, len(chunk_counts) - len(self.counts)))
+        self.counts += chunk_counts
+
+        poem_ids = frame["poem_id"].to_numpy(dtype=np.int64)[frame.index.get_indexer(words.index)]
+        pairs, pair_counts = np.unique((poem_ids << 32) | word_ids, return_counts=True)
+        self.pair_chunks.append((pairs, pair_counts))
+        self._poem_pairs = None
+
+    # (pairs, counts) of every poem and word, merged across chunks
+    def poem_pairs(self):
+        if self._poem_pairs is None:
+            if self.pair_chunks:
+                pairs = np.concatenate([chunk[0] for chunk in self.pair_chunks])
+                counts = np.concatenate([chunk[1] for chunk in self.pair_chunks])
+                # lines are streamed by line_id, so a poem can span two chunks
+                pairs, inverse = np.unique(pairs, return_inverse=True)
+                counts = np.bincount(inverse, weights=counts).astype(np.int64)
+                self.pair_chunks = [(pairs, counts)]
+            else:
+                pairs = counts = np.zeros(0, dtype=np.int64)
+            self._poem_pairs = (pairs, counts)
+        return self._poem_pairs
+
+    def frequency_frame(self, word_ids, counts):
+        words = np.asarray(self.words, dtype=object)
+        frame = pd.DataFrame({"word": words[word_ids], "frequency": counts})
+        return frame.sort_values(["frequency", "word"], ascending=[False, True], ignore_index=True)
+
+    # most frequent words, with the same filters as tokens.top_words_query
+    def top_words(self, limit, excluded_words=()):
+        words = pd.Series(self.words, dtype=object)
+        keep = ((words.str.len() > 2) & ~words.isin(set(excluded_words))
+                & ~words.str.contains("'", regex=False) & ~words.str.endswith(","))
+        word_ids = np.flatnonzero(keep.to_numpy() & (self.counts > 0))
+        word_ids = word_ids[np.argsort(-self.counts[word_ids], kind="stable")][:limit]
+        return self.frequency_frame(word_ids, self.counts[word_ids])
+
+    # frequency of each of the given words that occurs
+    def word_frequency(self, words):
+        word_ids = np.array(sorted({self.word_ids[word] for word in words if word in self.word_ids}), dtype=np.int64)
+        return self.frequency_frame(word_ids, self.counts[word_ids])
+
+    # (poem_id, word, frequency) of one poem, or of every poem
+    def poem_counts(self, poem_id=None):
+        pairs, counts = self.poem_pairs()
+        poem_ids = pairs >> 32
+        selected = slice(None) if poem_id is None else poem_ids == poem_id
+        return self.grouped_frame("poem_id", poem_ids[selected], pairs[selected] & 0xFFFFFFFF, counts[selected])
+
+    # (author_id, word, frequency) of one author, or of every author
+    def author_counts(self, author_id=None):
+        pairs, counts = self.poem_pairs()
+        author_ids = pd.Series(pairs >> 32).map(self.poem_authors).to_numpy()
+        selected = pd.notna(author_ids)
+        if author_id is not None:
+            selected &= author_ids == author_id
+        frame = pd.DataFrame({"author_id": author_ids[selected].astype(np.int64),
+                              "word_id": pairs[selected] & 0xFFFFFFFF,
+                              "frequency": counts[selected]})
+        frame = frame.groupby(["author_id", "word_id"], as_index=False)["frequency"].sum()
+        return self.grouped_frame("author_id", frame["author_id"].to_numpy(), frame["word_id"].to_numpy(),
+                                  frame["frequency"].to_numpy())
+
+    def grouped_frame(self, group_column, group_ids, word_ids, counts):
+        frame = pd.DataFrame({group_column: group_ids,
+                              "word": np.asarray(self.words, dtype=object)[word_ids],
+                              "frequency": counts})
+        return frame.sort_values([group_column, "frequency", "word"], ascending=[True, False, True],
+                                 ignore_index=True)
+
+
+# the state the counts depend on: (line count, highest line_id, whether the token tables cover exactly those lines)
+def corpus_state():
+    with db.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*), COALESCE(MAX(line_id), 0) FROM lines")
+        line_count, last_line_id = cursor.fetchone()
+        tokens = token_state(cursor)
+    # the ingest refreshes the tokens when it's done, they are behind while one runs or after lines were changed
+    # by hand
+    tokens_current = tokens is not None and tuple(tokens) == (last_line_id, line_count, False)
+    return line_count, last_line_id, tokens_current
+
+
+# stream every line once through a server-side cursor and count its words
+def count_words(fetch_size=None):
+    fetch_size = fetch_size or FETCH_SIZE
+    frequencies = WordFrequencies()
+    with db.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*), COALESCE(MAX(line_id), 0) FROM lines")
+        frequencies.state = cursor.fetchone()
+    # named cursor so only fetch_size lines are held at a time
+    with db.cursor("word_frequency_lines") as cursor:
+        cursor.itersize = fetch_size
+        cursor.execute("""
+            SELECT l.poem_id, p.author_id, l.line_content
+            FROM lines l
+            LEFT JOIN poems p ON p.poem_id = l.poem_id
+            ORDER BY l.line_id
+        """)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            frequencies.add_lines(rows)
+    return frequencies
+
+
+# the in-process counts of the current lines, counted again only when lines were added or removed
+def get_frequencies(state=None):
+    global _frequencies
+    if state is None:
+        state = corpus_state()
+    # datasets loaded from several threads share one pass over the lines
+    with _lock:
+        if _frequencies is None or _frequencies.state != tuple(state[:2]):
+            _frequencies = count_words()
+        return _frequencies
+
+
+# pick where a word query runs
+# in-process counts that are already current are free to reuse; token tables that cover every line are cheaper
+# to read than streaming the corpus; otherwise one streaming pass gives exact counts without writing anything
+def choose_backend(backend=None):
+    backend = backend or BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("Unknown word frequency backend: " + backend)
+    if backend != "auto":
+        return backend, None
+    state = corpus_state()
+    line_count, last_line_id, tokens_current = state
+    if _frequencies is not None and _frequencies.state == (line_count, last_line_id):
+        return "python", state
+    if tokens_current:
+        return "sql", state
+    return "python", state
+
+
+# run a query with the chosen backend, sql reads the token tables as the last ingest left them
+def run(backend, sql_query, in_process, params=None):
+    backend, state = choose_backend(backend)
+    if backend == "sql":
+        return execute_query(sql_query, params)
+    return in_process(get_frequencies(state))
+
+
+# most frequent words longer than two characters that aren't excluded
+def top_words(limit, excluded_words=(), backend=None):
+    return run(backend, top_words_query(excluded_words, limit),
+               lambda frequencies: frequencies.top_words(limit, excluded_words))
+
+
+# frequency of each of the given words
+def word_frequency(words, backend=None):
+    return run(backend, word_frequency_query(words), lambda frequencies: frequencies.word_frequency(words))
+
+
+# (poem_id, word, frequency) of one poem, or of every poem
+def poem_counts(poem_id=None, backend=None):
+    query = """
+        SELECT poem_id, word_lower AS word, COUNT(*) AS frequency
+        FROM tokens
+        {where}
+        GROUP BY poem_id, word_lower
+        ORDER BY poem_id, frequency DESC, word_lower
+    """.format(where="" if poem_id is None else "WHERE poem_id = %(id)s")
+    return run(backend, query, lambda frequencies: frequencies.poem_counts(poem_id),
+               None if poem_id is None else {"id": poem_id})
+
+
+# (author_id, word, frequency) of one author, or of every author
+def author_counts(author_id=None, backend=None):
+    query = """
+        SELECT p.author_id, t.word_lower AS word, COUNT(*) AS frequency
+        FROM tokens t
+        JOIN poems p ON p.poem_id = t.poem_id
+        WHERE p.author_id IS NOT NULL {where}
+        GROUP BY p.author_id, t.word_lower
+        ORDER BY p.author_id, frequency DESC, t.word_lower
+    """.format(where="" if author_id is None else "AND p.author_id = %(id)s")
+    return run(backend, query, lambda frequencies: frequencies.author_counts(author_id),
+               None if author_id is None else {"id": author_id})
+
+
+# distinct words longer than two characters per poem next to its line count, for poems shorter than max_line_count
+def word_diversity(max_line_count, backend=None):
+    return run(backend, word_diversity_query(max_line_count),
+               lambda frequencies: poem_word_diversity(frequencies, max_line_count))
+
+
+# word_diversity from the in-process counts, the way analytics.snapshot_word_diversity computes it
+def poem_word_diversity(frequencies, max_line_count):
+    counts = frequencies.poem_counts()
+    unique_words = counts[counts["word"].str.len() > 2].groupby("poem_id").size().rename("unique_words")
+    poems = execute_query("SELECT poem_id, line_count FROM poems WHERE line_count < %s", (int(max_line_count),))
+    return poems.join(unique_words, on="poem_id", how="inner").reset_index(drop=True)
+
+
+# the theme word ranking computed the way EDA.py used to, scanning every line with UNNEST
+def scan_top_words_query(excluded_words, limit):
+    excluded = ", ".join("'%s'" % word.replace("'", "''") for word in excluded_words)
+    return """
+        SELECT LOWER(word) as word, COUNT(*) as frequency
+        FROM lines l,
+        LATERAL UNNEST(STRING_TO_ARRAY(l.line_content, ' ')) AS word
+        WHERE l.poem_id IS NOT NULL
+        AND LENGTH(word) > 2
+        AND LOWER(word) NOT IN ({excluded})
+        AND LOWER(word) NOT LIKE '%''%'
+        AND LOWER(word) NOT LIKE '%,'
+        GROUP BY LOWER(word)
+        ORDER BY frequency DESC
+        LIMIT {limit}
+    """.format(excluded=excluded, limit=int(limit))
+
+
+# time the same queries on each backend and check that they agree
+def compare_backends(excluded_words, limit=50, repeat=3):
+    global _frequencies
+    queries = [
+        ("top %d words" % limit, lambda backend: top_words(limit, excluded_words, backend=backend)),
+        ("per-poem counts", lambda backend: poem_counts(backend=backend)),
+        ("per-author counts", lambda backend: author_counts(backend=backend)),
+    ]
+    if not corpus_state()[2]:
+        print("The token tables don't cover the current lines, run tokens.py to bring them up to date first")
+        return
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        execute_query(scan_top_words_query(excluded_words, limit))
+    print("%-18s %-26s %8.3fs" % (queries[0][0], "sql UNNEST scan", (time.perf_counter() - started) / repeat))
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        _frequencies = None
+        get_frequencies()
+    print("%-18s %-26s %8.3fs" % ("count all lines", "python (one pass)", (time.perf_counter() - started) / repeat))
+
+    for name, query in queries:
+        results = {}
+        for backend in ("sql", "python"):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                results[backend] = query(backend)
+            label = "sql token tables" if backend == "sql" else "python (counts in memory)"
+            print("%-18s %-26s %8.3fs" % (name, label, (time.perf_counter() - started) / repeat))
+        # ties in frequency can be ordered differently, so compare the counts
+        sql, in_process = results["sql"], results["python"]
+        same = len(sql) == len(in_process) and (sql["frequency"].to_numpy() == in_process["frequency"].to_numpy()).all()
+        print("%-18s %s" % ("", "results match" if same else "RESULTS DIFFER"))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from analytics import excluded_words
+
+    parser = argparse.ArgumentParser(description="Compare SQL and in-process word frequency queries")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE)
+    args = parser.parse_args()
+
+    FETCH_SIZE = args.fetch_size
+    compare_backends(excluded_words(), limit=args.limit, repeat=args.repeat)